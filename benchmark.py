@@ -0,0 +1,724 @@
+#!/usr/bin/env python
+'''Benchmarks for generate_mods.
+
+Run './benchmark.py --help' to see the available benchmarks. Each benchmark
+builds its own synthetic dataset in a temporary directory, so nothing in
+test_files or mods_files is touched.
+'''
+import codecs
+import csv
+import gc
+import json
+import multiprocessing
+import os
+import resource
+import subprocess
+import shutil
+import sys
+import tempfile
+import time
+import logging
+import zipfile
+import Queue
+from collections import OrderedDict
+from optparse import OptionParser
+from xml.sax.saxutils import escape
+
+import xlrd
+try:
+    import xlwt
+except ImportError:
+    #only needed for the .xls datasets
+    xlwt = None
+
+import generate_mods
+from generate_mods import DataHandler, DirectMapper, Mapper, PipelineStats
+
+#the benchmarks generate lots of warnings (ambiguous dates, ...) - we don't
+#   want to time the logging
+generate_mods.logger.setLevel(logging.ERROR)
+
+MAPPED_HEADERS = [u'Record name', u'Title', u'Subject', u'Name', u'Date']
+MAPPED_CTRL = [u'record name', u'<mods:titleInfo><mods:title>',
+               u'<mods:subject><mods:topic>',
+               u'<mods:name type="personal"><mods:namePart>#<mods:role><mods:roleTerm type="text">',
+               u'<mods:originInfo><mods:dateCreated encoding="w3cdtf">']
+
+
+def _mapped_values(row_num):
+    return [u'rec%07d' % row_num, u'Title %d' % row_num, u'Topic 1 || Topic 2',
+            u'Smith, J.#creator', u'10/21/2005']
+
+
+def write_csv(path, num_rows, extra_cols=0, start=0):
+    '''Write a CSV file with a header row, a control row & num_rows data rows
+    (numbered from start).
+
+    extra_cols unmapped (and empty) columns are added to each row, to make the
+    control row wider without adding any MODS data.'''
+    header = MAPPED_HEADERS + [u'extra %d' % i for i in range(extra_cols)]
+    ctrl = MAPPED_CTRL + [u'do not map'] * extra_cols
+    with open(path, 'wb') as f:
+        writer = csv.writer(f)
+        writer.writerow([v.encode('utf-8') for v in header])
+        writer.writerow([v.encode('utf-8') for v in ctrl])
+        for i in xrange(start, start + num_rows):
+            values = _mapped_values(i) + [u''] * extra_cols
+            writer.writerow([v.encode('utf-8') for v in values])
+
+
+XLSX_CONTENT_TYPES = '''<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">
+<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>
+<Default Extension="xml" ContentType="application/xml"/>
+<Override PartName="/xl/workbook.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>
+<Override PartName="/xl/worksheets/sheet1.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>
+<Override PartName="/xl/sharedStrings.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sharedStrings+xml"/>
+<Override PartName="/xl/styles.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.styles+xml"/>
+</Types>'''
+XLSX_RELS = '''<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">
+<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" Target="xl/workbook.xml"/>
+</Relationships>'''
+XLSX_WORKBOOK = '''<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">
+<sheets><sheet name="Sheet1" sheetId="1" r:id="rId1"/></sheets>
+</workbook>'''
+XLSX_WORKBOOK_RELS = '''<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">
+<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" Target="worksheets/sheet1.xml"/>
+<Relationship Id="rId2" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/sharedStrings" Target="sharedStrings.xml"/>
+<Relationship Id="rId3" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/styles" Target="styles.xml"/>
+</Relationships>'''
+#style 1 is a date (built-in number format 14)
+XLSX_STYLES = '''<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<styleSheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">
+<fonts count="1"><font><sz val="11"/><name val="Calibri"/></font></fonts>
+<fills count="1"><fill><patternFill patternType="none"/></fill></fills>
+<borders count="1"><border><left/><right/><top/><bottom/><diagonal/></border></borders>
+<cellStyleXfs count="1"><xf numFmtId="0" fontId="0" fillId="0" borderId="0"/></cellStyleXfs>
+<cellXfs count="2"><xf numFmtId="0" fontId="0" fillId="0" borderId="0" xfId="0"/><xf numFmtId="14" fontId="0" fillId="0" borderId="0" xfId="0" applyNumberFormat="1"/></cellXfs>
+</styleSheet>'''
+
+
+def _xlsx_col_name(index):
+    name = ''
+    index += 1
+    while index:
+        index, rem = divmod(index - 1, 26)
+        name = chr(65 + rem) + name
+    return name
+
+
+def write_xlsx(path, rows):
+    '''Write a minimal single-sheet .xlsx file.
+
+    rows is a list of lists of (cell type, value), using the xlrd cell types:
+    text values go in the shared strings table, numbers are written as they
+    are, and dates (Excel date numbers) get a date style.'''
+    strings = {}
+    sheet = ['<?xml version="1.0" encoding="UTF-8" standalone="yes"?>',
+             '<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main"><sheetData>']
+    col_names = [_xlsx_col_name(i) for i in range(max(len(row) for row in rows))]
+    for r, row in enumerate(rows):
+        cells = []
+        for c, (cell_type, value) in enumerate(row):
+            ref = '%s%d' % (col_names[c], r + 1)
+            if cell_type == xlrd.XL_CELL_TEXT:
+                index = strings.setdefault(value, len(strings))
+                cells.append('<c r="%s" t="s"><v>%d</v></c>' % (ref, index))
+            elif cell_type == xlrd.XL_CELL_NUMBER:
+                cells.append('<c r="%s"><v>%r</v></c>' % (ref, value))
+            elif cell_type == xlrd.XL_CELL_DATE:
+                cells.append('<c r="%s" s="1"><v>%r</v></c>' % (ref, value))
+        sheet.append('<row r="%d">%s</row>' % (r + 1, ''.join(cells)))
+    sheet.append('</sheetData></worksheet>')
+    shared = ['<?xml version="1.0" encoding="UTF-8" standalone="yes"?>',
+              '<sst xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" count="%d" uniqueCount="%d">' %
+              (len(strings), len(strings))]
+    for value, index in sorted(strings.items(), key=lambda item: item[1]):
+        shared.append(u'<si><t xml:space="preserve">%s</t></si>' % escape(value))
+    shared.append('</sst>')
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as z:
+        z.writestr('[Content_Types].xml', XLSX_CONTENT_TYPES)
+        z.writestr('_rels/.rels', XLSX_RELS)
+        z.writestr('xl/workbook.xml', XLSX_WORKBOOK)
+        z.writestr('xl/_rels/workbook.xml.rels', XLSX_WORKBOOK_RELS)
+        z.writestr('xl/styles.xml', XLSX_STYLES)
+        z.writestr('xl/worksheets/sheet1.xml', u''.join(sheet).encode('utf-8'))
+        z.writestr('xl/sharedStrings.xml', u''.join(shared).encode('utf-8'))
+
+
+def scale_sheet(src_path, dest_path, num_rows, ctrl_row=2):
+    '''Copy the first sheet of src_path to a new .xlsx file, repeating its data
+    rows until there are num_rows of them (with unique ids in the id column).'''
+    sheet = xlrd.open_workbook(src_path).sheet_by_index(0)
+    rows = [zip(sheet.row_types(r), sheet.row_values(r)) for r in range(sheet.nrows)]
+    id_col = DataHandler(src_path)._get_id_col()
+    data_rows = rows[ctrl_row:]
+    new_rows = rows[:ctrl_row]
+    for i in xrange(num_rows):
+        row = list(data_rows[i % len(data_rows)])
+        row[id_col] = (xlrd.XL_CELL_TEXT, u'rec%07d' % i)
+        new_rows.append(row)
+    write_xlsx(dest_path, new_rows)
+
+
+#realistic columns for the end-to-end datasets: (header, control row, function
+#   that takes the row number & returns (xlrd cell type, value))
+SYNTHETIC_COLUMNS = [
+    (u'ID', u'id', lambda i: (xlrd.XL_CELL_TEXT, u'rec%07d' % i)),
+    (u'Filename', u'do not map', lambda i: (xlrd.XL_CELL_TEXT, u'rec%07d.tif, rec%07d.jpg' % (i, i))),
+    (u'Local id', u'<mods:identifier type="local" displayLabel="Local id">',
+     lambda i: (xlrd.XL_CELL_NUMBER, float(100000 + i))),
+    (u'Title', u'<mods:titleInfo><mods:title>#<mods:partName>#<mods:partNumber>',
+     lambda i: (xlrd.XL_CELL_TEXT, u'Title %d#P\xe4rt \\#%d#%d' % (i, i % 7, i % 7))),
+    (u'Creator', u'<mods:name type="personal"><mods:namePart>#<mods:role><mods:roleTerm type="text">',
+     lambda i: (xlrd.XL_CELL_TEXT, u'Smith, J. %d#creator || Jones, T.#contributor' % (i % 100))),
+    (u'Date created', u'<mods:originInfo><mods:dateCreated encoding="w3cdtf" keyDate="yes">',
+     lambda i: (xlrd.XL_CELL_DATE, 38000.0 + i % 3000)),
+    (u'Date issued', u'<mods:originInfo><mods:dateIssued>',
+     lambda i: (xlrd.XL_CELL_TEXT, [u'10/21/2005', u'5/4/99', u'2001-01-01', u'13/1/2010'][i % 4])),
+    (u'Genre', u'<mods:genre authority="aat">', lambda i: (xlrd.XL_CELL_TEXT, u'photographs')),
+    (u'Subjects', u'<mods:subject><mods:topic>',
+     lambda i: (xlrd.XL_CELL_TEXT, u'Topic %d || Topic %d || \xdcnicode' % (i % 50, i % 13))),
+    (u'Place', u'<mods:subject><mods:hierarchicalGeographic><mods:country>United States</mods:country><mods:state>',
+     lambda i: (xlrd.XL_CELL_TEXT, u'Rhode Island')),
+    (u'Extent', u'<mods:physicalDescription><mods:extent>#<mods:digitalOrigin>',
+     lambda i: (xlrd.XL_CELL_TEXT, u'1 photograph#reformatted digital')),
+    (u'Note', u'<mods:note displayLabel="Note">', lambda i: (xlrd.XL_CELL_TEXT, u'Note %d || Second note' % i)),
+    (u'Abstract', u'<mods:abstract>', lambda i: (xlrd.XL_CELL_TEXT, u'' if i % 3 else u'An abstract for record %d.' % i)),
+    (u'URL', u'<mods:location><mods:url>', lambda i: (xlrd.XL_CELL_TEXT, u'http://example.org/rec%07d' % i)),
+    (u'Copy note', u'<mods:location><mods:holdingSimple><mods:copyInformation><mods:note>',
+     lambda i: (xlrd.XL_CELL_TEXT, u'Box %d' % (i // 100))),
+    (u'Language', u'<mods:language><mods:languageTerm authority="iso639-2b" type="code">',
+     lambda i: (xlrd.XL_CELL_TEXT, u'eng')),
+]
+
+
+def synthetic_rows(num_rows):
+    '''Header row, control row & num_rows data rows of (xlrd cell type, value).'''
+    rows = [[(xlrd.XL_CELL_TEXT, header) for header, ctrl, value in SYNTHETIC_COLUMNS],
+            [(xlrd.XL_CELL_TEXT, ctrl) for header, ctrl, value in SYNTHETIC_COLUMNS]]
+    for i in xrange(num_rows):
+        rows.append([value(i) for header, ctrl, value in SYNTHETIC_COLUMNS])
+    return rows
+
+
+def _csv_value(cell_type, value):
+    if cell_type == xlrd.XL_CELL_NUMBER:
+        return u'%d' % value
+    elif cell_type == xlrd.XL_CELL_DATE:
+        #CSV files just have text dates
+        return u'%04d-%02d-%02d' % xlrd.xldate_as_tuple(value, 0)[:3]
+    return value
+
+
+def write_synthetic_csv(path, rows):
+    with open(path, 'wb') as f:
+        writer = csv.writer(f)
+        for row in rows:
+            writer.writerow([_csv_value(cell_type, value).encode('utf-8') for cell_type, value in row])
+
+
+def write_xls(path, rows):
+    '''Write a single-sheet .xls file (needs xlwt).'''
+    book = xlwt.Workbook(encoding='utf-8')
+    sheet = book.add_sheet('Sheet1')
+    date_style = xlwt.easyxf(num_format_str='YYYY-MM-DD')
+    for r, row in enumerate(rows):
+        for c, (cell_type, value) in enumerate(row):
+            if cell_type == xlrd.XL_CELL_DATE:
+                sheet.write(r, c, value, date_style)
+            else:
+                sheet.write(r, c, value)
+    book.save(path)
+
+
+#format -> (extension, writer function, max data rows)
+SYNTHETIC_FORMATS = {
+    'csv': ('.csv', write_synthetic_csv, None),
+    'xls': ('.xls', write_xls, 65534),
+    'xlsx': ('.xlsx', write_xlsx, None),
+}
+
+
+def _peak_rss_kb():
+    #ru_maxrss is in kilobytes on Linux (bytes on OS X)
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        peak //= 1024
+    return peak
+
+
+def _run_end_to_end(path, mods_dir, workers, queue):
+    '''Run DataHandler + process() on path (in a child process, so each run
+    gets its own peak RSS) & put the results on queue.'''
+    generate_mods.MODS_DIR = mods_dir
+    os.makedirs(mods_dir)
+    stats = PipelineStats()
+    start = time.time()
+    generate_mods.process(DataHandler(path), workers=workers, stats=stats)
+    elapsed = time.time() - start
+    stages = dict((stage, summary['total']) for stage, summary in stats.summary().items()
+                  if not stage.startswith(u'map:'))
+    queue.put({'seconds': elapsed, 'peak_rss_kb': _peak_rss_kb(), 'stages': stages})
+
+
+def _get_child_result(child, queue, name):
+    '''Wait for the result of a _run_end_to_end child process - raises an
+    Exception if the child exits without one, or with an error code (eg. if
+    it crashed), instead of waiting forever.'''
+    result = None
+    while result is None:
+        try:
+            result = queue.get(timeout=1)
+        except Queue.Empty:
+            if not child.is_alive():
+                #it may have put the result on the queue just before it exited
+                try:
+                    result = queue.get(timeout=1)
+                except Queue.Empty:
+                    break
+    child.join()
+    if result is None or child.exitcode:
+        raise Exception('%s benchmark failed (exit code %s)' % (name, child.exitcode))
+    return result
+
+
+def bench_end_to_end(tmp_dir, num_rows=None, sizes=(1000, 10000, 100000), formats=('csv', 'xls', 'xlsx'),
+                     workers=1):
+    '''DataHandler + process() on synthetic CSV, XLS & XLSX datasets, with a
+    realistic control row. Returns the results, keyed by '<format>-<rows>'.'''
+    if num_rows:
+        sizes = (num_rows,)
+    print('DataHandler + process(), %d worker(s)' % workers)
+    print('%-14s %10s %10s %12s %10s   %s' % ('dataset', 'seconds', 'rows/sec', 'peak RSS MB',
+                                            'load secs', 'map/serialize/write secs'))
+    results = OrderedDict()
+    for size in sizes:
+        rows = synthetic_rows(size)
+        for format in formats:
+            extension, write, max_rows = SYNTHETIC_FORMATS[format]
+            name = '%s-%d' % (format, size)
+            if format == 'xls' and xlwt is None:
+                print('%-14s skipped - xlwt is not installed' % name)
+                continue
+            if max_rows and size > max_rows:
+                print('%-14s skipped - too many rows for %s' % (name, format))
+                continue
+            path = os.path.join(tmp_dir, 'synthetic-%d%s' % (size, extension))
+            write(path, rows)
+            mods_dir = os.path.join(tmp_dir, name)
+            queue = multiprocessing.Queue()
+            child = multiprocessing.Process(target=_run_end_to_end, args=(path, mods_dir, workers, queue))
+            child.start()
+            result = _get_child_result(child, queue, name)
+            shutil.rmtree(mods_dir)
+            result['rows'] = size
+            result['rows_per_sec'] = size / result['seconds']
+            results[name] = result
+            stages = result['stages']
+            print('%-14s %10.2f %10.1f %12.1f %10.2f   %.2f/%.2f/%.2f' %
+                  (name, result['seconds'], result['rows_per_sec'], result['peak_rss_kb'] / 1024.0,
+                   stages.get('load', 0.0), stages.get('map', 0.0), stages.get('serialize', 0.0),
+                   stages.get('write', 0.0)))
+    return results
+
+
+def _git_revision():
+    try:
+        with open(os.devnull, 'wb') as devnull:
+            return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=devnull).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def save_results(filename, results):
+    '''Add this run's results to filename (a JSON list of runs), so runs from
+    different commits can be compared.'''
+    runs = []
+    if os.path.exists(filename):
+        with open(filename, 'rb') as f:
+            runs = json.load(f)
+    runs.append({'revision': _git_revision(), 'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+                 'results': results})
+    with open(filename, 'wb') as f:
+        json.dump(runs, f, indent=1, sort_keys=True)
+
+
+def compare_results(filename, results):
+    '''Print the change in rows/sec & peak RSS since the last run saved in filename.'''
+    with open(filename, 'rb') as f:
+        runs = json.load(f)
+    if not runs:
+        return
+    previous = runs[-1]
+    print('Compared to %s (%s):' % (previous['revision'], previous['time']))
+    print('%-28s %14s %14s' % ('dataset', 'rows/sec', 'peak RSS'))
+    for name, result in results.items():
+        old = previous['results'].get(name)
+        if old is None:
+            continue
+        print('%-28s %+13.1f%% %+13.1f%%' %
+              (name, 100.0 * (result['rows_per_sec'] / old['rows_per_sec'] - 1),
+               100.0 * (float(result['peak_rss_kb']) / old['peak_rss_kb'] - 1)))
+
+
+def _time(func, *args, **kwargs):
+    start = time.time()
+    result = func(*args, **kwargs)
+    return time.time() - start, result
+
+
+def bench_control_row_width(tmp_dir, num_rows=2000, widths=(0, 50, 200, 800)):
+    '''Per-row cost of DataHandler.get_mods_records as the control row gets wider.
+
+    Only the 5 mapped columns have data, so any growth in the per-row cost
+    comes from scanning the control row.'''
+    print('DataHandler.get_mods_records, %d rows' % num_rows)
+    print('%12s %14s' % ('extra cols', 'usec/row'))
+    for width in widths:
+        path = os.path.join(tmp_dir, 'width-%d.csv' % width)
+        write_csv(path, num_rows, extra_cols=width)
+        dh = DataHandler(path)
+        elapsed, records = _time(dh.get_mods_records)
+        assert len(records) == num_rows
+        print('%12d %14.1f' % (width, elapsed / num_rows * 1000000))
+
+
+def bench_xlrd_columnar(tmp_dir, num_rows=20000):
+    '''DataHandler.get_mods_records on a scaled-up copy of test_files/data.xlsx,
+    reading rows one at a time vs. loading the sheet by columns.'''
+    path = os.path.join(tmp_dir, 'scaled.xlsx')
+    scale_sheet(os.path.join('test_files', 'data.xlsx'), path, num_rows)
+    print('DataHandler.get_mods_records, data.xlsx scaled to %d rows' % num_rows)
+    print('%12s %14s %14s' % ('', 'seconds', 'usec/row'))
+    results = {}
+    for columnar in (False, True):
+        gc.collect()
+        #time opening the sheet too, since that's when the columns are loaded
+        elapsed, records = _time(lambda: DataHandler(path, columnar=columnar).get_mods_records())
+        assert len(records) == num_rows
+        results[columnar] = [r.field_data() for r in records]
+        print('%12s %14.2f %14.1f' % ('columnar' if columnar else 'row by row', elapsed,
+                                      elapsed / num_rows * 1000000))
+    assert results[True] == results[False]
+
+
+def _read_csv_transcoding(path, encoding):
+    '''Read the rows of a CSV file the way DataHandler used to: decode the
+    file, re-encode each line to UTF-8 for the CSV module, & decode each cell
+    again.'''
+    with codecs.open(path, 'r', encoding) as f:
+        reader = csv.reader(line.encode('utf-8') for line in f)
+        return [[unicode(cell, 'utf-8') for cell in row] for row in reader if row]
+
+
+def bench_csv_throughput(tmp_dir, num_rows=100000):
+    '''MB/s reading the rows of synthetic UTF-8 & UTF-16 CSV files: the old
+    decode/re-encode/decode path vs. DataHandler, which only transcodes files
+    the CSV module can't parse as they are.'''
+    utf8_path = os.path.join(tmp_dir, 'synthetic-%d.csv' % num_rows)
+    write_synthetic_csv(utf8_path, synthetic_rows(num_rows))
+    utf16_path = os.path.join(tmp_dir, 'synthetic-%d-utf16.csv' % num_rows)
+    with open(utf8_path, 'rb') as src:
+        with open(utf16_path, 'wb') as dest:
+            dest.write(src.read().decode('utf-8').encode('utf-16'))
+    print('Reading CSV rows, %d rows' % num_rows)
+    print('%-8s %8s %16s %16s' % ('', 'MB', 'old MB/s', 'DataHandler MB/s'))
+    for name, path, encoding in [('utf-8', utf8_path, 'utf-8'), ('utf-16', utf16_path, 'utf-16')]:
+        size = os.path.getsize(path) / 1024.0 / 1024
+        gc.collect()
+        old_elapsed, old_rows = _time(_read_csv_transcoding, path, encoding)
+        gc.collect()
+        #DataHandler reads all the rows when it opens the file
+        elapsed, dh = _time(DataHandler, path, encoding)
+        assert dh.csvData == old_rows
+        print('%-8s %8.1f %16.1f %16.1f' % (name, size, size / old_elapsed, size / elapsed))
+
+
+def bench_batch(tmp_dir, num_rows=200, num_files=20):
+    '''Running generate_mods.py once per file vs. once with --batch for all
+    of them (num_files CSV files of num_rows rows each).'''
+    script = os.path.abspath('generate_mods.py')
+    data_dir = os.path.join(tmp_dir, 'batch-data')
+    os.makedirs(data_dir)
+    filenames = []
+    for i in range(num_files):
+        filename = os.path.join(data_dir, 'data-%03d.csv' % i)
+        write_csv(filename, num_rows, start=i * num_rows)
+        filenames.append(filename)
+    print('generate_mods.py on %d CSV files of %d rows' % (num_files, num_rows))
+    print('%-14s %10s %14s' % ('', 'seconds', 'secs/file'))
+    with open(os.devnull, 'w') as devnull:
+        for name in ('one per file', 'batch'):
+            run_dir = os.path.join(tmp_dir, 'batch-' + name.replace(' ', '-'))
+            os.makedirs(run_dir)
+            start = time.time()
+            if name == 'batch':
+                subprocess.check_call([sys.executable, script, '--batch', os.path.join(data_dir, '*.csv')],
+                                      cwd=run_dir, stdout=devnull, stderr=devnull)
+            else:
+                for filename in filenames:
+                    subprocess.check_call([sys.executable, script, filename], cwd=run_dir,
+                                          stdout=devnull, stderr=devnull)
+            elapsed = time.time() - start
+            assert len(os.listdir(os.path.join(run_dir, generate_mods.MODS_DIR))) == num_rows * num_files
+            print('%-14s %10.2f %14.3f' % (name, elapsed, elapsed / num_files))
+
+
+def _write_synthetic_xlsx(path, num_rows):
+    write_xlsx(path, synthetic_rows(num_rows))
+
+
+def _read_xlsx_records(path, streaming, queue):
+    '''Read all the ModsRecords from path (in a child process, so each run
+    gets its own peak RSS) & put (seconds, peak RSS, count) on queue.'''
+    start = time.time()
+    count = 0
+    for record in DataHandler(path, streaming=streaming).get_mods_records():
+        count += 1
+    queue.put((time.time() - start, _peak_rss_kb(), count))
+
+
+def bench_xlsx_streaming(tmp_dir, num_rows=100000):
+    '''Reading all the ModsRecords from a synthetic .xlsx file with xlrd (which
+    loads the whole workbook) vs. streaming it with an XlsxReader.'''
+    path = os.path.join(tmp_dir, 'synthetic-%d.xlsx' % num_rows)
+    #write the file in a child process too, so the readers don't inherit the
+    #   memory used for the rows
+    child = multiprocessing.Process(target=_write_synthetic_xlsx, args=(path, num_rows))
+    child.start()
+    child.join()
+    print('DataHandler.get_mods_records, %d row .xlsx file (%.1f MB)' %
+          (num_rows, os.path.getsize(path) / 1024.0 / 1024))
+    print('%12s %10s %10s %12s' % ('', 'seconds', 'rows/sec', 'peak RSS MB'))
+    for streaming in (False, True):
+        queue = multiprocessing.Queue()
+        child = multiprocessing.Process(target=_read_xlsx_records, args=(path, streaming, queue))
+        child.start()
+        elapsed, peak_rss, count = queue.get()
+        child.join()
+        assert count == num_rows
+        print('%12s %10.2f %10.0f %12.1f' % ('streaming' if streaming else 'xlrd', elapsed,
+                                             num_rows / elapsed, peak_rss / 1024.0))
+
+
+#sample (location, data) for each element type Mapper.add_data handles
+ADD_DATA_SAMPLES = [
+    (u'<mods:titleInfo><mods:title>#<mods:partName>#<mods:partNumber>', u'Title#part \\#1#1'),
+    (u'<mods:name type="personal"><mods:namePart>#<mods:role><mods:roleTerm type="text">', u'Smith, J.#creator || Jones, T.'),
+    (u'<mods:identifier type="local" displayLabel="PN_DB_id">', u'321'),
+    (u'<mods:genre authority="aat">', u'Programming Tests'),
+    (u'<mods:originInfo><mods:dateCreated encoding="w3cdtf" keyDate="yes">', u'2010-01-31'),
+    (u'<mods:physicalDescription><mods:extent>#<mods:digitalOrigin>', u'1 video file#reformatted digital'),
+    (u'<mods:abstract>', u'An abstract.'),
+    (u'<mods:note displayLabel="note label">', u'Note 1 || Note 2'),
+    (u'<mods:subject><mods:topic>', u'Topic 1 || Topic 2'),
+    (u'<mods:language><mods:languageTerm authority="iso639-2b" type="code">', u'eng'),
+    (u'<mods:relatedItem type="related item" displayLabel="display"><mods:titleInfo><mods:title>', u'Related'),
+]
+
+
+def bench_add_data(tmp_dir, num_rows=2000):
+    '''Mapper.add_data calls/sec for each element type.'''
+    print('Mapper.add_data, %d calls per element (new Mapper every 20 calls)' % num_rows)
+    print('%-28s %14s' % ('element', 'calls/sec'))
+    for mods_loc, data in ADD_DATA_SAMPLES:
+        elapsed = 0.0
+        for i in xrange(num_rows // 20):
+            mapper = Mapper()
+            start = time.time()
+            for j in xrange(20):
+                mapper.add_data(mods_loc, data)
+            elapsed += time.time() - start
+        element = mods_loc[1:].split(u'>')[0].split(u' ')[0]
+        print('%-28s %14.0f' % (element, num_rows // 20 * 20 / elapsed))
+
+
+def _find_loop_data_divs(data):
+    '''The old Mapper._get_data_divs loop (for comparison), which re-slices
+    the string for each escaped '#'.'''
+    data_divs = []
+    while data:
+        ind = data.find(u'#')
+        if ind == -1:
+            data_divs.append(data)
+            data = ''
+        else:
+            while ind != -1 and data[ind-1] == u'\\':
+                data = data[:ind-1] + data[ind:]
+                ind = data.find(u'#', ind)
+            if ind == -1:
+                data_divs.append(data)
+                data = u''
+            else:
+                data_divs.append(data[:ind])
+                data = data[ind+1:]
+    return data_divs
+
+
+def bench_data_divs(tmp_dir, num_rows=200):
+    '''Splitting long sectioned notes (|| values, # sections & \\# escapes):
+    the old find/slice loop vs. split_sectioned_data.'''
+    print('Splitting sectioned data, %d cells of each size' % num_rows)
+    print('%12s %12s %14s %14s' % ('chars', 'escapes', 'old usec', 'new usec'))
+    for num_escapes in (1, 10, 100, 1000):
+        value = u' '.join([u'Note text with an escaped \\# hash.'] * num_escapes)
+        data = u' || '.join([value + u'#display label#' + value] * 3)
+        old = lambda: [_find_loop_data_divs(v.strip()) for v in data.split(u'||') if v.strip()]
+        new = lambda: generate_mods.split_sectioned_data(data)
+        assert old() == new()
+        old_elapsed = min(_time(lambda: [old() for i in xrange(num_rows)])[0] for j in range(3))
+        new_elapsed = min(_time(lambda: [new() for i in xrange(num_rows)])[0] for j in range(3))
+        print('%12d %12d %14.1f %14.1f' % (len(data), num_escapes * 6, old_elapsed / num_rows * 1000000,
+                                           new_elapsed / num_rows * 1000000))
+
+
+def bench_engine(tmp_dir, num_rows=2000):
+    '''Mapping & serializing the synthetic end-to-end records with the
+    eulxml objects (Mapper) vs. straight into lxml (DirectMapper).'''
+    path = os.path.join(tmp_dir, 'engine.csv')
+    write_synthetic_csv(path, synthetic_rows(num_rows))
+    records = DataHandler(path).get_mods_records()
+    assert DirectMapper.supports(field['mods_path'] for field in records[0].field_data())
+    print('Map & serialize %d synthetic records (%d mapped columns)' % (num_rows, len(records[0].field_data())))
+    print('%12s %14s %14s' % ('engine', 'seconds', 'records/sec'))
+    build = {
+        'eulxml': lambda record: generate_mods.build_mods_data(record),
+        'lxml': lambda record: generate_mods.build_mods_direct(record).serialize(),
+    }
+    output = {}
+    for engine in ('eulxml', 'lxml'):
+        gc.collect()
+        elapsed, output[engine] = min(_time(lambda: [build[engine](r) for r in records]) for i in range(3))
+        print('%12s %14.2f %14.0f' % (engine, elapsed, num_rows / elapsed))
+    assert output['eulxml'] == output['lxml']
+
+
+def _deep_sizeof(obj, seen):
+    '''Bytes used by obj & everything it refers to that isn't in seen yet
+    (so objects shared between records are only counted once).'''
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(_deep_sizeof(key, seen) + _deep_sizeof(value, seen) for key, value in obj.items())
+    elif isinstance(obj, (list, tuple)):
+        size += sum(_deep_sizeof(item, seen) for item in obj)
+    elif not isinstance(obj, basestring):
+        if hasattr(obj, '__dict__'):
+            size += _deep_sizeof(obj.__dict__, seen)
+        for name in getattr(type(obj), '__slots__', ()):
+            size += _deep_sizeof(getattr(obj, name), seen)
+    return size
+
+
+class _DictModsRecord(object):
+    '''The old ModsRecord: a __dict__, & a {'mods_path': ..., 'data': ...}
+    dict for each field.'''
+
+    def __init__(self, id, mods_id, field_data, data_files):
+        self.id = id
+        self.mods_id = mods_id
+        self.parent_mods_filename = u'%s.mods' % id
+        self.mods_filename = u'%s.mods' % mods_id
+        self._field_data = field_data
+        self.data_files = data_files
+
+
+def _dict_mods_records(dh):
+    '''Build _DictModsRecords from the same rows & ids as dh.get_mods_records.'''
+    plan = dh._get_mapping_plan()
+    records = []
+    for data_row, record in zip(dh._get_data_rows(), dh.get_mods_records()):
+        field_data = [{'mods_path': mods_path, 'data': data_row[i]} for i, mods_path in plan.mapped_cols
+                      if i < len(data_row) and len(data_row[i]) > 0]
+        records.append(_DictModsRecord(record.id, record.mods_id, field_data, record.data_files))
+    return records
+
+
+def bench_record_memory(tmp_dir, num_rows=10000, widths=(0, 200)):
+    '''Bytes per ModsRecord (with its field data), for the synthetic
+    end-to-end columns, with & without extra mapped columns - the old
+    dict-based records vs. the slot-based ones with shared paths &
+    interned values.'''
+    print('ModsRecord memory, %d synthetic rows' % num_rows)
+    print('%12s %16s %16s %14s' % ('extra cols', 'old bytes/rec', 'new bytes/rec', 'old/new'))
+    for width in widths:
+        rows = synthetic_rows(num_rows)
+        #extra mapped columns, mostly repeated values
+        rows[0].extend((xlrd.XL_CELL_TEXT, u'Extra %d' % c) for c in range(width))
+        rows[1].extend((xlrd.XL_CELL_TEXT, u'<mods:note type="extra %d">' % c) for c in range(width))
+        for i, row in enumerate(rows[2:]):
+            row.extend((xlrd.XL_CELL_TEXT, u'value %d' % ((i + c) % 10)) for c in range(width))
+        path = os.path.join(tmp_dir, 'memory-%d.csv' % width)
+        write_synthetic_csv(path, rows)
+        dh = DataHandler(path)
+        old = _deep_sizeof(_dict_mods_records(dh), set()) / float(num_rows)
+        new = _deep_sizeof(dh.get_mods_records(), set()) / float(num_rows)
+        print('%12d %16.0f %16.0f %14.1f' % (width, old, new, old / new))
+
+
+#benchmarks that can be saved & compared (end-to-end) return a dict of
+#   dataset name -> measurements, including rows_per_sec & peak_rss_kb
+BENCHMARKS = {
+    'add-data': bench_add_data,
+    'batch': bench_batch,
+    'csv-throughput': bench_csv_throughput,
+    'control-row-width': bench_control_row_width,
+    'data-divs': bench_data_divs,
+    'end-to-end': bench_end_to_end,
+    'engine': bench_engine,
+    'record-memory': bench_record_memory,
+    'xlrd-columnar': bench_xlrd_columnar,
+    'xlsx-streaming': bench_xlsx_streaming,
+}
+
+
+if __name__ == '__main__':
+    parser = OptionParser(usage='%prog [options] [benchmark ...]')
+    parser.add_option('-n', '--rows',
+                    action='store', dest='rows', type='int', default=None,
+                    help='number of data rows to generate')
+    parser.add_option('-l', '--list',
+                    action='store_true', dest='list', default=False,
+                    help='list the available benchmarks')
+    parser.add_option('-w', '--workers',
+                    action='store', dest='workers', type='int', default=None,
+                    help='number of processes for the end-to-end benchmark (default is 1)')
+    parser.add_option('--save',
+                    action='store', dest='save', default=None,
+                    help='add the results to this JSON file, to compare with later runs')
+    parser.add_option('--compare',
+                    action='store', dest='compare', default=None,
+                    help='compare the results with the last run saved in this JSON file')
+    (options, args) = parser.parse_args()
+    if options.list:
+        for name in sorted(BENCHMARKS):
+            print(name)
+        sys.exit()
+    names = args or sorted(BENCHMARKS)
+    tmp_dir = tempfile.mkdtemp(prefix='mods_bench')
+    results = OrderedDict()
+    try:
+        for name in names:
+            kwargs = {}
+            if options.rows:
+                kwargs['num_rows'] = options.rows
+            if options.workers and name == 'end-to-end':
+                kwargs['workers'] = options.workers
+            bench_results = BENCHMARKS[name](tmp_dir, **kwargs)
+            if bench_results:
+                for result_name, result in bench_results.items():
+                    results['%s:%s' % (name, result_name)] = result
+            print('')
+    finally:
+        shutil.rmtree(tmp_dir)
+    if options.compare and os.path.exists(options.compare):
+        compare_results(options.compare, results)
+    if options.save:
+        save_results(options.save, results)
+    sys.exit()
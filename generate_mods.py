@@ -5,7 +5,9 @@ in the mods_files directory, logging the output to dataset_mods.log.
 Run './generate_mods.py --help' to see various options.
 
 Notes: 
-1. Requirements: xlrd, lxml, and bdrxml.
+1. Requirements: xlrd, lxml, and bdrxml. The MODS schema (mods-3-4.xsd) and
+    the schemas it imports (xlink.xsd & xml.xsd) should be in the same
+    directory as this script, for the --validate option.
 2. The spreadsheet can be any version of Excel, or a CSV file.
 3. The first row of the dataset is for headers, the second row is for
     MODS mapping tags, and the rest of the rows are for the data.
@@ -27,9 +29,23 @@ import string
 import logging
 import logging.handlers
 import datetime
+import glob
 import os
 import codecs
+import copy
+import hashlib
+import json
+import math
 import re
+import time
+import multiprocessing
+import cProfile
+import threading
+import tarfile
+import zipfile
+import Queue
+from collections import namedtuple, OrderedDict
+from itertools import islice, izip
 from optparse import OptionParser
 
 from lxml import etree
@@ -37,6 +53,8 @@ import xlrd
 from eulxml.xmlmap import load_xmlobject_from_file
 from bdrxml import mods
 
+from validate import ModsValidator
+
 #set up logging to console & log file
 LOG_FILENAME = 'dataset_mods.log'
 logger = logging.getLogger('simple')
@@ -54,21 +72,509 @@ logger.addHandler(consoleHandler)
 
 #directory for mods files
 MODS_DIR = "mods_files"
+#number of records handed to a worker process at a time
+WORKER_CHUNKSIZE = 16
+#seconds between progress lines in the log
+PROGRESS_INTERVAL = 10.0
+#number of rows between checks for the columns with mostly unique values,
+#   which stop being interned (see DataHandler._generate_mods_records)
+INTERN_SAMPLE_ROWS = 1000
+#most values kept for interning a column - past that, it stops being interned
+INTERN_MAX_VALUES = 10000
+#part of each record's hash in the incremental manifest - bump it when a
+#   code change changes the MODS output, so everything gets regenerated
+OUTPUT_VERSION = 1
+
+
+class QueueHandler(logging.Handler):
+    '''Put log records on a queue, for another thread to handle (like
+    Python 3's logging.handlers.QueueHandler).'''
+
+    def __init__(self, queue):
+        logging.Handler.__init__(self)
+        self.queue = queue
+
+    def emit(self, record):
+        try:
+            #format the message now, in case the arguments change later
+            record.msg = record.getMessage()
+            record.args = None
+            if record.exc_info:
+                record.exc_text = logging.Formatter().formatException(record.exc_info)
+                record.exc_info = None
+            self.queue.put_nowait(record)
+        except Exception:
+            self.handleError(record)
+
+
+class AsyncLogSink(object):
+    '''Hand a logger's records to its handlers in a background thread, so
+    writing the log file & console doesn't hold up the processing.
+
+    start() replaces the logger's handlers with a QueueHandler, & stop()
+    handles whatever is left on the queue and puts the handlers back.'''
+
+    def __init__(self, logger):
+        self.logger = logger
+        self.handlers = list(logger.handlers)
+        self.queue = Queue.Queue()
+        self.queue_handler = QueueHandler(self.queue)
+        self._thread = None
+
+    def start(self):
+        for handler in self.handlers:
+            self.logger.removeHandler(handler)
+        self.logger.addHandler(self.queue_handler)
+        self._thread = threading.Thread(target=self._handle_records, name='AsyncLogSink')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is not None:
+            self.queue.put(None)
+            self._thread.join()
+            self._thread = None
+        self.detach()
+
+    def detach(self):
+        '''Put the logger's own handlers back (eg. in a forked worker process,
+        which doesn't have the background thread).'''
+        self.logger.removeHandler(self.queue_handler)
+        for handler in self.handlers:
+            if handler not in self.logger.handlers:
+                self.logger.addHandler(handler)
+
+    def _handle_records(self):
+        while True:
+            record = self.queue.get()
+            if record is None:
+                return
+            for handler in self.handlers:
+                if record.levelno >= handler.level:
+                    handler.handle(record)
+
+
+#set when logging is asynchronous (see --async-log)
+async_log_sink = None
 
 
 class ModsRecord(object):
+    '''The data for one record (a data row).
 
-    def __init__(self, id, mods_id, field_data, data_files):
+    There can be lots of these in memory, so the fields are kept as
+    (column index, data) tuples, with the MODS paths in a table (column
+    index -> MODS path) that all the records from a sheet share. field_data
+    can be a list of {'mods_path': xxx, 'data': xxx} dicts, or (if paths is
+    passed in) a list of (column index, data) tuples.'''
+
+    __slots__ = ('id', 'mods_id', 'data_files', '_fields', '_paths')
+
+    def __init__(self, id, mods_id, field_data, data_files, paths=None):
         self.id = id #this is what ties parent records to children
         self.mods_id = mods_id #this object's mods id (from a column or calculated)
-        self.parent_mods_filename = u'%s.mods' % id
-        self.mods_filename = u'%s.mods' % mods_id
-        self._field_data = field_data
+        if paths is None:
+            paths = tuple(field['mods_path'] for field in field_data)
+            field_data = [(i, field['data']) for i, field in enumerate(field_data)]
+        self._fields = tuple(field_data)
+        self._paths = paths
         self.data_files = data_files
 
+    @property
+    def parent_mods_filename(self):
+        return u'%s.mods' % self.id
+
+    @property
+    def mods_filename(self):
+        return u'%s.mods' % self.mods_id
+
     def field_data(self):
         #return list of {'mods_path': xxx, 'data': xxx}
-        return self._field_data
+        paths = self._paths
+        return [{'mods_path': paths[i], 'data': data} for i, data in self._fields]
+
+    def fields(self):
+        '''List of (mods path, data) tuples - like field_data, without making a dict for each field.'''
+        paths = self._paths
+        return [(paths[i], data) for i, data in self._fields]
+
+    def __getstate__(self):
+        #just the paths this record uses, not the whole table (eg. for worker processes)
+        return (self.id, self.mods_id, self.fields(), self.data_files)
+
+    def __setstate__(self, state):
+        self.id, self.mods_id, fields, self.data_files = state
+        self._paths = tuple(mods_path for mods_path, data in fields)
+        self._fields = tuple((i, data) for i, (mods_path, data) in enumerate(fields))
+
+
+def group_records(records):
+    '''Group ModsRecords by id, in one pass over the records.
+
+    Returns a list of (id, records) tuples, in the order each id first
+    appears - the records for an id stay in row order, so for a parent
+    sheet the first one is the parent & the rest are its children.'''
+    groups = OrderedDict()
+    for record in records:
+        try:
+            groups[record.id].append(record)
+        except KeyError:
+            groups[record.id] = [record]
+    return groups.items()
+
+
+def attach_children(parents, child_groups):
+    '''Pair each parent record with its children (child_groups is from
+    group_records), so they can be built together.
+
+    Returns a list of (parent, children) tuples, in the parents' order - the
+    children whose parent isn't in parents come last, with a parent of None.'''
+    child_groups = OrderedDict(child_groups)
+    groups = [(parent, child_groups.pop(parent.id, [])) for parent in parents]
+    groups.extend((None, children) for children in child_groups.values())
+    return groups
+
+
+class WarningCounter(object):
+    '''Count repeated warnings by category, instead of logging every one.
+
+    The first log_first warnings in each category are logged as usual, the
+    rest are just counted. log_summary() logs how many there were in each
+    category, with a few samples.
+    Like the logger, warn takes the message format & its arguments
+    separately, so the message is only formatted if it's logged.'''
+
+    def __init__(self, log_first=5, num_samples=5):
+        self.log_first = log_first
+        self.num_samples = num_samples
+        #category -> count, & category -> list of samples
+        self.counts = OrderedDict()
+        self.samples = {}
+
+    def warn(self, category, message, sample, *args):
+        count = self.counts.get(category, 0) + 1
+        self.counts[category] = count
+        if count <= self.log_first:
+            logger.warning(message, *args)
+        samples = self.samples.setdefault(category, [])
+        if len(samples) < self.num_samples and sample not in samples:
+            samples.append(sample)
+
+    def log_summary(self):
+        for category, count in self.counts.items():
+            logger.warning('%s %s (e.g. %s).', '{:,}'.format(count), category,
+                           u', '.join(u'%s' % sample for sample in self.samples[category]))
+
+    def clear(self):
+        self.counts.clear()
+        self.samples.clear()
+
+
+#warnings about the data (ambiguous dates, ...) are counted here
+warning_counter = WarningCounter()
+
+
+class LRUCache(object):
+    '''Bounded cache that drops the least recently used item when it's full.
+
+    load(key) is called to create the item for a key that isn't in the
+    cache yet.'''
+
+    def __init__(self, load, maxsize):
+        self._load = load
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._cache = OrderedDict()
+
+    def __len__(self):
+        return len(self._cache)
+
+    def __contains__(self, key):
+        return key in self._cache
+
+    def get(self, key):
+        '''Return the item for key, loading it if needed.'''
+        try:
+            item = self._cache.pop(key)
+            self.hits += 1
+        except KeyError:
+            self.misses += 1
+            item = self._load(key)
+            if len(self._cache) >= self.maxsize:
+                #drop the least recently used item
+                self._cache.popitem(last=False)
+        #(re-)insert at the end, so it's the most recently used
+        self._cache[key] = item
+        return item
+
+    def clear(self):
+        self._cache.clear()
+        self.hits = 0
+        self.misses = 0
+
+
+class MappingPlan(object):
+    '''Column mapping information for one sheet.
+
+    Built once from the first row & the control row, and then reused for
+    every data row, so we don't rescan the control row for each record.
+    Column indexes are 0-based.
+    '''
+
+    ID_NAMES = [u'id', u'tracker item id', u'tracker id', u'record name', u'file id']
+    MODS_ID_NAMES = [u'mods id', u'<mods:mods id="">']
+    FILENAME_NAMES = [u'file name', u'filename', u'file_id']
+
+    def __init__(self, first_row, control_row):
+        self._first_row = first_row
+        self._control_row = control_row
+        #column that ties parent records to children
+        self.id_col = self._get_col_from_id_names(self.ID_NAMES)
+        self.mods_id_col = self._get_col_from_id_names(self.MODS_ID_NAMES)
+        self.filename_col = self._get_col_from_id_names(self.FILENAME_NAMES)
+        #dict of column index -> MODS path for the columns we should map
+        #   (we'll assume it's to be mapped if we see the start of a MODS tag)
+        self.cols_to_map = {}
+        for i, val in enumerate(control_row):
+            if val.startswith(u'<mods'):
+                self.cols_to_map[i] = val
+        #same info as a sorted list of (index, MODS path), for iterating rows
+        self.mapped_cols = sorted(self.cols_to_map.items())
+        #& as a table of column index -> MODS path (or None), for ModsRecords
+        self.paths = tuple(self.cols_to_map.get(i) for i in range(len(control_row)))
+        #columns that could have text dates in them
+        self.date_cols = [i for i, val in enumerate(control_row) if u'date' in val]
+
+    def _get_col_from_id_names(self, id_names):
+        #try control row first, then the first row
+        for row in (self._control_row, self._first_row):
+            for i, val in enumerate(row):
+                if val.lower() in id_names:
+                    return i
+        #return None if we didn't find anything
+        return None
+
+
+#spreadsheetml & relationship namespaces, for reading .xlsx files ourselves
+SSML_NAMESPACE = 'http://schemas.openxmlformats.org/spreadsheetml/2006/main'
+RELS_NAMESPACE = 'http://schemas.openxmlformats.org/package/2006/relationships'
+OFFICE_RELS_NAMESPACE = 'http://schemas.openxmlformats.org/officeDocument/2006/relationships'
+XML_SPACE_ATTR = '{http://www.w3.org/XML/1998/namespace}space'
+#Excel escapes some characters in text as _xHHHH_
+XLSX_ESCAPE_RE = re.compile(r'_x([0-9A-Fa-f]{4})_')
+#number formats that xlrd treats as dates in .xlsx files (the custom formats
+#   are checked with xlrd's is_date_format_string)
+XLSX_DATE_FORMATS = frozenset(range(14, 23) + range(45, 48))
+XLSX_ERROR_CODES = dict((text, code) for code, text in xlrd.error_text_from_code.items())
+#is_date_format_string only needs a book for its logging settings
+_XLRD_QUIET_BOOK = namedtuple('XlrdBook', 'verbosity logfile')(0, sys.stderr)
+
+
+def _ssml(tag):
+    return '{%s}%s' % (SSML_NAMESPACE, tag)
+
+
+def _xlsx_text(elem):
+    '''Get the unicode text of a <t> or <v> element, the way xlrd does.'''
+    text = elem.text
+    if text is None:
+        return u''
+    if elem.get(XML_SPACE_ATTR) != 'preserve':
+        text = text.strip('\t\n\r ')
+    if '_' in text:
+        text = XLSX_ESCAPE_RE.sub(lambda m: unichr(int(m.group(1), 16)), text)
+    #lxml gives us str objects for ascii text
+    return unicode(text)
+
+
+def _xlsx_string(elem, t_tag=_ssml('t'), r_tag=_ssml('r')):
+    '''Get the text of a shared string (<si>) or inline string (<is>) - the
+    text of the <t> elements, including the ones in rich text runs.'''
+    parts = []
+    for child in elem:
+        if child.tag == t_tag:
+            parts.append(_xlsx_text(child))
+        elif child.tag == r_tag:
+            parts.extend(_xlsx_text(t) for t in child if t.tag == t_tag)
+    return u''.join(parts)
+
+
+def _xlsx_col_index(cell_name):
+    '''Get the 0-based column index from a cell name like "AB12".'''
+    col = 0
+    for c in cell_name:
+        if c.isdigit():
+            break
+        if c != '$':
+            col = col * 26 + ord(c.upper()) - 64
+    return col - 1
+
+
+def _iter_clearing(source, tag):
+    '''iterparse source for tag elements, clearing each one (& dropping it
+    from its parent) after it's been used, so the tree doesn't grow.'''
+    for event, elem in etree.iterparse(source, tag=tag, huge_tree=True):
+        yield elem
+        elem.clear()
+        while elem.getprevious() is not None:
+            del elem.getparent()[0]
+
+
+class XlsxReader(object):
+    '''Read the rows of one sheet of an .xlsx file, without loading the whole
+    workbook like xlrd does.
+
+    The shared strings table & the sheet are iterparsed straight from the
+    zip file, so memory is bounded by the shared strings, not the number of
+    rows. Rows are lists of unicode values, with numbers & dates converted
+    the same way as the xlrd rows (see _convert_xlrd_cell).
+    zip_file can be the open zipfile.ZipFile for filename, to share it
+    between the readers for several sheets - it's left open. Otherwise the
+    file is closed once the rows have been read (or by close).
+    '''
+
+    def __init__(self, filename, sheet=1, zip_file=None):
+        self._owns_zip = zip_file is None
+        if zip_file is None:
+            zip_file = zipfile.ZipFile(filename)
+        self._zip = zip_file
+        try:
+            workbook = etree.fromstring(self._zip.read('xl/workbook.xml'))
+            targets = self._read_rels('xl/_rels/workbook.xml.rels')
+            sheets = workbook.findall('%s/%s' % (_ssml('sheets'), _ssml('sheet')))
+            sheet_elem = sheets[int(sheet)-1]
+            self.name = sheet_elem.get('name')
+            self._sheet_path = targets[sheet_elem.get('{%s}id' % OFFICE_RELS_NAMESPACE)][1]
+            workbook_pr = workbook.find(_ssml('workbookPr'))
+            self.datemode = 0
+            if workbook_pr is not None and workbook_pr.get('date1904') in ('1', 'true'):
+                self.datemode = 1
+            paths = dict((rel_type.rsplit('/', 1)[-1], path) for rel_type, path in targets.values())
+            self._xf_types = self._read_styles(paths.get('styles'))
+            self._shared_strings = self._read_shared_strings(paths.get('sharedStrings'))
+        except:
+            self.close()
+            raise
+
+    def close(self):
+        '''Close the zip file, unless it was passed in.'''
+        if self._owns_zip:
+            self._zip.close()
+
+    def _read_rels(self, path):
+        '''Get a dict of relationship id -> (type, path in the zip file).'''
+        targets = {}
+        for rel in etree.fromstring(self._zip.read(path)).iter('{%s}Relationship' % RELS_NAMESPACE):
+            target = rel.get('Target')
+            if target.startswith('/'):
+                target = target[1:]
+            else:
+                target = 'xl/' + target
+            targets[rel.get('Id')] = (rel.get('Type'), target)
+        return targets
+
+    def _read_styles(self, path):
+        '''Get a list of the xlrd cell type (number or date) for each cell
+        style.'''
+        if path is None:
+            return []
+        styles = etree.fromstring(self._zip.read(path))
+        date_formats = set(XLSX_DATE_FORMATS)
+        for num_fmt in styles.iter(_ssml('numFmt')):
+            fmt_id = int(num_fmt.get('numFmtId'))
+            date_formats.discard(fmt_id)
+            if xlrd.formatting.is_date_format_string(_XLRD_QUIET_BOOK, unicode(num_fmt.get('formatCode'))):
+                date_formats.add(fmt_id)
+        cell_xfs = styles.find(_ssml('cellXfs'))
+        if cell_xfs is None:
+            return []
+        return [xlrd.XL_CELL_DATE if int(xf.get('numFmtId', '0')) in date_formats else xlrd.XL_CELL_NUMBER
+                for xf in cell_xfs.iter(_ssml('xf'))]
+
+    def _read_shared_strings(self, path):
+        if path is None:
+            return []
+        source = self._zip.open(path)
+        try:
+            return [_xlsx_string(si) for si in _iter_clearing(source, _ssml('si'))]
+        finally:
+            source.close()
+
+    def _cell_value(self, cell, v_tag=_ssml('v'), is_tag=_ssml('is')):
+        '''Get the unicode value of a <c> element (None if it has no value).'''
+        cell_type = cell.get('t', 'n')
+        value = None
+        for child in cell:
+            if child.tag == v_tag:
+                value = child.text
+            elif child.tag == is_tag:
+                value = _xlsx_string(child)
+        if cell_type == 'n':
+            if not value:
+                return None
+            style = int(cell.get('s', '0'))
+            xf_types = self._xf_types
+            xl_type = xf_types[style] if style < len(xf_types) else xlrd.XL_CELL_NUMBER
+            value = _convert_xlrd_cell(float(value), xl_type, self.datemode)
+            return value if isinstance(value, unicode) else unicode(value)
+        if cell_type == 's':
+            if not value:
+                return None
+            return self._shared_strings[int(value)]
+        if cell_type == 'str':
+            v = cell.find(v_tag)
+            return u'' if v is None else _xlsx_text(v)
+        if cell_type == 'b':
+            return u'1' if value in ('1', 'true') else u'0'
+        if cell_type == 'e':
+            return unicode(XLSX_ERROR_CODES.get(value or '#N/A', value))
+        if cell_type == 'inlineStr':
+            return unicode(value) if value else None
+        raise Exception('unknown cell type %r in cell %s' % (cell_type, cell.get('r')))
+
+    def iter_rows(self):
+        '''Generate the rows of the sheet, like xlrd's row_values: empty rows
+        in between rows with values are included, & rows are padded with
+        empty strings (to the sheet's dimension, or the widest row so far).'''
+        row_tag = _ssml('row')
+        dimension_tag = _ssml('dimension')
+        width = 0
+        rowx = -1
+        next_rowx = 0
+        source = self._zip.open(self._sheet_path)
+        try:
+            for elem in _iter_clearing(source, (dimension_tag, row_tag)):
+                if elem.tag == dimension_tag:
+                    ref = elem.get('ref', '')
+                    width = _xlsx_col_index(ref.split(':')[-1]) + 1
+                    continue
+                row_number = elem.get('r')
+                rowx = int(row_number) - 1 if row_number else rowx + 1
+                row = []
+                colx = -1
+                for cell in elem:
+                    cell_name = cell.get('r')
+                    colx = _xlsx_col_index(cell_name) if cell_name else colx + 1
+                    value = self._cell_value(cell)
+                    if value is None:
+                        continue
+                    if colx >= len(row):
+                        row.extend([u''] * (colx + 1 - len(row)))
+                    row[colx] = value
+                #rows without any values don't count (unless there's a row
+                #   with values after them)
+                if not row:
+                    continue
+                width = max(width, len(row))
+                while next_rowx < rowx:
+                    yield [u''] * width
+                    next_rowx += 1
+                row.extend([u''] * (width - len(row)))
+                yield row
+                next_rowx = rowx + 1
+        finally:
+            source.close()
+            self.close()
 
 
 class DataHandler(object):
@@ -79,74 +585,205 @@ class DataHandler(object):
     which is what xlrd uses, and we convert all CSV data to unicode objects
     as well.
     '''
-    def __init__(self, filename, inputEncoding='utf-8', sheet=1, ctrlRow=2, forceDates=False, obj_type='parent'):
+    def __init__(self, filename, inputEncoding='utf-8', sheet=1, ctrlRow=2, forceDates=False, obj_type='parent',
+                 streaming=False, columnar=False, book=None):
         '''Open file and get data from correct sheet.
         
         First, try opening the file as an excel spreadsheet.
         If that fails, try opening it as a CSV file.
         Exit with error if CSV doesn't work.
+
+        If streaming is True, get_mods_records returns a generator instead of
+        a list, and CSV data rows are read from the file as they're needed
+        (only the rows up to the control row are read up front). .xlsx files
+        are read the same way, with an XlsxReader instead of xlrd.
+        If columnar is True, Excel sheets are read & converted a column at a
+        time, instead of a row at a time (the converted columns are kept as
+        well as xlrd's copy of the sheet, so it's off by default).
+        book can be the open workbook for filename - the xlrd Book, or the
+        zipfile.ZipFile of an .xlsx file we're streaming - to share it with
+        another sheet (see process_batch). Otherwise the workbook is opened
+        here (xlrd with on_demand, so only the sheet we need is loaded for
+        .xls files), & close releases it.
         '''
         self.obj_type = obj_type
         #set the date override value
         self.forceDates = forceDates
         self.inputEncoding = inputEncoding
+        self.streaming = streaming
         self._ctrlRow = ctrlRow
+        self._mapping_plan = None
+        #xlrd data is loaded a column at a time if columnar is True
+        self.columnar = columnar
+        self._xlrd_columns = None
+        #CSV file & reader for the remaining data rows, if we're streaming
+        self._csvFile = None
+        self._csvReader = None
+        #encoding of the cells the CSV reader gives us
+        self._csvEncoding = None
+        #remaining rows of an .xlsx sheet, if we're streaming
+        self._xlsxRows = None
+        self.book = None
+        #whether close should release the workbook (we opened it)
+        self._owns_book = book is None
+        if self.streaming and self._open_xlsx(filename, sheet, book):
+            return
         #open file
         try:
-            self.book = xlrd.open_workbook(filename)
+            if book is None:
+                book = xlrd.open_workbook(filename, on_demand=True)
+            self.book = book
             self.dataset = self.book.sheet_by_index(int(sheet)-1)
             self.dataType = 'xlrd'
-            logger.debug('Got "%s" dataset.' % self.dataset.name)
+            logger.debug('Got "%s" dataset.', self.dataset.name)
         except xlrd.XLRDError as xerr:
-            logger.debug('Failed xlrd open: %s.' % repr(xerr))
+            logger.debug('Failed xlrd open: %r.', xerr)
             #now try using csv
+            csvFile = None
             try:
-                #need to open the file with whatever encoding it's in
-                logger.debug('opening file with ' + self.inputEncoding + ' encoding.')
-                csvFile = codecs.open(filename, 'r', self.inputEncoding)
+                #a byte order mark overrides the input encoding
+                with open(filename, 'rb') as f:
+                    encoding, bomLength = detect_bom(f.read(4), self.inputEncoding)
+                logger.debug('opening file with %s encoding.', encoding)
+                self._csvEncoding = csv_cell_encoding(encoding)
+                if self._csvEncoding:
+                    #the CSV module can parse the bytes as they are, so each
+                    #   cell just has to be decoded once
+                    csvFile = open(filename, 'rb')
+                    start = bomLength
+                    csvLines = csvFile
+                else:
+                    #CSV module doesn't handle unicode (or encodings like
+                    #   UTF-16) correctly, so temporarily encode data as
+                    #   UTF-8, which it can handle. (newline='' leaves the
+                    #   line endings for the CSV module.)
+                    csvFile = io.open(filename, 'r', encoding=encoding, newline='')
+                    start = 0
+                    csvLines = self._utf_8_encoder(csvFile)
+                    self._csvEncoding = 'utf-8'
+                csvFile.seek(start)
                 #read some test data to pass to sniffer for checking the dialect
-                data = csvFile.read(4096) #data is unicode object
-                csvFile.seek(0)
-                #Sniffer needs data encoded in ascii (just drop non-ascii characters for now)
-                dataAscii = data.encode('ascii', 'ignore')
+                data = csvFile.read(4096)
+                csvFile.seek(start)
+                #Sniffer needs data in ascii (just drop non-ascii characters for now)
+                if isinstance(data, unicode):
+                    dataAscii = data.encode('ascii', 'ignore')
+                else:
+                    dataAscii = data.decode('ascii', 'ignore').encode('ascii')
                 dialect = csv.Sniffer().sniff(dataAscii)
                 #set doublequote to true because that's the default and the Sniffer doesn't
                 #   seem to pick it up right
                 dialect.doublequote = True
                 self.dataType = 'csv'
-                #CSV module doesn't handle unicode correctly, so temporarily
-                #   encode data as UTF-8, which it can handle.
-                csvReader = csv.reader(self._utf_8_encoder(csvFile), dialect)
+                csvReader = csv.reader(csvLines, dialect)
                 #self.csvData is a list of lists of the row data
+                #   (when streaming, just the rows up to the control row)
                 self.csvData = []
                 for row in csvReader:
                     if len(row) > 0:
-                        #convert all the data back to unicode since we're done w/ CSV module
-                        row = [unicode(cell, 'utf-8') for cell in row]
+                        #convert the data to unicode since we're done w/ CSV module
+                        row = self._decode_csv_row(row)
                         self.csvData.append(row)
-                logger.debug('Got CSV data')
-                csvFile.close()
+                        if self.streaming and len(self.csvData) >= self._ctrlRow:
+                            break
+                if self.streaming:
+                    self._csvFile = csvFile
+                    self._csvReader = csvReader
+                    logger.debug('Streaming CSV data')
+                else:
+                    logger.debug('Got CSV data')
+                    csvFile.close()
             except Exception as e:
                 logger.error(str(e))
                 logger.error('Could not recognize file format. Exiting.')
-                csvFile.close()
+                if csvFile is not None:
+                    csvFile.close()
                 sys.exit(1)
 
+    def _open_xlsx(self, filename, sheet, zip_file=None):
+        '''Try to open the file as an .xlsx file, with an XlsxReader (sharing
+        zip_file, if it's the open zip file). Only the rows up to the control
+        row are read now. Returns True if it worked.'''
+        if zip_file is None:
+            if not zipfile.is_zipfile(filename):
+                return False
+            zip_file = zipfile.ZipFile(filename)
+        elif not isinstance(zip_file, zipfile.ZipFile):
+            return False
+        try:
+            reader = XlsxReader(filename, sheet, zip_file)
+        except (KeyError, etree.XMLSyntaxError) as e:
+            logger.debug('Failed xlsx open: %r.', e)
+            if self._owns_book:
+                zip_file.close()
+            return False
+        self.book = zip_file
+        self.dataType = 'xlsx'
+        rows = reader.iter_rows()
+        self.xlsxData = list(islice(rows, self._ctrlRow))
+        self._xlsxRows = rows
+        logger.debug('Streaming "%s" dataset.', reader.name)
+        return True
+
+    def close(self):
+        '''Close the file we're streaming from, & release the workbook if
+        we opened it (the rows that were already loaded can still be used).'''
+        if self._csvFile is not None:
+            self._csvFile.close()
+        if self.book is not None and self._owns_book:
+            if isinstance(self.book, zipfile.ZipFile):
+                self.book.close()
+            else:
+                self.book.release_resources()
+
     def get_mods_records(self):
-        id_col = self._get_id_col()
-        if id_col is None:
+        '''Get the ModsRecords for all the data rows (a list, or a generator
+        if we're streaming).'''
+        plan = self._get_mapping_plan()
+        if plan.id_col is None:
             raise Exception('no ID column')
+        mods_records = self._generate_mods_records(plan)
+        if self.streaming:
+            return mods_records
+        return list(mods_records)
+
+    def get_record_groups(self):
+        '''Get the ModsRecords grouped by id (see group_records). All the
+        records are read, even if we're streaming.'''
+        return group_records(self.get_mods_records())
+
+    def _generate_mods_records(self, plan):
+        id_col = plan.id_col
         index = self._ctrlRow
-        mods_records = []
         mods_ids = {}
-        data_file_col = self._get_filename_col()
+        mods_id_col = plan.mods_id_col
+        data_file_col = plan.filename_col
+        paths = plan.paths
+        #(index, dict of the values seen so far) for each mapped column - the
+        #   records share one copy of each repeated value (intern() is just for str)
+        columns = [(i, {}) for i, mods_path in plan.mapped_cols]
+        #number of values in each column's dict at the last check
+        checked_sizes = [0] * len(columns)
+        num_rows = 0
         for data_row in self._get_data_rows():
             index += 1
+            num_rows += 1
+            if num_rows % INTERN_SAMPLE_ROWS == 0:
+                #stop interning the columns that got mostly new values since
+                #   the last check, or have too many values to keep (so the
+                #   dicts don't keep growing when we're streaming)
+                for c, (i, values) in enumerate(columns):
+                    if values is None:
+                        continue
+                    if (len(values) - checked_sizes[c] > INTERN_SAMPLE_ROWS // 2 or
+                            len(values) > INTERN_MAX_VALUES):
+                        columns[c] = (i, None)
+                    else:
+                        checked_sizes[c] = len(values)
             rec_id = data_row[id_col].strip()
             if not rec_id:
-                logger.warning('no id on row %s - skipping' % index)
+                warning_counter.warn('rows without an id', 'no id on row %s - skipping', index, index)
                 continue
-            mods_id_col = self._get_mods_id_col()
             if mods_id_col is not None:
                 mods_id = data_row[mods_id_col].strip()
             else:
@@ -160,121 +797,116 @@ class DataHandler(object):
                     else:
                         mods_id = u'%s_1' % rec_id
                         mods_ids[rec_id] = 2
-            field_data = []
-            cols_to_map = self.get_cols_to_map()
-            for i, val in enumerate(data_row):
-                if i in cols_to_map and len(val) > 0:
-                    field_data.append({'mods_path': cols_to_map[i], 'data': val})
+            fields = []
+            row_len = len(data_row)
+            for i, values in columns:
+                if i < row_len:
+                    value = data_row[i]
+                    if value:
+                        if values is not None:
+                            value = values.setdefault(value, value)
+                        fields.append((i, value))
             data_files = []
             if data_file_col is not None:
                 data_files = [df.strip() for df in data_row[data_file_col].split(u',')]
-            mods_records.append(ModsRecord(rec_id, mods_id, field_data, data_files))
-        return mods_records
+            yield ModsRecord(rec_id, mods_id, fields, data_files, paths)
 
     def _get_data_rows(self):
         '''data rows will be all the rows after the control row'''
+        if self._csvReader is not None:
+            for row in self._stream_csv_rows():
+                yield row
+            return
+        if self._xlsxRows is not None:
+            for row in self._stream_xlsx_rows():
+                yield row
+            return
         for i in xrange(self._ctrlRow+1, self._get_total_rows()+1): #xrange doesn't include the stop value
             yield self.get_row(i)
 
+    def _stream_csv_rows(self):
+        '''Read the remaining data rows from the CSV file, one at a time.'''
+        csvReader = self._csvReader
+        #the rows can only be read once
+        self._csvReader = None
+        try:
+            for row in csvReader:
+                if len(row) > 0:
+                    row = self._decode_csv_row(row)
+                    self._process_text_dates(row)
+                    yield row
+        finally:
+            self._csvFile.close()
+
+    def _stream_xlsx_rows(self):
+        '''Read the remaining data rows from the .xlsx sheet, one at a time.'''
+        rows = self._xlsxRows
+        #the rows can only be read once
+        self._xlsxRows = None
+        for row in rows:
+            self._process_text_dates(row)
+            yield row
+
     def _get_control_row(self):
         '''Retrieve the row that controls MODS mapping locations.'''
         return self.get_row(self._ctrlRow)
 
-    def _get_col_from_id_names(self, id_names):
-        #try control row first
-        for i, val in enumerate(self._get_control_row()):
-            if val.lower() in id_names:
-                return i
-        #try first row if needed
-        for i, val in enumerate(self.get_row(1)):
-            if val.lower() in id_names:
-                return i
-        #return None if we didn't find anything
-        return None
+    def _get_mapping_plan(self):
+        '''Build the MappingPlan for this sheet the first time it's needed.'''
+        if self._mapping_plan is None:
+            self._mapping_plan = MappingPlan(self.get_row(1), self._get_control_row())
+        return self._mapping_plan
 
     def _get_mods_id_col(self):
-        ID_NAMES = [u'mods id', '<mods:mods id="">']
-        return self._get_col_from_id_names(ID_NAMES)
+        return self._get_mapping_plan().mods_id_col
 
     def _get_id_col(self):
         '''Get index of column that contains id for tying children to parents'''
-        ID_NAMES = [u'id', u'tracker item id', u'tracker id', u'record name', u'file id']
-        return self._get_col_from_id_names(ID_NAMES)
+        return self._get_mapping_plan().id_col
 
     def _get_filename_col(self):
         '''Get index of column that contains data file name.'''
-        ID_NAMES = [u'file name', u'filename', u'file_id']
-        return self._get_col_from_id_names(ID_NAMES)
+        return self._get_mapping_plan().filename_col
 
     def get_cols_to_map(self):
         '''Get a dict of columns & values in dataset that should be mapped to MODS
         (some will just be ignored).
         '''
-        cols = {}
-        ctrl_row = self._get_control_row()
-        for i, val in enumerate(ctrl_row):
-            #we'll assume it's to be mapped if we see the start of a MODS tag
-            if val.startswith(u'<mods'):
-                cols[i] = val
-        return cols
+        return dict(self._get_mapping_plan().cols_to_map)
 
     def get_row(self, index):
         '''Retrieve a list of unicode values (index is 1-based like excel)'''
         #subtract 1 from index so that it's 0-based like xlrd and csvData list
         index = index - 1
+        #In a data column that's mapped to a date field, we could find a text
+        #   string that looks like a date - we might want to reformat
+        #   that as well. (The control row & rows above it are never dates.)
+        is_data_row = index > (self._ctrlRow-1)
+        if self.dataType == 'xlrd' and self.columnar:
+            row = [values[index] for values in self._get_xlrd_columns()]
+            if is_data_row:
+                self._process_text_dates(row)
+            #everything was already converted to unicode
+            return row
         if self.dataType == 'xlrd':
             row = self.dataset.row_values(index)
-            #In a data column that's mapped to a date field, we could find a text
-            #   string that looks like a date - we might want to reformat 
-            #   that as well.
-            if index > (self._ctrlRow-1):
-                for i, v in enumerate(self._get_control_row()):
-                    if 'date' in v:
-                        if isinstance(row[i], basestring):
-                            #we may have a text date, so see if we can understand it
-                            # *process_text_date will return a text value of the
-                            #   reformatted date if possible, else the original value
-                            row[i] = process_text_date(row[i], self.forceDates)
+            #get all the cell types at once, instead of asking for each cell
+            cell_types = None
             for i, v in enumerate(row):
                 if isinstance(v, float):
-                    #there are some interesting things that happen
-                    # with numbers in Excel. Eg. what looks like an int in Excel
-                    # is actually stored as a float (and xlrd handles as a float).
-                    #http://stackoverflow.com/questions/2739989/reading-numeric-excel-data-as-text-using-xlrd-in-python
-                    #if cell is XL_CELL_NUMBER
-                    if self.dataset.cell_type(index, i) == 2 and int(v) == v:
-                        #convert data into int & then unicode
-                        #Note: if a number was displayed as xxxx.0 in Excel, we
-                        #   would lose the .0 here
-                        row[i] = unicode(int(v))
-                    #Dates are also stored as floats in Excel, so we have to do
-                    #   some extra processing to get a datetime object
-                    #if we have an XL_CELL_DATE
-                    elif self.dataset.cell_type(index, i) == 3:
-                        #try to get an actual date out of it, instead of a float
-                        #Note: we are losing Excel formatting information here,
-                        #   and formatting the date as yyyy-mm-dd.
-                        tup = xlrd.xldate_as_tuple(v, self.book.datemode)
-                        d = datetime.datetime(*tup)
-                        if tup[0] == 0 and tup[1] == 0 and tup[2] == 0:
-                            #just time, no date
-                            row[i] = unicode('{0:%H:%M:%S}'.format(d))
-                        elif tup[3] == 0 and tup[4] == 0 and tup[5] == 0:
-                            #just date, no time
-                            row[i] = unicode('{0:%Y-%m-%d}'.format(d))
-                        else:
-                            #assume full date/time
-                            row[i] = unicode('{0:%Y-%m-%d %H:%M:%S}'.format(d))
+                    if cell_types is None:
+                        cell_types = self.dataset.row_types(index)
+                    row[i] = _convert_xlrd_cell(v, cell_types[i], self.book.datemode)
+            if is_data_row:
+                self._process_text_dates(row)
         elif self.dataType == 'csv':
             row = self.csvData[index]
-            if index > (self._ctrlRow-1):
-                for i, v in enumerate(self._get_control_row()):
-                    if 'date' in v:
-                        if isinstance(row[i], basestring):
-                            #we may have a text date, so see if we can understand it
-                            # *process_text_date will return a text value of the
-                            #   reformatted date if possible, else the original value
-                            row[i] = process_text_date(row[i], self.forceDates)
+            if is_data_row:
+                self._process_text_dates(row)
+            #each cell was decoded when it was read
+            return row
+        elif self.dataType == 'xlsx':
+            row = self.xlsxData[index]
         #this final loop should be unnecessary, but it's a final check to
         #   make sure everything is unicode.
         for i, v in enumerate(row):
@@ -288,6 +920,44 @@ class DataHandler(object):
         #finally return the row
         return row
 
+    def _get_xlrd_columns(self):
+        '''Get all the columns of the sheet (as lists of unicode values) - the
+        rows are put together from them as they're needed.
+
+        The first time, the sheet is read a column at a time, and the numbers
+        & dates in each column are converted in one pass.'''
+        if self._xlrd_columns is None:
+            datemode = self.book.datemode
+            columns = []
+            for col in xrange(self.dataset.ncols):
+                types = self.dataset.col_types(col)
+                type_set = set(types)
+                values = self.dataset.col_values(col)
+                #text & empty cells are already unicode, so most columns
+                #   don't need another pass
+                if not type_set <= XLRD_TEXT_TYPES:
+                    if xlrd.XL_CELL_NUMBER in type_set or xlrd.XL_CELL_DATE in type_set:
+                        values = [_convert_xlrd_cell(v, t, datemode) for v, t in izip(values, types)]
+                    values = [v if isinstance(v, unicode) else unicode(v) for v in values]
+                columns.append(values)
+            self._xlrd_columns = columns
+        return self._xlrd_columns
+
+    def _process_text_dates(self, row):
+        '''Reformat text dates in the date columns of a data row (in place).'''
+        row_len = len(row)
+        for i in self._get_mapping_plan().date_cols:
+            if i < row_len and isinstance(row[i], basestring):
+                #we may have a text date, so see if we can understand it
+                # *process_text_date will return a text value of the
+                #   reformatted date if possible, else the original value
+                row[i] = process_text_date(row[i], self.forceDates)
+
+    def _decode_csv_row(self, row):
+        '''Decode the cells of a row from the CSV module to unicode.'''
+        encoding = self._csvEncoding
+        return [unicode(cell, encoding) for cell in row]
+
     def _utf_8_encoder(self, unicode_csv_data):
         '''From docs.python.org/2.6/library/csv.html
         
@@ -302,9 +972,105 @@ class DataHandler(object):
             totalRows = self.dataset.nrows
         elif self.dataType == 'csv':
             totalRows = len(self.csvData)
+        elif self.dataType == 'xlsx':
+            totalRows = len(self.xlsxData)
         return totalRows
 
 
+#byte order marks, & the encoding they mean (the UTF-32 ones first, since
+#   the UTF-32 LE mark starts with the UTF-16 LE one)
+BYTE_ORDER_MARKS = [
+    (codecs.BOM_UTF32_LE, 'utf-32'),
+    (codecs.BOM_UTF32_BE, 'utf-32'),
+    (codecs.BOM_UTF8, 'utf-8'),
+    (codecs.BOM_UTF16_LE, 'utf-16'),
+    (codecs.BOM_UTF16_BE, 'utf-16'),
+]
+
+
+def detect_bom(data, default_encoding):
+    '''Check the start of a file for a byte order mark. Returns the
+    (encoding, length of the BOM) - the BOM is left for the utf-16 & utf-32
+    codecs to handle, but a UTF-8 BOM has to be skipped.'''
+    for bom, encoding in BYTE_ORDER_MARKS:
+        if data.startswith(bom):
+            if encoding == 'utf-8':
+                return (encoding, len(bom))
+            return (encoding, 0)
+    return (default_encoding, 0)
+
+
+def csv_cell_encoding(encoding):
+    '''Get the encoding to decode CSV cells with, if the CSV module can parse
+    data in this encoding as it is (the delimiters, quotes & newlines have to
+    be the same bytes as in ascii, and those bytes can't be part of any other
+    characters). Returns None if the data has to be transcoded first.'''
+    name = codecs.lookup(encoding).name
+    #unicode() has fast paths for these spellings
+    if name in ('utf-8', 'ascii'):
+        return name
+    if name == 'iso8859-1':
+        return 'latin-1'
+    if name.startswith(('iso8859-', 'cp125', 'mac-')):
+        return name
+    return None
+
+
+#xlrd cell types whose values are always unicode
+XLRD_TEXT_TYPES = frozenset([xlrd.XL_CELL_TEXT, xlrd.XL_CELL_EMPTY, xlrd.XL_CELL_BLANK])
+
+
+def _convert_xlrd_cell(value, cell_type, datemode):
+    '''Convert an xlrd number or date cell value to unicode (other values
+    are returned as they are).'''
+    #there are some interesting things that happen
+    # with numbers in Excel. Eg. what looks like an int in Excel
+    # is actually stored as a float (and xlrd handles as a float).
+    #http://stackoverflow.com/questions/2739989/reading-numeric-excel-data-as-text-using-xlrd-in-python
+    if cell_type == xlrd.XL_CELL_NUMBER and int(value) == value:
+        #convert data into int & then unicode
+        #Note: if a number was displayed as xxxx.0 in Excel, we
+        #   would lose the .0 here
+        return unicode(int(value))
+    #Dates are also stored as floats in Excel, so we have to do
+    #   some extra processing to get an actual date out of it
+    elif cell_type == xlrd.XL_CELL_DATE:
+        #Note: we are losing Excel formatting information here,
+        #   and formatting the date as yyyy-mm-dd.
+        tup = xlrd.xldate_as_tuple(value, datemode)
+        if tup[0] == 0 and tup[1] == 0 and tup[2] == 0:
+            #just time, no date
+            return u'%02d:%02d:%02d' % tup[3:]
+        elif tup[3] == 0 and tup[4] == 0 and tup[5] == 0:
+            #just date, no time
+            return u'%04d-%02d-%02d' % tup[:3]
+        else:
+            #assume full date/time
+            return u'%04d-%02d-%02d %02d:%02d:%02d' % tup
+    return value
+
+
+#Some date formats we could understand:
+#dd/dd/dddd, dd/dd/dd, d/d/dd, dd-dd-dddd, dd-dd-dd, d-d-dd, ...
+#   (both separators have to be the same)
+TEXT_DATE_RE = re.compile(r'^(\d?\d)([/-])(\d?\d)\2(\d\d\d\d|\d\d)$')
+
+
+class TextDateCache(LRUCache):
+    '''Cache of process_text_date results, keyed by (text date, forceDates).
+
+    Each item is a (result, warning) tuple (see _normalize_text_date), so the
+    warning can be counted again each time the date shows up.'''
+
+    def __init__(self, maxsize=10000):
+        super(TextDateCache, self).__init__(lambda key: _normalize_text_date(*key), maxsize)
+
+
+#cache used by process_text_date - date columns tend to have the same
+#   dates over and over
+text_date_cache = TextDateCache()
+
+
 def process_text_date(strDate, forceDates=False):
     '''Take a text-based date and try to reformat it to yyyy-mm-dd if needed.
         
@@ -315,95 +1081,126 @@ def process_text_date(strDate, forceDates=False):
         return strDate
     if len(strDate) == 0:
         return strDate
-    #Some date formats we could understand:
-    #dd/dd/dddd, dd/dd/dd, d/d/dd, ...
-    mmddyy = re.compile('^\d?\d/\d?\d/\d\d$')
-    mmddyyyy = re.compile('^\d?\d/\d?\d/\d\d\d\d$')
-    #dd-dd-dddd, dd-dd-dd, d-d-dd, ...
-    mmddyy2 = re.compile('^\d?\d-\d?\d-\d\d$')
-    mmddyyyy2 = re.compile('^\d?\d-\d?\d-\d\d\d\d$')
-    format = '' #flag to remember which format we used
-    if mmddyy.search(strDate):
-        try:
-            #try mm/dd/yy first, since that should be more common in the US
-            newDate = datetime.datetime.strptime(strDate, '%m/%d/%y')
-            format = 'mmddyy'
-        except ValueError:
-            try:
-                newDate = datetime.datetime.strptime(strDate, '%d/%m/%y')
-                format = 'ddmmyy'
-            except ValueError:
-                logger.warning('Error creating date from ' + strDate)
-                return strDate
-    elif mmddyyyy.search(strDate):
-        try:
-            newDate = datetime.datetime.strptime(strDate, '%m/%d/%Y')
-            format = 'mmddyyyy'
-        except ValueError:
-            try:
-                newDate = datetime.datetime.strptime(strDate, '%d/%m/%Y')
-                format = 'ddmmyyyy'
-            except ValueError:
-                logger.warning('Error creating date from ' + strDate)
-                return strDate
-    elif mmddyy2.search(strDate):
-        try:
-            #try mm-dd-yy first, since that should be more common
-            newDate = datetime.datetime.strptime(strDate, '%m-%d-%y')
-            format = 'mmddyy'
-        except ValueError:
-            try:
-                newDate = datetime.datetime.strptime(strDate, '%d-%m-%y')
-                format = 'ddmmyy'
-            except ValueError:
-                logger.warning('Error creating date from ' + strDate)
-                return strDate
-    elif mmddyyyy2.search(strDate):
-        try:
-            newDate = datetime.datetime.strptime(strDate, '%m-%d-%Y')
-            format = 'mmddyyyy'
-        except ValueError:
-            try:
-                newDate = datetime.datetime.strptime(strDate, '%d-%m-%Y')
-                format = 'ddmmyyyy'
-            except ValueError:
-                logger.warning('Error creating date from ' + strDate)
-                return strDate
-    else:
+    result, warning = text_date_cache.get((strDate, forceDates))
+    if warning:
+        category, message = warning
+        warning_counter.warn(category, message, strDate, strDate)
+    return result
+
+
+def _make_date(year, month, day):
+    '''Return a datetime.date, or None if the values aren't a valid date.'''
+    try:
+        return datetime.date(year, month, day)
+    except ValueError:
+        return None
+
+
+def _normalize_text_date(strDate, forceDates):
+    '''Does the work for process_text_date - returns (result, warning), where
+    warning is None or a (category, message) tuple (the message is a format
+    for the date).
+
+    This gives the same results as trying datetime.strptime with %m/%d/%y
+    and then %d/%m/%y (or the %Y & '-' versions), without the overhead.'''
+    match = TEXT_DATE_RE.match(strDate)
+    if not match:
         #logger.warning('Could not parse date string: ' + strDate)
-        return strDate
+        return (strDate, None)
+    first, separator, second, year_text = match.groups()
+    if match.end() != len(strDate):
+        #a trailing newline matches the '$', but strptime doesn't accept it
+        return (strDate, ('invalid dates', 'Error creating date from %s'))
+    year = int(year_text)
+    short_year = (len(year_text) == 2)
+    if short_year:
+        #same cutoff as strptime's %y
+        if year < 69:
+            year += 2000
+        else:
+            year += 1900
+    #try mm/dd first, since that should be more common in the US
+    newDate = _make_date(year, int(first), int(second))
+    if newDate is None:
+        newDate = _make_date(year, int(second), int(first))
+        if newDate is None:
+            return (strDate, ('invalid dates', 'Error creating date from %s'))
+    normalized = u'%04d-%02d-%02d' % (newDate.year, newDate.month, newDate.day)
     #at this point, we have newDate, but it could still have been ambiguous
     #day & month are both between 1 and 12 & not equal - ambiguous
-    if newDate.day <= 12 and newDate.day != newDate.month: 
+    if newDate.day <= 12 and newDate.day != newDate.month:
         if forceDates:
-            logger.warning('Ambiguous day/month: ' + strDate + 
-                        '. Using it anyway.')
-            return newDate.strftime('%Y-%m-%d')
+            return (normalized, ('ambiguous day/month dates', 'Ambiguous day/month: %s. Using it anyway.'))
         else:
-            logger.warning('Ambiguous day/month: ' + strDate)
-            return strDate
+            return (strDate, ('ambiguous day/month dates', 'Ambiguous day/month: %s'))
     #year is only two digits - don't know the century, or if year was
     # interchanged with month or day
-    elif format == 'mmddyy' or format == 'ddmmyy':
+    elif short_year:
         if forceDates:
-            logger.warning('Ambiguous year: ' + strDate +
-                        '. Using it anyway.')
-            return newDate.strftime('%Y-%m-%d')
+            return (normalized, ('ambiguous year dates', 'Ambiguous year: %s. Using it anyway.'))
         else:
-            logger.warning('Ambiguous year: ' + strDate)
-            return strDate
+            return (strDate, ('ambiguous year dates', 'Ambiguous year: %s'))
     else:
-        return newDate.strftime('%Y-%m-%d')
+        return (normalized, None)
+
+
+#an unescaped '#' separates the sections of a value ('\#' is a literal '#')
+SECTION_SEPARATOR_RE = re.compile(r'(?<!\\)#')
+
+
+def split_sections(value):
+    '''Split a data value into its sections, on unescaped '#'s.
+
+    An empty last section is dropped, and '\#' is unescaped to '#'.'''
+    if u'#' not in value:
+        return [value] if value else []
+    divs = SECTION_SEPARATOR_RE.split(value)
+    if not divs[-1]:
+        divs.pop()
+    if u'\\' in value:
+        divs = [div.replace(u'\\#', u'#') for div in divs]
+    return divs
+
+
+def split_sectioned_data(data, separator=u'||'):
+    '''Split cell data into values (on separator) & each value into its
+    sections (see split_sections).
+
+    Returns a list of the non-empty values (stripped), each one a list of
+    its sections. Both splits are C-level, so each character is only looked
+    at a couple of times, however many escapes there are.'''
+    values = []
+    for value in data.split(separator):
+        value = value.strip()
+        if value:
+            values.append(split_sections(value))
+    return values
+
+
+def split_data(data, has_sectioned_data, separator=u'||'):
+    '''Split cell data into the list of values a Mapper handler gets - each
+    value is a list of its sections (just one, if the location isn't sectioned).'''
+    if has_sectioned_data:
+        return split_sectioned_data(data, separator)
+    #strip any empty data sections so the handlers don't have to worry about it
+    return [[value] for value in [value.strip() for value in data.split(separator)] if value]
 
 
 class Mapper(object):
     '''Map data into a Mods object.
     Each instance of this class can only handle 1 MODS object.'''
 
-    def __init__(self, encoding='utf-8', parent_mods=None):
+    #base element name -> (handler, clear, compile) - see register_element_handler
+    _element_handlers = {}
+
+    def __init__(self, encoding='utf-8', parent_mods=None, location_cache=None):
         self.dataSeparator = u'||'
         self.encoding = encoding
         self._parent_mods = parent_mods
+        #parsed control row locations are shared between Mappers by default
+        if location_cache is None:
+            location_cache = default_location_cache
+        self._location_cache = location_cache
         #dict for keeping track of which fields we've cleared out the parent
         # info for. So we can have multiple columns in the spreadsheet w/ the same field.
         self._cleared_fields = {}
@@ -418,184 +1215,168 @@ class Mapper(object):
     def add_data(self, mods_loc, data):
         '''Method to actually put the data in the correct place of MODS obj.'''
         #parse location info into elements/attributes
-        loc = LocationParser(mods_loc)
-        base_element = loc.get_base_element()
-        location_sections = loc.get_sections()
-        data_vals = [data.strip() for data in data.split(self.dataSeparator)]
-        #strip any empty data sections so we don't have to worry about it below
-        data_vals = [self._get_data_divs(data, loc.has_sectioned_data) for data in data_vals if data]
+        loc = self._location_cache.get(mods_loc)
+        base_element = loc.base_element
+        location_sections = loc.sections
+        data_vals = split_data(data, loc.has_sectioned_data, self.dataSeparator)
         #handle various MODS elements
-        if base_element['element'] == u'mods:mods':
-            if 'ID' in base_element['attributes']:
-                self._mods.id = data_vals[0][0]
-        elif base_element['element'] == u'mods:name':
-            if not self._cleared_fields.get(u'names', None):
-                self._mods.names = []
-                self._cleared_fields[u'names'] = True
-            self._add_name_data(base_element, location_sections, data_vals)
-        elif base_element['element'] == u'mods:namePart':
-            #grab the last name that was added
-            name = self._mods.names[-1]
-            np = mods.NamePart(text=data_vals[0][0])
-            if u'type' in base_element[u'attributes']:
-                np.type = base_element[u'attributes'][u'type']
-            name.name_parts.append(np)
-        elif base_element[u'element'] == u'mods:titleInfo':
-            if not self._cleared_fields.get(u'title_info_list', None):
-                self._mods.title_info_list = []
-                self._cleared_fields[u'title_info_list'] = True
-            self._add_title_data(base_element, location_sections, data_vals)
-        elif base_element[u'element'] == u'mods:language':
-            if not self._cleared_fields.get(u'languages', None):
-                self._mods.languages = []
-                self._cleared_fields[u'languages'] = True
-            for data in data_vals:
-                language = mods.Language()
-                language_term = mods.LanguageTerm(text=data[0])
-                if u'authority' in location_sections[0][0]['attributes']:
-                    language_term.authority = location_sections[0][0]['attributes']['authority']
-                if u'type' in location_sections[0][0]['attributes']:
-                    language_term.type = location_sections[0][0][u'attributes'][u'type']
-                language.terms.append(language_term)
-                self._mods.languages.append(language)
-        elif base_element[u'element'] == u'mods:genre':
-            if not self._cleared_fields.get(u'genres', None):
-                self._mods.genres = []
-                self._cleared_fields[u'genres'] = True
-            for data in data_vals:
-                genre = mods.Genre(text=data[0])
-                if 'authority' in base_element['attributes']:
-                    genre.authority = base_element['attributes']['authority']
-                self._mods.genres.append(genre)
-        elif base_element['element'] == 'mods:originInfo':
-            if not self._cleared_fields.get(u'origin_info', None):
-                self._mods.origin_info = None
-                self._cleared_fields[u'origin_info'] = True
-                self._mods.create_origin_info()
-            self._add_origin_info_data(base_element, location_sections, data_vals)
-        elif base_element['element'] == 'mods:physicalDescription':
-            if not self._cleared_fields.get(u'physical_description', None):
-                self._mods.physical_description = None
-                self._cleared_fields[u'physical_description'] = True
-                #can only have one physical description currently
-                self._mods.create_physical_description()
-            data_divs = data_vals[0]
-            for index, section in enumerate(location_sections):
-                if section[0][u'element'] == 'mods:extent':
-                    self._mods.physical_description.extent = data_divs[index]
-                elif section[0][u'element'] == 'mods:digitalOrigin':
-                    self._mods.physical_description.digital_origin = data_divs[index]
-                elif section[0][u'element'] == 'mods:note':
-                    self._mods.physical_description.note = data_divs[index]
-        elif base_element['element'] == 'mods:typeOfResource':
-            if not self._cleared_fields.get(u'typeOfResource', None):
-                self._mods.resource_type = None
-                self._cleared_fields[u'typeOfResource'] = True
-            self._mods.resource_type = data_vals[0][0]
-        elif base_element['element'] == 'mods:abstract':
-            if not self._cleared_fields.get(u'abstract', None):
-                self._mods.abstract = None
-                self._cleared_fields[u'abstract'] = True
-                #can only have one abstract currently
-                self._mods.create_abstract()
-            self._mods.abstract.text = data_vals[0][0]
-        elif base_element['element'] == 'mods:note':
-            if not self._cleared_fields.get(u'notes', None):
-                self._mods.notes = []
-                self._cleared_fields[u'notes'] = True
-            for data in data_vals:
-                note = mods.Note(text=data[0])
-                if 'type' in base_element['attributes']:
-                    note.type = base_element['attributes']['type']
-                if 'displayLabel' in base_element['attributes']:
-                    note.label = base_element['attributes']['displayLabel']
-                self._mods.notes.append(note)
-        elif base_element['element'] == 'mods:subject':
-            if not self._cleared_fields.get(u'subjects', None):
-                self._mods.subjects = []
-                self._cleared_fields[u'subjects'] = True
-            for data in data_vals:
-                subject = mods.Subject()
-                if 'authority' in base_element['attributes']:
-                    subject.authority = base_element['attributes']['authority']
-                data_divs = data
-                for section, div in zip(location_sections, data_divs):
-                    if section[0]['element'] == 'mods:topic':
-                        topic = mods.Topic(text=div)
-                        subject.topic_list.append(topic)
-                    elif section[0]['element'] == 'mods:temporal':
-                        temporal = mods.Temporal(text=div)
-                        subject.temporal_list.append(temporal)
-                    elif section[0]['element'] == 'mods:geographic':
-                        subject.geographic = div
-                    elif section[0]['element'] == 'mods:hierarchicalGeographic':
-                        print(u'%s' % section)
-                        hg = mods.HierarchicalGeographic()
-                        if section[1]['element'] == 'mods:country':
-                            if 'data' in section[1]:
-                                hg.country = section[1]['data']
-                                if section[2]['element'] == 'mods:state':
-                                    hg.state = div
-                            else:
-                                hg.country = div
-                        subject.hierarchical_geographic = hg
-                self._mods.subjects.append(subject)
-        elif base_element['element'] == 'mods:identifier':
-            if not self._cleared_fields.get(u'identifiers', None):
-                self._mods.identifiers = []
-                self._cleared_fields[u'identifiers'] = True
-            for data in data_vals:
-                identifier = mods.Identifier(text=data[0])
-                if 'type' in base_element['attributes']:
-                    identifier.type = base_element['attributes']['type']
-                if 'displayLabel' in base_element['attributes']:
-                    identifier.label = base_element['attributes']['displayLabel']
-                self._mods.identifiers.append(identifier)
-        elif base_element['element'] == u'mods:location':
-            if not self._cleared_fields.get(u'locations', None):
-                self._mods.locations = []
-                self._cleared_fields[u'locations'] = True
-            for data in data_vals:
-                loc = mods.Location()
-                data_divs = data
-                for section, div in zip(location_sections, data_divs):
-                    if section[0]['element'] == u'mods:url':
-                        if section[0]['data']:
-                            loc.url = section[0]['data']
-                        else:
-                            loc.url = div
-                    elif section[0]['element'] == u'mods:physicalLocation':
-                        if section[0]['data']:
-                            loc.physical = section[0]['data']
-                        else:
-                            loc.physical = div
-                    elif section[0]['element'] == u'mods:holdingSimple':
-                        hs = mods.HoldingSimple()
-                        if section[1]['element'] == u'mods:copyInformation':
-                            if section[2]['element'] == u'mods:note':
-                                note = mods.Note(text=div)
-                                ci = mods.CopyInformation()
-                                ci.notes.append(note)
-                                hs.copy_information.append(ci)
-                                loc.holding_simple = hs
-                self._mods.locations.append(loc)
-        elif base_element['element'] == u'mods:relatedItem':
-            if not self._cleared_fields.get(u'related', None):
-                self._mods.related_items = []
-                self._cleared_fields[u'related'] = True
-            for data in data_vals:
-                related_item = mods.RelatedItem()
-                if u'type' in base_element[u'attributes']:
-                    related_item.type = base_element[u'attributes'][u'type']
-                if u'displayLabel' in base_element[u'attributes']:
-                    related_item.label = base_element[u'attributes'][u'displayLabel']
-                if location_sections[0][0][u'element'] == u'mods:titleInfo':
-                    if location_sections[0][1][u'element'] == u'mods:title':
-                        related_item.title = data[0]
-                self._mods.related_items.append(related_item)
-        else:
-            logger.error('element not handled! %s' % base_element)
+        element = base_element[u'element']
+        try:
+            handler, clear, compile = self._element_handlers[element]
+        except KeyError:
+            logger.error('element not handled! %s', base_element)
             raise Exception('element not handled!')
+        if clear is not None and element not in self._cleared_fields:
+            #clear out the parent info for this element, the first time we see it
+            clear(self._mods)
+            self._cleared_fields[element] = True
+        handler(self, base_element, location_sections, data_vals)
+
+    @classmethod
+    def register_element_handler(cls, element, handler, clear=None, compile=None):
+        '''Register the function that maps data for a base element (eg. u'mods:note').
+
+        handler is called as handler(mapper, base_element, location_sections, data_vals).
+        clear, if given, is called as clear(mods_obj) the first time a Mapper
+        gets data for the element, to remove whatever the parent MODS had for it.
+        compile, if given, is called as compile(base_element, location_sections)
+        and returns a build(root, data_vals) function that does the same as
+        handler to an lxml mods:mods element (see compile_location) - without
+        it, DirectMapper (--engine lxml) can't map the element.
+        Registering on a subclass doesn't affect Mapper itself.'''
+        if '_element_handlers' not in cls.__dict__:
+            cls._element_handlers = dict(cls._element_handlers)
+        cls._element_handlers[element] = (handler, clear, compile)
+
+    def _add_mods_data(self, base_element, location_sections, data_vals):
+        if 'ID' in base_element['attributes']:
+            self._mods.id = data_vals[0][0]
+
+    def _add_name_part_data(self, base_element, location_sections, data_vals):
+        #grab the last name that was added
+        name = self._mods.names[-1]
+        np = mods.NamePart(text=data_vals[0][0])
+        if u'type' in base_element[u'attributes']:
+            np.type = base_element[u'attributes'][u'type']
+        name.name_parts.append(np)
+
+    def _add_language_data(self, base_element, location_sections, data_vals):
+        for data in data_vals:
+            language = mods.Language()
+            language_term = mods.LanguageTerm(text=data[0])
+            if u'authority' in location_sections[0][0]['attributes']:
+                language_term.authority = location_sections[0][0]['attributes']['authority']
+            if u'type' in location_sections[0][0]['attributes']:
+                language_term.type = location_sections[0][0][u'attributes'][u'type']
+            language.terms.append(language_term)
+            self._mods.languages.append(language)
+
+    def _add_genre_data(self, base_element, location_sections, data_vals):
+        for data in data_vals:
+            genre = mods.Genre(text=data[0])
+            if 'authority' in base_element['attributes']:
+                genre.authority = base_element['attributes']['authority']
+            self._mods.genres.append(genre)
+
+    def _add_physical_description_data(self, base_element, location_sections, data_vals):
+        data_divs = data_vals[0]
+        for index, section in enumerate(location_sections):
+            if section[0][u'element'] == 'mods:extent':
+                self._mods.physical_description.extent = data_divs[index]
+            elif section[0][u'element'] == 'mods:digitalOrigin':
+                self._mods.physical_description.digital_origin = data_divs[index]
+            elif section[0][u'element'] == 'mods:note':
+                self._mods.physical_description.note = data_divs[index]
+
+    def _add_resource_type_data(self, base_element, location_sections, data_vals):
+        self._mods.resource_type = data_vals[0][0]
+
+    def _add_abstract_data(self, base_element, location_sections, data_vals):
+        self._mods.abstract.text = data_vals[0][0]
+
+    def _add_note_data(self, base_element, location_sections, data_vals):
+        for data in data_vals:
+            note = mods.Note(text=data[0])
+            if 'type' in base_element['attributes']:
+                note.type = base_element['attributes']['type']
+            if 'displayLabel' in base_element['attributes']:
+                note.label = base_element['attributes']['displayLabel']
+            self._mods.notes.append(note)
+
+    def _add_subject_data(self, base_element, location_sections, data_vals):
+        for data in data_vals:
+            subject = mods.Subject()
+            if 'authority' in base_element['attributes']:
+                subject.authority = base_element['attributes']['authority']
+            data_divs = data
+            for section, div in zip(location_sections, data_divs):
+                if section[0]['element'] == 'mods:topic':
+                    topic = mods.Topic(text=div)
+                    subject.topic_list.append(topic)
+                elif section[0]['element'] == 'mods:temporal':
+                    temporal = mods.Temporal(text=div)
+                    subject.temporal_list.append(temporal)
+                elif section[0]['element'] == 'mods:geographic':
+                    subject.geographic = div
+                elif section[0]['element'] == 'mods:hierarchicalGeographic':
+                    logger.debug(u'hierarchicalGeographic section: %s', section)
+                    hg = mods.HierarchicalGeographic()
+                    if section[1]['element'] == 'mods:country':
+                        if 'data' in section[1]:
+                            hg.country = section[1]['data']
+                            if section[2]['element'] == 'mods:state':
+                                hg.state = div
+                        else:
+                            hg.country = div
+                    subject.hierarchical_geographic = hg
+            self._mods.subjects.append(subject)
+
+    def _add_identifier_data(self, base_element, location_sections, data_vals):
+        for data in data_vals:
+            identifier = mods.Identifier(text=data[0])
+            if 'type' in base_element['attributes']:
+                identifier.type = base_element['attributes']['type']
+            if 'displayLabel' in base_element['attributes']:
+                identifier.label = base_element['attributes']['displayLabel']
+            self._mods.identifiers.append(identifier)
+
+    def _add_location_data(self, base_element, location_sections, data_vals):
+        for data in data_vals:
+            loc = mods.Location()
+            data_divs = data
+            for section, div in zip(location_sections, data_divs):
+                if section[0]['element'] == u'mods:url':
+                    if section[0]['data']:
+                        loc.url = section[0]['data']
+                    else:
+                        loc.url = div
+                elif section[0]['element'] == u'mods:physicalLocation':
+                    if section[0]['data']:
+                        loc.physical = section[0]['data']
+                    else:
+                        loc.physical = div
+                elif section[0]['element'] == u'mods:holdingSimple':
+                    hs = mods.HoldingSimple()
+                    if section[1]['element'] == u'mods:copyInformation':
+                        if section[2]['element'] == u'mods:note':
+                            note = mods.Note(text=div)
+                            ci = mods.CopyInformation()
+                            ci.notes.append(note)
+                            hs.copy_information.append(ci)
+                            loc.holding_simple = hs
+            self._mods.locations.append(loc)
+
+    def _add_related_item_data(self, base_element, location_sections, data_vals):
+        for data in data_vals:
+            related_item = mods.RelatedItem()
+            if u'type' in base_element[u'attributes']:
+                related_item.type = base_element[u'attributes'][u'type']
+            if u'displayLabel' in base_element[u'attributes']:
+                related_item.label = base_element[u'attributes'][u'displayLabel']
+            if location_sections[0][0][u'element'] == u'mods:titleInfo':
+                if location_sections[0][1][u'element'] == u'mods:title':
+                    related_item.title = data[0]
+            self._mods.related_items.append(related_item)
 
     def _add_title_data(self, base_element, location_sections, data_vals):
         for data_divs in data_vals:
@@ -617,28 +1398,10 @@ class Mapper(object):
             self._mods.title_info_list.append(title)
 
     def _get_data_divs(self, data, has_sectioned_data):
-        data_divs = []
         if not has_sectioned_data:
             return [data]
         #split data into its divisions based on '#', but allow \ to escape the #
-        while data:
-            ind = data.find(u'#')
-            if ind == -1:
-                data_divs.append(data)
-                data = ''
-            else:
-                while ind != -1 and data[ind-1] == u'\\':
-                    #remove '\'
-                    data = data[:ind-1] + data[ind:]
-                    #find next '#' (being sure to advance past current '#')
-                    ind = data.find(u'#', ind)
-                if ind == -1:
-                    data_divs.append(data)
-                    data = u''
-                else:
-                    data_divs.append(data[:ind])
-                    data = data[ind+1:]
-        return data_divs
+        return split_sections(data)
 
 
     def _add_name_data(self, base_element, location_sections, data_vals):
@@ -725,8 +1488,7 @@ class Mapper(object):
                 elif section[0][u'element'] == u'mods:publisher':
                     self._mods.origin_info.publisher = divs[index]
                 else:
-                    print(u'unhandled originInfo element: %s' % section)
-                    raise Exception('unhandled originInfo element: %s' % section)
+                    raise Exception('unhandled originInfo element: %s' % (section,))
 
     def _set_date_attributes(self, date, attributes):
         if u'encoding' in attributes:
@@ -738,6 +1500,435 @@ class Mapper(object):
         return date
 
 
+def _clear_list(field):
+    '''Make a function that empties a list field of a Mods object.'''
+    def clear(mods_obj):
+        setattr(mods_obj, field, [])
+    return clear
+
+
+def _clear_node(field, create=None):
+    '''Make a function that removes a field of a Mods object (and then
+    creates a new empty one, if create is the name of the create method).'''
+    def clear(mods_obj):
+        setattr(mods_obj, field, None)
+        if create:
+            getattr(mods_obj, create)()
+    return clear
+
+
+
+MODS_NAMESPACE = u'http://www.loc.gov/mods/v3'
+
+
+class UnsupportedLocation(Exception):
+    '''A control row location that DirectMapper can't map the same way as Mapper.'''
+
+
+def _mods_tag(element):
+    '''u'mods:title' -> the lxml tag for the element.'''
+    prefix, sep, name = element.partition(u':')
+    if prefix != u'mods' or not name:
+        raise UnsupportedLocation(element)
+    return u'{%s}%s' % (MODS_NAMESPACE, name)
+
+
+def _get_attributes(element, names):
+    '''The (name, value) pairs of the attributes Mapper would set on an
+    element, in the order it sets them (not the control row order).'''
+    return [(name, element[u'attributes'][name]) for name in names if name in element[u'attributes']]
+
+
+def _set_attributes(node, attributes):
+    for name, value in attributes:
+        node.set(name, value)
+
+
+def _add_item(parent, tag):
+    '''Add a tag element after the last one in parent (or at the end, if
+    there isn't one) - where eulxml adds an item to a list field.'''
+    last = next(parent.iterchildren(tag, reversed=True), None)
+    child = etree.SubElement(parent, tag)
+    if last is not None:
+        last.addnext(child)
+    return child
+
+
+def _get_child(parent, tag):
+    '''Get the first tag element in parent, or add one at the end - like
+    eulxml does for a single node field.'''
+    child = parent.find(tag)
+    if child is None:
+        child = etree.SubElement(parent, tag)
+    return child
+
+
+def _add_text_item(parent, tag, text, attributes):
+    node = _add_item(parent, tag)
+    node.text = text
+    _set_attributes(node, attributes)
+    return node
+
+
+def _compile_mods(base_element, sections):
+    if u'ID' not in base_element[u'attributes']:
+        return lambda root, data_vals: None
+    def build(root, data_vals):
+        root.set(u'ID', data_vals[0][0])
+    return build
+
+
+def _compile_name(base_element, sections):
+    name_tag = _mods_tag(u'mods:name')
+    name_part_tag = _mods_tag(u'mods:namePart')
+    role_tag = _mods_tag(u'mods:role')
+    role_term_tag = _mods_tag(u'mods:roleTerm')
+    name_attributes = _get_attributes(base_element, [u'type'])
+    #(index, whether it's a mods:role section, [(is a namePart, attributes, roleTerm data)])
+    compiled_sections = []
+    for index, section in enumerate(sections):
+        elements = []
+        for element in section:
+            if element[u'element'] == u'mods:namePart':
+                elements.append((True, _get_attributes(element, [u'type']), None))
+            elif element[u'element'] == u'mods:roleTerm':
+                elements.append((False, _get_attributes(element, [u'type', u'authority']), element[u'data']))
+        compiled_sections.append((index, section[0][u'element'] == u'mods:role', elements))
+    def build(root, data_vals):
+        for data in data_vals:
+            name = _add_item(root, name_tag)
+            _set_attributes(name, name_attributes)
+            for index, is_role, elements in compiled_sections:
+                try:
+                    div = data[index].strip()
+                except IndexError:
+                    div = None
+                if not div and not is_role:
+                    continue
+                for is_name_part, attributes, role_data in elements:
+                    if is_name_part:
+                        _add_text_item(name, name_part_tag, div, attributes)
+                        continue
+                    text = role_data or div
+                    if not text:
+                        continue
+                    role = _add_item(name, role_tag)
+                    role_term = etree.SubElement(role, role_term_tag)
+                    role_term.text = text
+                    _set_attributes(role_term, attributes)
+    return build
+
+
+def _compile_name_part(base_element, sections):
+    name_tag = _mods_tag(u'mods:name')
+    name_part_tag = _mods_tag(u'mods:namePart')
+    attributes = _get_attributes(base_element, [u'type'])
+    def build(root, data_vals):
+        #add to the last name
+        name = root.findall(name_tag)[-1]
+        _add_text_item(name, name_part_tag, data_vals[0][0], attributes)
+    return build
+
+
+def _compile_title(base_element, sections):
+    title_info_tag = _mods_tag(u'mods:titleInfo')
+    attributes = _get_attributes(base_element, [u'type', u'displayLabel'])
+    title_elements = [u'mods:title', u'mods:partName', u'mods:partNumber', u'mods:nonSort']
+    section_tags = [[_mods_tag(element[u'element']) for element in section if element[u'element'] in title_elements]
+                    for section in sections]
+    def build(root, data_vals):
+        for data_divs in data_vals:
+            title = _add_item(root, title_info_tag)
+            _set_attributes(title, attributes)
+            for tags, div in zip(section_tags, data_divs):
+                for tag in tags:
+                    _get_child(title, tag).text = div
+    return build
+
+
+def _compile_language(base_element, sections):
+    if not sections:
+        raise UnsupportedLocation(u'mods:language')
+    language_tag = _mods_tag(u'mods:language')
+    language_term_tag = _mods_tag(u'mods:languageTerm')
+    attributes = _get_attributes(sections[0][0], [u'authority', u'type'])
+    def build(root, data_vals):
+        for data in data_vals:
+            language = _add_item(root, language_tag)
+            _add_text_item(language, language_term_tag, data[0], attributes)
+    return build
+
+
+def _compile_text_items(element, attribute_names):
+    '''Compile a location for a list of elements with just text (eg. mods:note).'''
+    def compile(base_element, sections):
+        tag = _mods_tag(element)
+        attributes = _get_attributes(base_element, attribute_names)
+        def build(root, data_vals):
+            for data in data_vals:
+                _add_text_item(root, tag, data[0], attributes)
+        return build
+    return compile
+
+
+def _compile_origin_info(base_element, sections):
+    origin_info_tag = _mods_tag(u'mods:originInfo')
+    place_tag = _mods_tag(u'mods:place')
+    place_term_tag = _mods_tag(u'mods:placeTerm')
+    publisher_tag = _mods_tag(u'mods:publisher')
+    label = base_element[u'attributes'].get(u'displayLabel')
+    date_elements = [u'mods:dateCreated', u'mods:dateIssued', u'mods:dateCaptured', u'mods:dateValid',
+                     u'mods:dateModified', u'mods:copyrightDate', u'mods:dateOther']
+    #(index, date tag or None, date attributes) for each section
+    compiled_sections = []
+    for index, section in enumerate(sections):
+        element = section[0][u'element']
+        if element in date_elements:
+            compiled_sections.append((index, _mods_tag(element),
+                                      _get_attributes(section[0], [u'encoding', u'point', u'keyDate'])))
+        elif element in (u'mods:place', u'mods:publisher'):
+            compiled_sections.append((index, element, None))
+        else:
+            #Mapper raises an exception for these
+            raise UnsupportedLocation(element)
+    def build(root, data_vals):
+        origin_info = _get_child(root, origin_info_tag)
+        if label is not None:
+            origin_info.set(u'displayLabel', label)
+        for divs in data_vals:
+            for index, tag, attributes in compiled_sections:
+                div = divs[index]
+                if not div:
+                    continue
+                if attributes is not None:
+                    _add_text_item(origin_info, tag, div, attributes)
+                elif tag == u'mods:place':
+                    place = _add_item(origin_info, place_tag)
+                    etree.SubElement(place, place_term_tag).text = div
+                else:
+                    _get_child(origin_info, publisher_tag).text = div
+    return build
+
+
+def _compile_physical_description(base_element, sections):
+    physical_description_tag = _mods_tag(u'mods:physicalDescription')
+    tags = [(index, _mods_tag(section[0][u'element'])) for index, section in enumerate(sections)
+            if section[0][u'element'] in (u'mods:extent', u'mods:digitalOrigin', u'mods:note')]
+    def build(root, data_vals):
+        physical_description = _get_child(root, physical_description_tag)
+        data_divs = data_vals[0]
+        for index, tag in tags:
+            _get_child(physical_description, tag).text = data_divs[index]
+    return build
+
+
+def _compile_abstract(base_element, sections):
+    abstract_tag = _mods_tag(u'mods:abstract')
+    def build(root, data_vals):
+        _get_child(root, abstract_tag).text = data_vals[0][0]
+    return build
+
+
+def _compile_subject(base_element, sections):
+    subject_tag = _mods_tag(u'mods:subject')
+    attributes = _get_attributes(base_element, [u'authority'])
+    #(kind, tag, country) for each section - kind is None for sections Mapper ignores
+    compiled_sections = []
+    for section in sections:
+        element = section[0][u'element']
+        if element in (u'mods:topic', u'mods:temporal'):
+            compiled_sections.append(('item', _mods_tag(element), None))
+        elif element == u'mods:geographic':
+            compiled_sections.append(('child', _mods_tag(element), None))
+        elif element == u'mods:hierarchicalGeographic':
+            if len(section) < 2:
+                raise UnsupportedLocation(element)
+            if section[1][u'element'] != u'mods:country':
+                compiled_sections.append(('hierarchical', None, None))
+            elif len(section) < 3 or not section[1][u'data']:
+                raise UnsupportedLocation(element)
+            else:
+                compiled_sections.append(('hierarchical', section[2][u'element'] == u'mods:state',
+                                          section[1][u'data']))
+        else:
+            compiled_sections.append((None, None, None))
+    if len([kind for kind, tag, country in compiled_sections if kind == 'hierarchical']) > 1:
+        #Mapper would replace the first one
+        raise UnsupportedLocation(u'mods:hierarchicalGeographic')
+    hierarchical_tag = _mods_tag(u'mods:hierarchicalGeographic')
+    country_tag = _mods_tag(u'mods:country')
+    state_tag = _mods_tag(u'mods:state')
+    def build(root, data_vals):
+        for data in data_vals:
+            subject = _add_item(root, subject_tag)
+            _set_attributes(subject, attributes)
+            for (kind, tag, country), div in zip(compiled_sections, data):
+                if kind == 'item':
+                    _add_item(subject, tag).text = div
+                elif kind == 'child':
+                    _get_child(subject, tag).text = div
+                elif kind == 'hierarchical':
+                    hierarchical = etree.SubElement(subject, hierarchical_tag)
+                    if country is not None:
+                        etree.SubElement(hierarchical, country_tag).text = country
+                        if tag:
+                            etree.SubElement(hierarchical, state_tag).text = div
+    return build
+
+
+def _compile_location(base_element, sections):
+    location_tag = _mods_tag(u'mods:location')
+    url_tag = _mods_tag(u'mods:url')
+    holding_tags = [_mods_tag(u'mods:holdingSimple'), _mods_tag(u'mods:copyInformation'), _mods_tag(u'mods:note')]
+    #(kind, url) for each section
+    compiled_sections = []
+    for section in sections:
+        element = section[0][u'element']
+        if element == u'mods:url':
+            compiled_sections.append(('url', section[0][u'data']))
+        elif element == u'mods:holdingSimple':
+            if len(section) < 2 or (section[1][u'element'] == u'mods:copyInformation' and len(section) < 3):
+                raise UnsupportedLocation(element)
+            if section[1][u'element'] == u'mods:copyInformation' and section[2][u'element'] == u'mods:note':
+                compiled_sections.append(('holding', None))
+            else:
+                compiled_sections.append((None, None))
+        elif element == u'mods:physicalLocation':
+            #not mapped the same way by all versions of bdrxml
+            raise UnsupportedLocation(element)
+        else:
+            compiled_sections.append((None, None))
+    if len([kind for kind, url in compiled_sections if kind == 'holding']) > 1:
+        raise UnsupportedLocation(u'mods:holdingSimple')
+    def build(root, data_vals):
+        for data in data_vals:
+            location = _add_item(root, location_tag)
+            for (kind, url), div in zip(compiled_sections, data):
+                if kind == 'url':
+                    _get_child(location, url_tag).text = url or div
+                elif kind == 'holding':
+                    node = location
+                    for tag in holding_tags:
+                        node = etree.SubElement(node, tag)
+                    node.text = div
+    return build
+
+
+def _compile_related_item(base_element, sections):
+    if not sections or (sections[0][0][u'element'] == u'mods:titleInfo' and len(sections[0]) < 2):
+        raise UnsupportedLocation(u'mods:relatedItem')
+    related_item_tag = _mods_tag(u'mods:relatedItem')
+    title_info_tag = _mods_tag(u'mods:titleInfo')
+    title_tag = _mods_tag(u'mods:title')
+    attributes = _get_attributes(base_element, [u'type', u'displayLabel'])
+    has_title = (sections[0][0][u'element'] == u'mods:titleInfo' and sections[0][1][u'element'] == u'mods:title')
+    def build(root, data_vals):
+        for data in data_vals:
+            related_item = _add_item(root, related_item_tag)
+            _set_attributes(related_item, attributes)
+            if has_title:
+                etree.SubElement(etree.SubElement(related_item, title_info_tag), title_tag).text = data[0]
+    return build
+
+
+#register the handlers for the base elements we know about, with the functions
+#   that compile their locations for DirectMapper
+for _element, _handler, _clear, _compile in [
+        (u'mods:mods', Mapper._add_mods_data, None, _compile_mods),
+        (u'mods:name', Mapper._add_name_data, _clear_list('names'), _compile_name),
+        (u'mods:namePart', Mapper._add_name_part_data, None, _compile_name_part),
+        (u'mods:titleInfo', Mapper._add_title_data, _clear_list('title_info_list'), _compile_title),
+        (u'mods:language', Mapper._add_language_data, _clear_list('languages'), _compile_language),
+        (u'mods:genre', Mapper._add_genre_data, _clear_list('genres'),
+            _compile_text_items(u'mods:genre', [u'authority'])),
+        (u'mods:originInfo', Mapper._add_origin_info_data, _clear_node('origin_info', 'create_origin_info'),
+            _compile_origin_info),
+        #can only have one physical description currently
+        (u'mods:physicalDescription', Mapper._add_physical_description_data,
+            _clear_node('physical_description', 'create_physical_description'), _compile_physical_description),
+        (u'mods:typeOfResource', Mapper._add_resource_type_data, _clear_node('resource_type'), None),
+        #can only have one abstract currently
+        (u'mods:abstract', Mapper._add_abstract_data, _clear_node('abstract', 'create_abstract'), _compile_abstract),
+        (u'mods:note', Mapper._add_note_data, _clear_list('notes'),
+            _compile_text_items(u'mods:note', [u'type', u'displayLabel'])),
+        (u'mods:subject', Mapper._add_subject_data, _clear_list('subjects'), _compile_subject),
+        (u'mods:identifier', Mapper._add_identifier_data, _clear_list('identifiers'),
+            _compile_text_items(u'mods:identifier', [u'type', u'displayLabel'])),
+        (u'mods:location', Mapper._add_location_data, _clear_list('locations'), _compile_location),
+        (u'mods:relatedItem', Mapper._add_related_item_data, _clear_list('related_items'), _compile_related_item),
+        ]:
+    Mapper.register_element_handler(_element, _handler, _clear, _compile)
+
+
+def compile_location(loc):
+    '''Compile a parsed location (see LocationCache) into a function that
+    adds the data values for it to an lxml mods:mods element, as
+    build(root, data_vals).
+
+    Returns None if DirectMapper can't map the location exactly the way
+    Mapper does (eg. an element registered on Mapper without a compile
+    function - see Mapper.register_element_handler).'''
+    element = loc.base_element[u'element']
+    handler, clear, compile = Mapper._element_handlers.get(element, (None, None, None))
+    if compile is None:
+        return None
+    try:
+        return compile(loc.base_element, loc.sections)
+    except UnsupportedLocation:
+        return None
+
+
+class CompiledLocationCache(LRUCache):
+    '''Cache of compile_location results, keyed by the control row location.'''
+
+    def __init__(self, maxsize=1024):
+        super(CompiledLocationCache, self).__init__(
+                lambda mods_loc: compile_location(default_location_cache.get(mods_loc)), maxsize)
+
+
+compiled_location_cache = CompiledLocationCache()
+
+#empty mods:mods element that each DirectMapper starts with a copy of
+_mods_template = None
+
+
+class DirectMapper(object):
+    '''Map data straight into an lxml tree, without the eulxml object model
+    that Mapper builds - a faster way to map records that don't have a parent.
+
+    The output is the same as Mapper's, but only for the locations that
+    compile_location supports - add_data raises UnsupportedLocation for the
+    others (check with supports first, to fall back to Mapper).'''
+
+    def __init__(self, compiled_cache=None):
+        global _mods_template
+        self.dataSeparator = u'||'
+        if compiled_cache is None:
+            compiled_cache = compiled_location_cache
+        self._compiled_cache = compiled_cache
+        if _mods_template is None:
+            _mods_template = mods.make_mods().node
+        self.node = copy.deepcopy(_mods_template)
+
+    @staticmethod
+    def supports(mods_locs, compiled_cache=None):
+        if compiled_cache is None:
+            compiled_cache = compiled_location_cache
+        return all(compiled_cache.get(mods_loc) is not None for mods_loc in mods_locs)
+
+    def add_data(self, mods_loc, data):
+        build = self._compiled_cache.get(mods_loc)
+        if build is None:
+            raise UnsupportedLocation(mods_loc)
+        loc = default_location_cache.get(mods_loc)
+        build(self.node, split_data(data, loc.has_sectioned_data, self.dataSeparator))
+
+    def serialize(self, pretty=True):
+        '''Serialize the MODS like Mods.serializeDocument (as UTF-8 bytes).'''
+        return etree.tostring(self.node.getroottree(), encoding='UTF-8', pretty_print=pretty,
+                              xml_declaration=True)
+
+
 class LocationParser(object):
     '''class for parsing dataset location instructions.
     eg. <mods:name type="personal"><mods:namePart>#<mods:namePart type="date">#<mods:namePart type="termsOfAddress">'''
@@ -848,52 +2039,1164 @@ class LocationParser(object):
                 attributes[attr] = val
                 data = data[valEnd+1:].strip()
             else:
-                logger.error('Error parsing attributes. data = "%s"' % data)
+                logger.error('Error parsing attributes. data = "%s"', data)
                 raise Exception('Error parsing attributes!')
         return attributes
 
 
-def get_mods_filename(parent_id, mods_id=None):
+class _FrozenDict(dict):
+    '''dict that can't be changed after it's created.'''
+
+    def _read_only(self, *args, **kwargs):
+        raise TypeError('%s is read-only' % self.__class__.__name__)
+
+    __setitem__ = __delitem__ = clear = pop = popitem = setdefault = update = _read_only
+
+    def __reduce__(self):
+        return (self.__class__, (dict(self),))
+
+
+#immutable version of a parsed location (see LocationParser):
+#   base_element is a read-only dict, and sections is a tuple of tuples of read-only dicts.
+ParsedLocation = namedtuple('ParsedLocation', ['base_element', 'sections', 'has_sectioned_data'])
+
+
+def _freeze_element(element):
+    frozen = dict(element)
+    frozen[u'attributes'] = _FrozenDict(element[u'attributes'])
+    return _FrozenDict(frozen)
+
+
+def parse_location(mods_loc):
+    '''Parse a control row location into a ParsedLocation.'''
+    loc = LocationParser(mods_loc)
+    return ParsedLocation(_freeze_element(loc.get_base_element()),
+            tuple(tuple(_freeze_element(e) for e in section) for section in loc.get_sections()),
+            loc.has_sectioned_data)
+
+
+class LocationCache(LRUCache):
+    '''Cache of parsed locations, keyed by the location string from the
+    control row.
+
+    Each distinct location is only parsed once, and the ParsedLocation can be
+    shared by any number of Mappers, since it can't be changed.'''
+
+    def __init__(self, maxsize=1024):
+        super(LocationCache, self).__init__(parse_location, maxsize)
+
+    def warm(self, mods_locs):
+        '''Parse a list of locations ahead of time (eg. the mapped columns
+        of the control row).'''
+        for mods_loc in mods_locs:
+            self.get(mods_loc)
+
+
+#cache used by Mappers that aren't given their own
+default_location_cache = LocationCache()
+
+
+#characters that can't be in a directory named after an id
+SHARD_KEY_UNSAFE_RE = re.compile(r'\W', re.UNICODE)
+
+
+class ModsDirLayout(object):
+    '''Where each MODS file goes in MODS_DIR.
+
+    With levels=0 (the default), all the files go straight into MODS_DIR.
+    Otherwise they're spread over that many levels of subdirectories, named
+    after the first characters (width per level) of a hash of the filename
+    (shard_by='hash'), or of the filename itself (shard_by='id' - characters
+    that aren't letters or digits are replaced with '_', so an id like
+    '../x' can't put the file outside the directory).'''
+
+    SHARD_BY = ['hash', 'id']
+
+    def __init__(self, levels=0, shard_by='hash', width=2):
+        if shard_by not in self.SHARD_BY:
+            raise Exception('unknown shard type: %s' % shard_by)
+        self.levels = levels
+        self.shard_by = shard_by
+        self.width = width
+
+    def shard_dirs(self, filename):
+        '''The subdirectories (outermost first) that filename goes in.'''
+        if not self.levels:
+            return []
+        length = self.levels * self.width
+        if self.shard_by == 'hash':
+            key = hashlib.md5(filename.encode('utf-8')).hexdigest()
+        else:
+            key = filename
+            if key.endswith(u'.mods'):
+                key = key[:-len(u'.mods')]
+            #short ids are padded, so every file is at the same depth
+            key = SHARD_KEY_UNSAFE_RE.sub(u'_', key[:length].ljust(length, u'_'))
+        return [key[i*self.width:(i+1)*self.width] for i in xrange(self.levels)]
+
+    def path(self, filename, directory=None):
+        '''Full path of filename in directory (MODS_DIR by default).'''
+        if directory is None:
+            directory = MODS_DIR
+        return os.path.join(directory, *(self.shard_dirs(filename) + [filename]))
+
+    def list_filenames(self, directory=None):
+        '''Get the filenames of all the files in directory, wherever they
+        are in the tree (so existing files are found even if they were
+        written with a different layout).'''
+        if directory is None:
+            directory = MODS_DIR
+        if not self.levels:
+            return os.listdir(directory)
+        filenames = []
+        for dirpath, dirnames, files in os.walk(directory):
+            filenames.extend(files)
+        return filenames
+
+
+#layout of MODS_DIR (flat, unless it's changed from the command line)
+mods_dir_layout = ModsDirLayout()
+
+
+def get_mods_path(filename):
+    '''Full path of a MODS filename in MODS_DIR.'''
+    return mods_dir_layout.path(filename)
+
+
+class ModsNameIndex(object):
+    '''In-memory index of the MODS filenames in use, so an unused filename
+    can be picked without checking the disk for each candidate.'''
+
+    def __init__(self, filenames=()):
+        self._used = set(filenames)
+        #base filename -> next _N suffix to try
+        self._next_suffix = {}
+
+    def __contains__(self, filename):
+        return filename in self._used
+
+    def __len__(self):
+        return len(self._used)
+
+    def add(self, filename):
+        self._used.add(filename)
+
+    def get_unused(self, base_filename):
+        '''Reserve & return base_filename.mods, or base_filename_N.mods with
+        the first N that's not in use.'''
+        filename = u'%s.mods' % base_filename
+        if filename in self._used:
+            ext = self._next_suffix.get(base_filename, 1)
+            filename = u'%s_%s.mods' % (base_filename, ext)
+            while filename in self._used:
+                ext += 1
+                filename = u'%s_%s.mods' % (base_filename, ext)
+            self._next_suffix[base_filename] = ext + 1
+        self._used.add(filename)
+        return filename
+
+
+def get_mods_filename(parent_id, mods_id=None, name_index=None):
     #use a mods id value if available
     #otherwise, take the id and loop until we get a filename that doesn't exist yet
     if mods_id:
         base_filename = mods_id
     else:
         base_filename = parent_id
-    filename = os.path.join(MODS_DIR, '%s.mods' % base_filename)
+    if name_index is not None:
+        #the index knows which names are taken, so we don't have to check the disk
+        return get_mods_path(name_index.get_unused(base_filename))
+    filename = get_mods_path(u'%s.mods' % base_filename)
     ext = 1
     while os.path.exists(filename):
-        filename = os.path.join(MODS_DIR, base_filename + u'_' 
-            + str(ext) + u'.mods')
+        filename = get_mods_path(base_filename + u'_' + str(ext) + u'.mods')
         ext += 1
     return filename
 
 
-def process(dataHandler, copy_parent_to_children=False):
-    '''Function to go through all the data and process it.'''
-    #get dicts of columns that should be mapped & where they go in MODS
-    index = 1
-    for record in dataHandler.get_mods_records():
-        filename = record.mods_filename
-        if os.path.exists(os.path.join(MODS_DIR, filename)):
-            raise Exception('%s already exists!' % filename)
-        logger.info('Processing row %d to %s.' % (index, filename))
-        if copy_parent_to_children:
-            #load parent mods object if desired (& it exists)
-            parent_filename = os.path.join(MODS_DIR, record.parent_mods_filename)
-            parent_mods = None
+def _load_parent_node(filename):
+    '''Parse a parent's MODS file (None if there isn't one) - we keep the
+    parsed XML, since copying that is much cheaper than parsing the file again.'''
+    parent_filename = get_mods_path(filename)
+    if os.path.exists(parent_filename):
+        return load_xmlobject_from_file(parent_filename, mods.Mods).node
+    return None
+
+
+class ParentModsCache(LRUCache):
+    '''Cache of parsed parent MODS files, keyed by the parent's filename
+    in MODS_DIR.
+
+    get() returns a new copy of the parent Mods object each time (or None if
+    there's no parent file), so a child can change its copy freely.'''
+
+    def __init__(self, maxsize=256):
+        super(ParentModsCache, self).__init__(_load_parent_node, maxsize)
+
+    def get(self, filename):
+        node = super(ParentModsCache, self).get(filename)
+        if node is None:
+            return None
+        return mods.Mods(copy.deepcopy(node))
+
+    def add(self, filename, mods_data):
+        '''Cache a parent's serialized MODS that was just generated, so its
+        children don't have to read the file back.'''
+        #parse the serialized data, so the children come out exactly the
+        #   same as if the parent had been loaded from its file
+        self._cache.pop(filename, None)
+        if len(self._cache) >= self.maxsize:
+            self._cache.popitem(last=False)
+        self._cache[filename] = etree.fromstring(mods_data)
+
+
+def build_mods(record, copy_parent_to_children=False, parent_cache=None, timings=None):
+    '''Map a record's data into a Mods object.
+
+    If parent_cache (a ParentModsCache) is passed in, the parent MODS is
+    loaded from there instead of from its file.
+    If timings is a list, ('map:<element>', seconds) is appended to it for
+    each field that's mapped.'''
+    parent_mods = None
+    if copy_parent_to_children:
+        #load parent mods object if desired (& it exists)
+        if parent_cache is not None:
+            parent_mods = parent_cache.get(record.parent_mods_filename)
+        else:
+            parent_filename = get_mods_path(record.parent_mods_filename)
             if os.path.exists(parent_filename):
                 parent_mods = load_xmlobject_from_file(parent_filename, mods.Mods)
-                mapper = Mapper(parent_mods=parent_mods)
-        else:
-            mapper = Mapper()
-        for field in record.field_data():
-            mapper.add_data(field['mods_path'], field['data'])
-        mods_obj = mapper.get_mods()
-        mods_data = unicode(mods_obj.serializeDocument(pretty=True), 'utf-8')
-        with codecs.open(os.path.join(MODS_DIR, filename), 'w', 'utf-8') as f:
+    mapper = Mapper(parent_mods=parent_mods)
+    if timings is not None:
+        for mods_path, data in record.fields():
+            element = default_location_cache.get(mods_path).base_element[u'element']
+            start = time.time()
+            mapper.add_data(mods_path, data)
+            timings.append((u'map:' + element, time.time() - start))
+        return mapper.get_mods()
+    for mods_path, data in record.fields():
+        mapper.add_data(mods_path, data)
+    return mapper.get_mods()
+
+
+def build_mods_data(record, copy_parent_to_children=False, parent_cache=None):
+    '''Map a record's data into a MODS object & return it serialized
+    (as UTF-8 bytes).'''
+    return build_mods(record, copy_parent_to_children, parent_cache).serializeDocument(pretty=True)
+
+
+def build_mods_direct(record, timings=None):
+    '''Like build_mods (without a parent), but with a DirectMapper - returns
+    the DirectMapper (its serialize() gives the MODS data).'''
+    mapper = DirectMapper()
+    if timings is not None:
+        for mods_path, data in record.fields():
+            element = default_location_cache.get(mods_path).base_element[u'element']
+            start = time.time()
+            mapper.add_data(mods_path, data)
+            timings.append((u'map:' + element, time.time() - start))
+        return mapper
+    for mods_path, data in record.fields():
+        mapper.add_data(mods_path, data)
+    return mapper
+
+
+def _build_record_direct(record, validator, timings=None):
+    '''_build_record with a DirectMapper.'''
+    if timings is None:
+        mapper = build_mods_direct(record)
+        errors = []
+        if validator is not None:
+            errors = validator.validate(mapper.node)
+        return (mapper.serialize(), errors)
+    start = time.time()
+    mapper = build_mods_direct(record, timings)
+    timings.append(('map', time.time() - start))
+    errors = []
+    if validator is not None:
+        start = time.time()
+        errors = validator.validate(mapper.node)
+        timings.append(('validate', time.time() - start))
+    start = time.time()
+    mods_data = mapper.serialize()
+    timings.append(('serialize', time.time() - start))
+    return (mods_data, errors)
+
+
+def _build_record(record, copy_parent_to_children, parent_cache, validator, timings=None, direct=False):
+    '''Build & serialize a record's MODS, validating the MODS tree first if
+    we have a validator. Returns (mods_data, list of validation errors).
+
+    If timings is a list, (stage, seconds) pairs are appended to it.
+    If direct is True, records without a parent are mapped with a
+    DirectMapper, if it supports all their locations.'''
+    if (direct and not copy_parent_to_children and
+            DirectMapper.supports(mods_path for mods_path, data in record.fields())):
+        return _build_record_direct(record, validator, timings)
+    if timings is None:
+        mods_obj = build_mods(record, copy_parent_to_children, parent_cache)
+        errors = []
+        if validator is not None:
+            errors = validator.validate(mods_obj.node)
+        return (mods_obj.serializeDocument(pretty=True), errors)
+    start = time.time()
+    mods_obj = build_mods(record, copy_parent_to_children, parent_cache, timings)
+    timings.append(('map', time.time() - start))
+    errors = []
+    if validator is not None:
+        start = time.time()
+        errors = validator.validate(mods_obj.node)
+        timings.append(('validate', time.time() - start))
+    start = time.time()
+    mods_data = mods_obj.serializeDocument(pretty=True)
+    timings.append(('serialize', time.time() - start))
+    return (mods_data, errors)
+
+
+#each worker process has its own parent cache & validator
+_worker_parent_cache = None
+_worker_validator = None
+_worker_direct = False
+
+
+def _init_worker(validate, direct=False):
+    global _worker_parent_cache, _worker_validator, _worker_direct
+    if async_log_sink is not None:
+        #the log thread wasn't copied into this process
+        async_log_sink.detach()
+    _worker_parent_cache = ParentModsCache()
+    _worker_direct = direct
+    if validate:
+        _worker_validator = ModsValidator()
+
+
+def _build_mods_data_worker(args):
+    '''Run _build_record in a worker process (args is a (record,
+    copy_parent_to_children, profile) tuple).
+
+    Returns the record, its MODS data, its validation errors, the
+    worker's (pid, hits, misses) parent cache stats, and the record's
+    timings (None unless profile is True).'''
+    record, copy_parent_to_children, profile = args
+    timings = [] if profile else None
+    mods_data, errors = _build_record(record, copy_parent_to_children, _worker_parent_cache, _worker_validator,
+                                      timings, _worker_direct)
+    cache_stats = (os.getpid(), _worker_parent_cache.hits, _worker_parent_cache.misses)
+    return (record, mods_data, errors, cache_stats, timings)
+
+
+def _build_group(parent, children, parent_cache, validator, profile=False, direct=False):
+    '''Build a parent record & its children (see attach_children). The
+    children get the parent's data copied in from memory instead of from
+    the parent's file - if parent is None, the children's parent is loaded
+    from MODS_DIR (if it's there), as usual.
+
+    Returns a list of (record, mods_data, errors, timings) tuples.'''
+    results = []
+    if parent is not None:
+        timings = [] if profile else None
+        mods_data, errors = _build_record(parent, False, parent_cache, validator, timings, direct)
+        if children:
+            parent_cache.add(parent.parent_mods_filename, mods_data)
+        results.append((parent, mods_data, errors, timings))
+    for record in children:
+        timings = [] if profile else None
+        mods_data, errors = _build_record(record, True, parent_cache, validator, timings)
+        results.append((record, mods_data, errors, timings))
+    return results
+
+
+def _build_group_worker(args):
+    '''Run _build_group in a worker process (args is a (parent, children,
+    profile) tuple). Returns a list of the same tuples as _build_mods_data_worker.'''
+    parent, children, profile = args
+    results = _build_group(parent, children, _worker_parent_cache, _worker_validator, profile, _worker_direct)
+    cache_stats = (os.getpid(), _worker_parent_cache.hits, _worker_parent_cache.misses)
+    return [(record, mods_data, errors, cache_stats, timings) for record, mods_data, errors, timings in results]
+
+
+class PipelineStats(object):
+    '''Counts & timings for the stages of process() (for --profile).
+
+    Every timing is kept, so the summary can give percentiles. Mapping is
+    also broken down by MODS element, in 'map:<element>' stages.'''
+
+    PERCENTILES = [50, 90, 99]
+
+    def __init__(self):
+        #stage -> list of seconds
+        self._timings = OrderedDict()
+
+    def add(self, stage, seconds):
+        try:
+            self._timings[stage].append(seconds)
+        except KeyError:
+            self._timings[stage] = [seconds]
+
+    def add_all(self, timings):
+        '''Add a list of (stage, seconds) pairs.'''
+        for stage, seconds in timings:
+            self.add(stage, seconds)
+
+    def timed(self, stage, iterable):
+        '''Yield the items of iterable, timing how long each one takes to get.'''
+        iterator = iter(iterable)
+        while True:
+            start = time.time()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            self.add(stage, time.time() - start)
+            yield item
+
+    def summary(self):
+        '''Get a dict of stage -> {'count', 'total', 'mean', 'max', 'p50', ...}
+        (times in seconds).'''
+        summary = OrderedDict()
+        for stage, timings in self._timings.items():
+            timings = sorted(timings)
+            count = len(timings)
+            total = sum(timings)
+            stage_summary = OrderedDict([('count', count), ('total', total),
+                                         ('mean', total / count), ('max', timings[-1])])
+            for percentile in self.PERCENTILES:
+                #nearest rank (percentile * count is exact, so the ceiling is too)
+                rank = int(math.ceil(percentile * count / 100.0)) - 1
+                stage_summary['p%d' % percentile] = timings[rank]
+            summary[stage] = stage_summary
+        return summary
+
+    def log_summary(self):
+        logger.info('%-40s %8s %10s %10s %10s %10s', 'Stage', 'count', 'total(s)', 'mean(ms)', 'p90(ms)', 'max(ms)')
+        for stage, stats in self.summary().items():
+            logger.info('%-40s %8d %10.3f %10.3f %10.3f %10.3f',
+                        stage, stats['count'], stats['total'], stats['mean'] * 1000,
+                        stats['p90'] * 1000, stats['max'] * 1000)
+
+    def dump_json(self, filename):
+        with open(filename, 'wb') as f:
+            json.dump(self.summary(), f, indent=2)
+
+
+def get_manifest_filename():
+    '''The manifest for incremental runs is kept next to MODS_DIR.'''
+    return os.path.normpath(MODS_DIR) + '.manifest.json'
+
+
+class Manifest(object):
+    '''Hashes of the records that were written to MODS_DIR, for incremental runs.
+
+    The manifest maps each MODS filename to a hash of the record it was
+    generated from (ids, data files, and each mods path & value - so both the
+    data & the control row mapping), plus OUTPUT_VERSION. A record is only
+    regenerated if its hash changed or its file is missing.
+    Parents & children can share a manifest (like they share MODS_DIR) - each
+    entry records which obj_type wrote it, and only entries of the current
+    obj_type can be orphans (obj_type is None when a run generates both).'''
+
+    def __init__(self, filename, obj_type='parent'):
+        self.filename = filename
+        self.obj_type = obj_type
+        #filename -> hash, & filename -> obj_type
+        self.hashes = {}
+        self.obj_types = {}
+        if os.path.exists(filename):
+            with open(filename, 'rb') as f:
+                for mods_filename, entry in json.load(f)['records'].items():
+                    self.hashes[mods_filename] = entry['hash']
+                    self.obj_types[mods_filename] = entry['type']
+        self.skipped = 0
+        #filenames of the records seen/written in this run
+        self.seen = set()
+        self.written = set()
+        #filenames that more than one record maps to
+        self.duplicates = set()
+        #filename -> new hash of records that are being regenerated
+        self._pending = {}
+        #filename -> obj_type of the records being regenerated, if it's
+        #   not self.obj_type
+        self._pending_types = {}
+
+    def record_hash(self, record, copy_parent_to_children=False, parent_hash=None):
+        if copy_parent_to_children and parent_hash is None:
+            #a child has to be regenerated if its parent changed
+            parent_hash = self.hashes.get(record.parent_mods_filename)
+        content = [OUTPUT_VERSION, record.id, record.mods_id, record.data_files,
+                   record.fields(),
+                   parent_hash]
+        return hashlib.sha1(json.dumps(content)).hexdigest()
+
+    def filter_changed(self, records, copy_parent_to_children=False, exists=None):
+        '''Yield the records that need to be (re)generated, skipping the
+        unchanged ones. exists(filename) says whether a file is in MODS_DIR.'''
+        if exists is None:
+            exists = lambda filename: os.path.exists(get_mods_path(filename))
+        for record in records:
+            filename = record.mods_filename
+            if filename in self.seen:
+                self.duplicates.add(filename)
+                yield record
+                continue
+            self.seen.add(filename)
+            digest = self.record_hash(record, copy_parent_to_children)
+            if self.hashes.get(filename) == digest and exists(filename):
+                self.skipped += 1
+                continue
+            self._pending[filename] = digest
+            yield record
+
+    def filter_changed_groups(self, groups, exists=None):
+        '''Like filter_changed, for (parent, children) groups that are built
+        together (see _build_group) - a whole group is regenerated if any of
+        its records changed, since the children are built from the parent.'''
+        if exists is None:
+            exists = lambda filename: os.path.exists(get_mods_path(filename))
+        for parent, children in groups:
+            changed = False
+            digests = {}
+            types = {}
+            parent_hash = None
+            if parent is not None:
+                #the children's hashes include the new hash of the parent
+                parent_hash = self.record_hash(parent)
+                records = [(parent, parent_hash, 'parent')]
+            else:
+                records = []
+            for record in children:
+                records.append((record, self.record_hash(record, True, parent_hash), 'child'))
+            for record, digest, obj_type in records:
+                filename = record.mods_filename
+                if filename in self.seen:
+                    self.duplicates.add(filename)
+                    changed = True
+                    continue
+                self.seen.add(filename)
+                if self.hashes.get(filename) != digest or not exists(filename):
+                    changed = True
+                digests[filename] = digest
+                types[filename] = obj_type
+            if not changed:
+                self.skipped += len(records)
+                continue
+            self._pending.update(digests)
+            self._pending_types.update(types)
+            yield (parent, children)
+
+    def can_overwrite(self, filename):
+        '''An existing file can only be overwritten if it was generated by an
+        earlier run (and not already in this one).'''
+        return (filename in self.hashes and filename not in self.written and
+                filename not in self.duplicates)
+
+    def mark_written(self, filename):
+        self.hashes[filename] = self._pending.pop(filename)
+        self.obj_types[filename] = self._pending_types.pop(filename, self.obj_type)
+        self.written.add(filename)
+
+    def orphans(self):
+        '''Filenames in the manifest (from this obj_type, or any if it's None)
+        that no record in this run maps to.'''
+        return sorted(filename for filename in self.hashes
+                      if filename not in self.seen and self.obj_type in (None, self.obj_types[filename]))
+
+    def remove_orphans(self):
+        '''Delete the orphaned files, & drop them from the manifest.'''
+        orphans = self.orphans()
+        for filename in orphans:
+            path = get_mods_path(filename)
+            if os.path.exists(path):
+                os.remove(path)
+            del self.hashes[filename]
+            del self.obj_types[filename]
+        return orphans
+
+    def save(self):
+        #write a temporary file first, so an interrupted save doesn't
+        #   lose the old manifest
+        tmp_filename = self.filename + '.tmp'
+        with open(tmp_filename, 'wb') as f:
+            records = dict((filename, {'hash': digest, 'type': self.obj_types[filename]})
+                           for filename, digest in self.hashes.items())
+            json.dump({'records': records}, f, indent=0, sort_keys=True)
+        os.rename(tmp_filename, self.filename)
+
+
+class ModsDirWriter(object):
+    '''Write serialized MODS records to files in a directory (MODS_DIR by default).
+
+    The directory is listed once, when the writer is created, so checking
+    whether a file exists doesn't have to hit the disk. If background is
+    True, the files are written by a separate thread, in batches of
+    batch_size, so serializing the next records overlaps with the disk I/O.
+    Call close() when done - it waits for the writes to finish, and raises
+    any error from the writer thread.
+    The files are put in subdirectories according to layout (a ModsDirLayout -
+    by default, mods_dir_layout).'''
+
+    def __init__(self, directory=None, background=False, batch_size=64, layout=None):
+        if directory is None:
+            directory = MODS_DIR
+        if layout is None:
+            layout = mods_dir_layout
+        self.directory = directory
+        self.layout = layout
+        self.names = ModsNameIndex(layout.list_filenames(directory))
+        #subdirectories we know exist
+        self._dirs = set()
+        self._batch_size = batch_size
+        self._batch = []
+        self._thread = None
+        self._error = None
+        if background:
+            #bounded, so we don't get too far ahead of the disk
+            self._queue = Queue.Queue(maxsize=8)
+            self._thread = threading.Thread(target=self._write_batches, name='ModsDirWriter')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def exists(self, filename):
+        return filename in self.names
+
+    def write(self, record, mods_data):
+        '''Write the mods_data bytes for record.'''
+        filename = record.mods_filename
+        self.names.add(filename)
+        if self._thread is None:
+            self._write_file(filename, mods_data)
+            return
+        if self._error:
+            raise self._error
+        self._batch.append((filename, mods_data))
+        if len(self._batch) >= self._batch_size:
+            self._queue.put(self._batch)
+            self._batch = []
+
+    def close(self):
+        if self._thread is not None:
+            if self._batch:
+                self._queue.put(self._batch)
+                self._batch = []
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+        if self._error:
+            raise self._error
+
+    def abort(self):
+        '''Finish writing what was queued, without raising errors.'''
+        try:
+            self.close()
+        except Exception:
+            pass
+
+    def _write_file(self, filename, mods_data):
+        path = self.layout.path(filename, self.directory)
+        dirname = os.path.dirname(path)
+        if dirname not in self._dirs:
+            if not os.path.isdir(dirname):
+                os.makedirs(dirname)
+            self._dirs.add(dirname)
+        with open(path, 'wb') as f:
             f.write(mods_data)
-        index = index + 1
+
+    def _write_batches(self):
+        while True:
+            batch = self._queue.get()
+            if batch is None:
+                return
+            if self._error:
+                #keep draining the queue, so write() doesn't block
+                continue
+            for filename, mods_data in batch:
+                try:
+                    self._write_file(filename, mods_data)
+                except Exception as e:
+                    self._error = e
+                    #don't leave a partial file behind
+                    try:
+                        os.remove(self.layout.path(filename, self.directory))
+                    except OSError:
+                        pass
+                    break
+
+
+class ModsArchiveWriter(object):
+    '''Write serialized MODS records into a single tar (optionally gzipped)
+    or zip archive, with the same filenames they'd have in MODS_DIR.
+
+    filename can be '-' to stream a tar archive to stdout (zip files can't be
+    streamed). format is 'tar', 'tar.gz' or 'zip' - by default it's worked out
+    from the filename's extension (see guess_output_format).'''
+
+    FORMATS = ['tar', 'tar.gz', 'zip']
+
+    def __init__(self, filename, format=None):
+        if format is None:
+            format = guess_output_format(filename)
+        if format not in self.FORMATS:
+            raise Exception('unknown archive format: %s' % format)
+        self.filename = filename
+        self.format = format
+        self._names = set()
+        self._zip = self._tar = None
+        if format == 'zip':
+            if filename == '-':
+                raise Exception("zip archives can't be written to stdout")
+            self._zip = zipfile.ZipFile(filename, 'w', zipfile.ZIP_DEFLATED, allowZip64=True)
+        else:
+            compression = 'gz' if format == 'tar.gz' else ''
+            if filename == '-':
+                #stream mode, since stdout isn't seekable
+                self._tar = tarfile.open(mode='w|' + compression, fileobj=sys.stdout)
+            else:
+                self._tar = tarfile.open(filename, 'w:' + compression)
+
+    def exists(self, filename):
+        '''Whether filename has already been written to the archive.'''
+        return filename in self._names
+
+    def write(self, record, mods_data):
+        filename = record.mods_filename
+        self._names.add(filename)
+        #archive member names are bytes
+        name = filename.encode('utf-8')
+        if self._zip:
+            info = zipfile.ZipInfo(name, time.localtime()[:6])
+            info.compress_type = zipfile.ZIP_DEFLATED
+            info.external_attr = 0644 << 16
+            self._zip.writestr(info, mods_data)
+        else:
+            info = tarfile.TarInfo(name)
+            info.size = len(mods_data)
+            info.mtime = time.time()
+            info.mode = 0644
+            self._tar.addfile(info, io.BytesIO(mods_data))
+
+    def close(self):
+        if self._zip:
+            self._zip.close()
+        elif self._tar:
+            self._tar.close()
+        self._zip = self._tar = None
+
+    def abort(self):
+        try:
+            self.close()
+        except Exception:
+            pass
+
+
+class ModsJsonLinesWriter(object):
+    '''Write serialized MODS records as JSON Lines - one JSON object per
+    record, like {"id": ..., "mods_id": ..., "data_files": [...], "mods_xml": "..."}.
+
+    filename can be '-' for stdout. The lines are written & flushed in
+    batches of batch_size records, so a consumer on the other end of a
+    pipe gets them steadily.'''
+
+    def __init__(self, filename, batch_size=100):
+        self.filename = filename
+        if filename == '-':
+            self._file = sys.stdout
+        else:
+            self._file = open(filename, 'wb')
+        self._batch_size = batch_size
+        self._batch = []
+        self._names = set()
+
+    def exists(self, filename):
+        '''Whether a record with this filename has already been written.'''
+        return filename in self._names
+
+    def write(self, record, mods_data):
+        self._names.add(record.mods_filename)
+        line = OrderedDict([('id', record.id),
+                            ('mods_id', record.mods_id),
+                            ('data_files', record.data_files),
+                            ('mods_xml', unicode(mods_data, 'utf-8'))])
+        #ascii output, so the lines are the same whatever encoding the
+        #   consumer assumes
+        self._batch.append(json.dumps(line))
+        if len(self._batch) >= self._batch_size:
+            self._flush()
+
+    def _flush(self):
+        if self._batch:
+            self._file.write('\n'.join(self._batch) + '\n')
+            self._batch = []
+        self._file.flush()
+
+    def close(self):
+        if self._file is None:
+            return
+        self._flush()
+        if self._file is not sys.stdout:
+            self._file.close()
+        self._file = None
+
+    def abort(self):
+        try:
+            self.close()
+        except Exception:
+            pass
+
+
+#formats for make_output_writer
+OUTPUT_FORMATS = ModsArchiveWriter.FORMATS + ['jsonl']
+
+
+def guess_output_format(filename):
+    '''Work out the output format from a filename's extension (tar by default).'''
+    if filename.endswith('.zip'):
+        return 'zip'
+    elif filename.endswith('.tar.gz') or filename.endswith('.tgz'):
+        return 'tar.gz'
+    elif filename.endswith('.jsonl') or filename.endswith('.ndjson'):
+        return 'jsonl'
+    return 'tar'
+
+
+def make_output_writer(filename, format=None):
+    '''Get a writer for process() that writes all the records to one output
+    file (or stdout, if filename is '-').'''
+    if format is None:
+        format = guess_output_format(filename)
+    if format == 'jsonl':
+        return ModsJsonLinesWriter(filename)
+    return ModsArchiveWriter(filename, format)
+
+
+class ProgressReporter(object):
+    '''Log the number of records processed, the rate & the ETA (if we know
+    the total) every interval seconds, instead of a line per record.'''
+
+    def __init__(self, total=None, interval=PROGRESS_INTERVAL):
+        self.total = total
+        self.interval = interval
+        self.count = 0
+        self.start_time = time.time()
+        self._next_report = self.start_time + interval
+
+    def update(self, count=1):
+        self.count += count
+        now = time.time()
+        if now >= self._next_report:
+            self.report(now)
+            self._next_report = now + self.interval
+
+    def report(self, now=None):
+        if now is None:
+            now = time.time()
+        elapsed = now - self.start_time
+        rate = self.count / elapsed if elapsed else 0.0
+        if self.total and rate:
+            eta = datetime.timedelta(seconds=int((self.total - self.count) / rate))
+            logger.info('Processed %d of %d records (%.1f%%, %.1f records/sec, ETA %s).',
+                        self.count, self.total, 100.0 * self.count / self.total, rate, eta)
+        else:
+            logger.info('Processed %d records (%.1f records/sec).', self.count, rate)
+
+
+def process(dataHandler, copy_parent_to_children=False, workers=1, validate=False,
+            incremental=False, remove_orphans=False, writer=None, stats=None, verbose=False,
+            group_by_id=False, children=None, direct=False, pool=None, close_writer=True):
+    '''Function to go through all the data and process it.
+
+    If workers is more than 1, the records are mapped & serialized in a pool
+    of that many processes. The files are still written (& logged) by this
+    process, in the same order as the data rows.
+    If validate is True, each MODS tree is validated against the MODS schema
+    before it's written, and the failures are logged. Returns the number of
+    invalid records.
+    If incremental is True, only the records that are new or changed since
+    the last incremental run are generated (see Manifest), & existing files
+    from earlier runs are overwritten. If remove_orphans is also True, files
+    from earlier runs that no record maps to any more are deleted.
+    The files are written by writer (by default, a ModsDirWriter for MODS_DIR -
+    see make_output_writer for the others). Incremental runs need a ModsDirWriter.
+    If stats (a PipelineStats) is passed in, the time spent in each stage
+    is recorded in it.
+    Progress is logged every PROGRESS_INTERVAL seconds - if verbose is True,
+    each record is logged as well. Repeated data warnings are summarized
+    at the end (see WarningCounter).
+    If group_by_id is True, the rows of a parent sheet are grouped by id
+    (see group_records): the first row for each id is the parent, & the
+    other rows are its children, which get the parent's data copied in from
+    memory - so parents & children are generated in one run. The groups are
+    written in the order their ids first appear.
+    children can be a DataHandler for the child records of dataHandler's
+    parents (eg. another sheet of the same workbook). Each parent is written
+    followed by its children, which get the parent's data copied in from
+    memory, like group_by_id.
+    If direct is True, the records without a parent are mapped with a
+    DirectMapper (where it supports the control row), which is faster than
+    building the eulxml objects & gives the same output.
+    pool can be a multiprocessing.Pool (started with _init_worker) to use
+    instead of starting one for this run - it's left running, for the next
+    run. If close_writer is False, the writer is left open as well (see
+    process_batch).'''
+    grouped = group_by_id or children is not None
+    if grouped and dataHandler.obj_type != 'parent':
+        raise Exception('the parents & children can only be generated together from parent records')
+    if children is not None and children.obj_type != 'child':
+        raise Exception('the children have to be child records')
+    if group_by_id and children is not None:
+        raise Exception("can't group by id when the children are in a separate sheet")
+    #the text date cache stays warm between runs, so its stats are counted from here
+    date_cache_hits, date_cache_misses = text_date_cache.hits, text_date_cache.misses
+    #get dicts of columns that should be mapped & where they go in MODS
+    # and parse all the locations once, up front
+    start_time = time.time()
+    default_location_cache.warm(dataHandler.get_cols_to_map().values())
+    if children is not None:
+        default_location_cache.warm(children.get_cols_to_map().values())
+    if direct:
+        #say which columns are mapped with eulxml, instead of quietly falling back
+        for mods_loc in sorted(set(dataHandler.get_cols_to_map().values())):
+            if compiled_location_cache.get(mods_loc) is None:
+                logger.warning(u"the lxml engine can't map %s (%s) - records with it are mapped with eulxml",
+                               default_location_cache.get(mods_loc).base_element[u'element'], mods_loc)
+    if stats is not None:
+        stats.add('parse_locations', time.time() - start_time)
+    start_time = time.time()
+    if grouped:
+        if group_by_id:
+            groups = [(records[0], records[1:]) for rec_id, records in dataHandler.get_record_groups()]
+        else:
+            groups = attach_children(dataHandler.get_mods_records(), children.get_record_groups())
+        total = None
+        if not incremental:
+            total = sum(len(records) + (parent is not None) for parent, records in groups)
+    else:
+        records = dataHandler.get_mods_records()
+        total = None
+        if isinstance(records, list) and not incremental:
+            total = len(records)
+    progress = ProgressReporter(total)
+    if stats is not None:
+        stats.add('load', time.time() - start_time)
+        if grouped:
+            groups = stats.timed('read', groups)
+        else:
+            records = stats.timed('read', records)
+    if writer is None:
+        writer = ModsDirWriter()
+    if incremental and not isinstance(writer, ModsDirWriter):
+        raise Exception('incremental runs only work when writing to a directory')
+    manifest = None
+    if incremental:
+        manifest = Manifest(get_manifest_filename(), None if grouped else dataHandler.obj_type)
+        if grouped:
+            groups = manifest.filter_changed_groups(groups, writer.exists)
+        else:
+            records = manifest.filter_changed(records, copy_parent_to_children, writer.exists)
+    parent_cache = ParentModsCache()
+    #(hits, misses) of the parent cache in each worker process
+    worker_cache_stats = {}
+    #list of (filename, errors) for records that failed validation
+    invalid = []
+    #only close the pool if we started it
+    own_pool = pool is None
+    if workers > 1:
+        #the records are independent of each other, so we can build them in
+        #   any process - imap hands the results back in order
+        if own_pool:
+            pool = multiprocessing.Pool(workers, _init_worker, (validate, direct))
+        if grouped:
+            #the children need their parent, so each group is built in one process
+            group_results = pool.imap(_build_group_worker,
+                                      ((parent, records, stats is not None) for parent, records in groups),
+                                      WORKER_CHUNKSIZE)
+            results = (result for group_result in group_results for result in group_result)
+        else:
+            results = pool.imap(_build_mods_data_worker,
+                                ((record, copy_parent_to_children, stats is not None) for record in records),
+                                WORKER_CHUNKSIZE)
+    else:
+        validator = ModsValidator() if validate else None
+        if grouped:
+            results = ((record, mods_data, errors, None, timings)
+                       for parent, records in groups
+                       for record, mods_data, errors, timings in
+                           _build_group(parent, records, parent_cache, validator, stats is not None, direct))
+        else:
+            results = ((record, None, None, None, None) for record in records)
+    index = 1
+    try:
+        for record, mods_data, errors, cache_stats, timings in results:
+            filename = record.mods_filename
+            if writer.exists(filename):
+                if manifest is None or not manifest.can_overwrite(filename):
+                    raise Exception('%s already exists!' % filename)
+            if verbose:
+                logger.info('Processing row %d to %s.', index, filename)
+            if mods_data is None:
+                timings = [] if stats is not None else None
+                mods_data, errors = _build_record(record, copy_parent_to_children, parent_cache, validator,
+                                                  timings, direct)
+            elif cache_stats is not None:
+                worker_cache_stats[cache_stats[0]] = cache_stats[1:]
+            if errors:
+                invalid.append((filename, errors))
+                logger.error('%s is not valid MODS: %s', filename, u'; '.join(errors))
+            if stats is None:
+                writer.write(record, mods_data)
+            else:
+                stats.add_all(timings)
+                write_start = time.time()
+                writer.write(record, mods_data)
+                stats.add('write', time.time() - write_start)
+            if manifest:
+                manifest.mark_written(filename)
+            index = index + 1
+            progress.update()
+    except:
+        if pool and own_pool:
+            pool.terminate()
+        writer.abort()
+        if manifest:
+            #keep track of the files that did get written
+            manifest.save()
+        raise
+    if pool and own_pool:
+        pool.close()
+        pool.join()
+    try:
+        if close_writer:
+            close_start = time.time()
+            writer.close()
+            if stats is not None:
+                stats.add('close', time.time() - close_start)
+    except:
+        if manifest:
+            manifest.save()
+        raise
+    if manifest:
+        orphans = manifest.orphans()
+        if remove_orphans:
+            manifest.remove_orphans()
+            for filename in orphans:
+                logger.info('Removed orphaned file %s.', filename)
+        manifest.save()
+        logger.info('Incremental run: %d written, %d unchanged & skipped, %d orphaned%s.',
+                    len(manifest.written), manifest.skipped, len(orphans),
+                    ' (removed)' if remove_orphans and orphans else '')
+    elapsed = time.time() - start_time
+    num_records = index - 1
+    logger.info('Wrote %d MODS files in %.2f seconds (%.1f records/sec, %d worker(s)).',
+                num_records, elapsed, num_records / elapsed if elapsed else 0.0, workers)
+    warning_counter.log_summary()
+    warning_counter.clear()
+    date_cache_hits = text_date_cache.hits - date_cache_hits
+    date_cache_misses = text_date_cache.misses - date_cache_misses
+    if date_cache_hits or date_cache_misses:
+        logger.info('Text date cache: %d hits, %d misses (%.1f%% hit rate).', date_cache_hits, date_cache_misses,
+                    100.0 * date_cache_hits / (date_cache_hits + date_cache_misses))
+    if copy_parent_to_children or grouped:
+        hits = parent_cache.hits + sum(cache_stats[0] for cache_stats in worker_cache_stats.values())
+        misses = parent_cache.misses + sum(cache_stats[1] for cache_stats in worker_cache_stats.values())
+        logger.info('Parent MODS cache: %d hits, %d misses.', hits, misses)
+    if validate:
+        logger.info('Validation: %d valid, %d invalid.', num_records - len(invalid), len(invalid))
+        for filename, errors in invalid:
+            logger.info('    %s (%d errors)', filename, len(errors))
+    if stats is not None:
+        stats.log_summary()
+    return len(invalid)
+
+
+#a batch input with a sheet number, like data.xls:2
+INPUT_SHEET_RE = re.compile(r'^(.+):(\d+)$')
+
+
+def expand_inputs(specs, sheet=1):
+    '''Expand batch input specs into a list of (filename, sheet number)
+    tuples. A spec can be a filename, a glob pattern (the matching files are
+    sorted), or either of those followed by :<sheet number> - otherwise the
+    sheet number is sheet.'''
+    inputs = []
+    for spec in specs:
+        spec_sheet = sheet
+        match = INPUT_SHEET_RE.match(spec)
+        if match and not os.path.exists(spec):
+            spec, spec_sheet = match.group(1), int(match.group(2))
+        if glob.has_magic(spec):
+            filenames = sorted(glob.glob(spec))
+            if not filenames:
+                raise Exception('no files match %s' % spec)
+        else:
+            filenames = [spec]
+        inputs.extend((filename, spec_sheet) for filename in filenames)
+    return inputs
+
+
+def process_batch(inputs, inputEncoding='utf-8', ctrlRow=2, forceDates=False, obj_type='parent', streaming=False,
+                  copy_parent_to_children=False, workers=1, validate=False, incremental=False, writer=None,
+                  stats=None, verbose=False, group_by_id=False, direct=False):
+    '''Process several inputs in one run - inputs is a list of (filename,
+    sheet number) tuples (see expand_inputs).
+
+    Each input is processed like process() does, but they all share one
+    worker pool & one writer, and the location, text date & compiled
+    location caches stay warm from one input to the next (in the worker
+    processes too). Each workbook is only opened once, with the inputs for
+    its sheets processed together (in the order the workbook first shows up
+    in inputs) - .xls sheets are loaded on demand & unloaded when they've
+    been processed, & streamed .xlsx sheets share the open zip file.
+    Returns the total number of invalid records.
+    Incremental runs share the manifest, so each run's orphan count includes
+    the other inputs' files - that's why there's no remove_orphans here.'''
+    #filename -> list of sheet numbers
+    files = OrderedDict()
+    for filename, sheet in inputs:
+        files.setdefault(filename, []).append(sheet)
+    if writer is None:
+        writer = ModsDirWriter()
+    pool = None
+    if workers > 1:
+        pool = multiprocessing.Pool(workers, _init_worker, (validate, direct))
+    start_time = time.time()
+    num_invalid = 0
+    input_num = 0
+    try:
+        for filename, sheets in files.items():
+            #the DataHandler that opened the workbook - the others share it
+            owner = None
+            try:
+                for sheet in sheets:
+                    input_num += 1
+                    logger.info('Processing %s, sheet %d (input %d of %d).', filename, sheet, input_num, len(inputs))
+                    book = None if owner is None else owner.book
+                    dataHandler = DataHandler(filename, inputEncoding, sheet, ctrlRow, forceDates, obj_type,
+                                              streaming=streaming, book=book)
+                    if owner is None:
+                        owner = dataHandler
+                    try:
+                        num_invalid += process(dataHandler, copy_parent_to_children, workers, validate, incremental,
+                                               False, writer, stats, verbose, group_by_id, None, direct,
+                                               pool=pool, close_writer=False)
+                    finally:
+                        if dataHandler is not owner:
+                            dataHandler.close()
+                    book = dataHandler.book
+                    if isinstance(book, xlrd.Book) and book.on_demand:
+                        book.unload_sheet(sheet - 1)
+            finally:
+                if owner is not None:
+                    owner.close()
+    except:
+        if pool:
+            pool.terminate()
+        writer.abort()
+        raise
+    if pool:
+        pool.close()
+        pool.join()
+    writer.close()
+    logger.info('Processed %d inputs from %d files in %.2f seconds.', len(inputs), len(files),
+                time.time() - start_time)
+    return num_invalid
 
 
 if __name__ == '__main__':
@@ -909,27 +3212,154 @@ if __name__ == '__main__':
     parser.add_option('--copy-parent-to-children',
                     action='store_true', dest='copy_parent_to_children', default=False,
                     help='copy parent data into children')
+    parser.add_option('--group-by-id',
+                    action='store_true', dest='group_by_id', default=False,
+                    help='treat the first row for each id as the parent & the other rows as its children (with the parent data copied in), so both are generated in one run')
+    parser.add_option('--children',
+                    action='store', dest='children', default=None,
+                    help='file with the child records, to generate them in the same run as the parents (with the parent data copied in)')
+    parser.add_option('--child-sheet',
+                    action='store', dest='child_sheet', default=None,
+                    help='sheet number of the child records (in the --children file, or the same workbook if there is no --children) - Excel files only')
     parser.add_option('-s', '--sheet',
                     action='store', dest='sheet', default=1,
                     help='specify the sheet number (starting at 1) in an Excel spreadsheet')
+    parser.add_option('-b', '--batch',
+                    action='store_true', dest='batch', default=False,
+                    help='process all the arguments in one run - each one can be a file, a glob pattern, or either of those followed by :<sheet number> (the default sheet is --sheet)')
     parser.add_option('-r', '--ctrl_row',
                     action='store', dest='row', default=2,
                     help='specify the control row number (starting at 1) in an Excel spreadsheet')
     parser.add_option('-i', '--input-encoding',
                     action='store', dest='in_enc', default='utf-8',
-                    help='specify the input encoding for CSV files (default is UTF-8)')
+                    help='specify the input encoding for CSV files (default is UTF-8 - a byte order mark overrides it)')
+    parser.add_option('--stream',
+                    action='store_true', dest='stream', default=False,
+                    help='read CSV & .xlsx data rows as they are processed, instead of loading the whole file first')
+    parser.add_option('-w', '--workers',
+                    action='store', dest='workers', type='int', default=1,
+                    help='number of processes to generate MODS with (default is 1)')
+    parser.add_option('--validate',
+                    action='store_true', dest='validate', default=False,
+                    help='validate each record against the MODS schema before writing it')
+    parser.add_option('--incremental',
+                    action='store_true', dest='incremental', default=False,
+                    help='only regenerate the records that changed since the last incremental run')
+    parser.add_option('--remove-orphans',
+                    action='store_true', dest='remove_orphans', default=False,
+                    help='with --incremental, delete files from earlier runs that no record maps to any more')
+    parser.add_option('--engine',
+                    action='store', dest='engine', default='eulxml', choices=['eulxml', 'lxml'],
+                    help='build the MODS with the bdrxml/eulxml objects (eulxml, the default), or straight into lxml (lxml - faster, for the elements it supports; records copied from a parent always use eulxml)')
+    parser.add_option('--writer-thread',
+                    action='store_true', dest='writer_thread', default=False,
+                    help='write the files in a separate thread, while the next records are generated')
+    parser.add_option('-o', '--output',
+                    action='store', dest='output', default=None,
+                    help="write all the records into one file instead of %s - an archive (.tar, .tar.gz, .tgz or .zip) or JSON Lines (.jsonl or .ndjson) - or '-' for stdout" % MODS_DIR)
+    parser.add_option('--output-format',
+                    action='store', dest='output_format', default=None, choices=OUTPUT_FORMATS,
+                    help='format for --output (tar, tar.gz, zip or jsonl - default is based on the filename, or tar for stdout)')
+    parser.add_option('--shard-levels',
+                    action='store', dest='shard_levels', type='int', default=0,
+                    help='spread the files in %s over this many levels of subdirectories (default is 0 - use the same value for parents & children)' % MODS_DIR)
+    parser.add_option('--shard-by',
+                    action='store', dest='shard_by', default='hash', choices=ModsDirLayout.SHARD_BY,
+                    help='name the subdirectories after a hash of the filename (hash, the default) or the start of the id (id)')
+    parser.add_option('--profile',
+                    action='store_true', dest='profile', default=False,
+                    help='log how long each stage (& each MODS element) took')
+    parser.add_option('--stats-json',
+                    action='store', dest='stats_json', default=None,
+                    help='write the --profile timings to this file, as JSON (implies --profile)')
+    parser.add_option('--cprofile',
+                    action='store', dest='cprofile', default=None,
+                    help='run the main process under cProfile, & save the stats to this file (for pstats)')
+    parser.add_option('-v', '--verbose',
+                    action='store_true', dest='verbose', default=False,
+                    help='log each record as it is written (by default, just the progress is logged)')
+    parser.add_option('--async-log',
+                    action='store_true', dest='async_log', default=False,
+                    help='write the log from a separate thread')
     (options, args) = parser.parse_args()
-    #make sure we have a directory to put the mods files in
+    mods_dir_layout = ModsDirLayout(options.shard_levels, options.shard_by)
+    if options.group_by_id and options.type != 'parent':
+        parser.error('--group-by-id only works for parent records')
+    if (options.children or options.child_sheet) and options.type != 'parent':
+        parser.error('--children & --child-sheet only work for parent records')
+    if options.group_by_id and (options.children or options.child_sheet):
+        parser.error("--group-by-id doesn't work with --children or --child-sheet")
+    if options.batch and (options.children or options.child_sheet or options.remove_orphans):
+        parser.error("--batch doesn't work with --children, --child-sheet or --remove-orphans")
+    if options.remove_orphans and not options.incremental:
+        parser.error('--remove-orphans only works with --incremental')
+    if options.output and (options.incremental or options.writer_thread):
+        parser.error('--incremental & --writer-thread only work when writing to %s' % MODS_DIR)
+    if options.output:
+        writer = make_output_writer(options.output, options.output_format)
+    else:
+        #make sure we have a directory to put the mods files in
+        try:
+            os.makedirs(MODS_DIR)
+        except OSError as err:
+            if os.path.isdir(MODS_DIR):
+                pass
+            else:
+                #dir creation error - re-raise it
+                raise
+        writer = ModsDirWriter(background=options.writer_thread)
+    #set up data handler & process data (& close the handlers when we're done, to release
+    #   the workbooks)
+    dataHandler = None
+    childDataHandler = None
     try:
-        os.makedirs(MODS_DIR)
-    except OSError as err:
-        if os.path.isdir(MODS_DIR):
-            pass
+        if options.batch:
+            try:
+                inputs = expand_inputs(args, int(options.sheet))
+            except Exception as e:
+                parser.error(str(e))
         else:
-            #dir creation error - re-raise it
-            raise
-    #set up data handler & process data
-    dataHandler = DataHandler(args[0], options.in_enc, int(options.sheet), int(options.row), options.force_dates, options.type)
-    process(dataHandler, options.copy_parent_to_children)
+            dataHandler = DataHandler(args[0], options.in_enc, int(options.sheet), int(options.row), options.force_dates, options.type,
+                                      streaming=options.stream)
+            if options.children or options.child_sheet:
+                #the child sheet can be in the same workbook
+                book = None if options.children else dataHandler.book
+                childDataHandler = DataHandler(options.children or args[0], options.in_enc, int(options.child_sheet or 1),
+                                               int(options.row), options.force_dates, 'child',
+                                               streaming=options.stream, book=book)
+                if options.child_sheet and childDataHandler.dataType == 'csv':
+                    parser.error("--child-sheet only works for Excel files - %s is a CSV file" %
+                                 (options.children or args[0]))
+        if options.async_log:
+            async_log_sink = AsyncLogSink(logger)
+            async_log_sink.start()
+        stats = None
+        if options.profile or options.stats_json:
+            stats = PipelineStats()
+        profiler = None
+        if options.cprofile:
+            profiler = cProfile.Profile()
+            profiler.enable()
+        try:
+            if options.batch:
+                process_batch(inputs, options.in_enc, int(options.row), options.force_dates, options.type, options.stream,
+                              options.copy_parent_to_children, options.workers, options.validate, options.incremental,
+                              writer, stats, options.verbose, options.group_by_id, options.engine == 'lxml')
+            else:
+                process(dataHandler, options.copy_parent_to_children, options.workers, options.validate,
+                        options.incremental, options.remove_orphans, writer, stats, options.verbose,
+                        options.group_by_id, childDataHandler, options.engine == 'lxml')
+        finally:
+            if profiler:
+                profiler.disable()
+                profiler.dump_stats(options.cprofile)
+            if async_log_sink:
+                async_log_sink.stop()
+    finally:
+        for handler in (childDataHandler, dataHandler):
+            if handler is not None:
+                handler.close()
+    if options.stats_json:
+        stats.dump_json(options.stats_json)
     sys.exit()
 
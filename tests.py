@@ -1,10 +1,24 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 import unittest
+import codecs
+import io
+import json
+import logging
 import os
+import pickle
+import shutil
+import sys
+import tarfile
+import tempfile
+import zipfile
 
-from generate_mods import LocationParser, DataHandler, Mapper, process_text_date
+import generate_mods
+from generate_mods import LocationParser, LocationCache, DataHandler, MappingPlan, Mapper, process_text_date
+from validate import ModsValidator
+from bdrxml import mods
 from bdrxml.mods import Mods
+from lxml import etree
 
 class TestLocationParser(unittest.TestCase):
 
@@ -85,6 +99,46 @@ class TestLocationParser(unittest.TestCase):
         #if we got here, no Exception was raised, so fail the test
         self.fail('Did not raise Exception on bad input!')
 
+class TestLocationCache(unittest.TestCase):
+
+    def test_cache(self):
+        cache = LocationCache(maxsize=2)
+        loc = u'<mods:name type="personal"><mods:namePart>#<mods:role><mods:roleTerm type="text">winner'
+        parsed = cache.get(loc)
+        self.assertEqual(parsed.base_element[u'element'], u'mods:name')
+        self.assertEqual(parsed.base_element[u'attributes'], {u'type': u'personal'})
+        self.assertTrue(parsed.has_sectioned_data)
+        self.assertEqual(len(parsed.sections), 2)
+        self.assertEqual(parsed.sections[1][1][u'data'], u'winner')
+        self.assertTrue(cache.get(loc) is parsed)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+        #parsed locations are shared, so they can't be changed
+        self.assertRaises(TypeError, parsed.base_element.__setitem__, u'element', u'mods:note')
+        self.assertRaises(TypeError, parsed.sections[0][0][u'attributes'].update, {u'type': u'date'})
+
+    def test_bounded(self):
+        cache = LocationCache(maxsize=2)
+        cache.warm([u'<mods:note>', u'<mods:genre>'])
+        cache.get(u'<mods:note>')
+        cache.get(u'<mods:abstract>')
+        self.assertEqual(len(cache), 2)
+        #least recently used location was dropped
+        self.assertFalse(u'<mods:genre>' in cache)
+        self.assertTrue(u'<mods:note>' in cache)
+        self.assertTrue(u'<mods:abstract>' in cache)
+
+    def test_lru_cache(self):
+        loaded = []
+        def load(key):
+            loaded.append(key)
+            return key.upper()
+        cache = generate_mods.LRUCache(load, maxsize=2)
+        self.assertEqual([cache.get(u'a'), cache.get(u'b'), cache.get(u'a'), cache.get(u'c')], [u'A', u'B', u'A', u'C'])
+        self.assertEqual(loaded, [u'a', u'b', u'c'])
+        self.assertFalse(u'b' in cache)
+        self.assertEqual((cache.hits, cache.misses), (1, 3))
+
+
 class TestDataHandler(unittest.TestCase):
     '''added some non-ascii characters to the files to make sure
     they're handled properly (é is u00e9, ă is u0103)'''
@@ -161,10 +215,223 @@ class TestDataHandler(unittest.TestCase):
         self.assertEqual(mods_records[0].id, u'test1')
         self.assertEqual(mods_records[0].field_data()[4]['data'], u'2005-10-21')
 
+    def test_csv_streaming(self):
+        dh = DataHandler(os.path.join('test_files', 'data.csv'), streaming=True)
+        #only the rows up to the control row are read up front
+        self.assertEqual(len(dh.csvData), 2)
+        mods_records = dh.get_mods_records()
+        self.assertFalse(isinstance(mods_records, list))
+        first = next(mods_records)
+        self.assertEqual(first.id, u'test1')
+        self.assertEqual(first.field_data()[0]['data'], u'123')
+        self.assertEqual(first.field_data()[4]['data'], u'2005-10-21')
+        self.assertEqual([r.id for r in mods_records], [u'test2'])
+        expected = DataHandler(os.path.join('test_files', 'data.csv')).get_mods_records()
+        streamed = list(DataHandler(os.path.join('test_files', 'data.csv'), streaming=True).get_mods_records())
+        self.assertEqual([r.field_data() for r in streamed], [r.field_data() for r in expected])
+
+    def test_csv_encodings(self):
+        expected = [r.field_data() for r in DataHandler(os.path.join('test_files', 'data.csv')).get_mods_records()]
+        #the UTF-16 file is found from its byte order mark, & transcoded for the CSV module
+        dh = DataHandler(os.path.join('test_files', 'data-utf16.csv'))
+        self.assertEqual(dh._csvEncoding, 'utf-8')
+        self.assertEqual([r.field_data() for r in dh.get_mods_records()], expected)
+        #a UTF-8 byte order mark is skipped
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tmp_dir, 'data-bom.csv')
+            with open(filename, 'wb') as f:
+                with open(os.path.join('test_files', 'data.csv'), 'rb') as data:
+                    f.write(codecs.BOM_UTF8 + data.read())
+            dh = DataHandler(filename, streaming=True)
+            self.assertEqual(dh.get_row(1)[0], u'Media Title')
+            self.assertEqual([r.field_data() for r in dh.get_mods_records()], expected)
+        finally:
+            shutil.rmtree(tmp_dir)
+        self.assertEqual(generate_mods.detect_bom(codecs.BOM_UTF32_LE, 'latin-1'), ('utf-32', 0))
+        self.assertEqual(generate_mods.detect_bom('abc', 'latin-1'), ('latin-1', 0))
+        self.assertEqual(generate_mods.csv_cell_encoding('ISO-8859-1'), 'latin-1')
+        self.assertEqual(generate_mods.csv_cell_encoding('utf-16'), None)
+
+    def test_xlsx_streaming(self):
+        path = os.path.join('test_files', 'data.xlsx')
+        for sheet in [1, 2]:
+            dh = DataHandler(path, sheet=sheet, streaming=True)
+            #the sheet is read with an XlsxReader, not xlrd
+            self.assertEqual(dh.dataType, 'xlsx')
+            self.assertEqual(len(dh.xlsxData), 2)
+            mods_records = dh.get_mods_records()
+            self.assertFalse(isinstance(mods_records, list))
+            expected = DataHandler(path, sheet=sheet).get_mods_records()
+            streamed = list(mods_records)
+            self.assertEqual([r.field_data() for r in streamed], [r.field_data() for r in expected])
+            self.assertEqual([r.mods_id for r in streamed], [r.mods_id for r in expected])
+        #numbers & dates are converted like xlrd does
+        rows = list(generate_mods.XlsxReader(path).iter_rows())
+        self.assertEqual(rows[2][:4], [u'xyz', u'1', u'test1', u'123'])
+        self.assertEqual(DataHandler(path, streaming=True).get_mods_records().next().field_data()[4]['data'],
+                         u'2005-10-21')
+        #other files still work when streaming
+        self.assertEqual(DataHandler(os.path.join('test_files', 'data.xls'), streaming=True).dataType, 'xlrd')
+
+    def test_shared_book(self):
+        path = os.path.join('test_files', 'data.xls')
+        first = DataHandler(path)
+        #the second sheet comes from the same (on demand) workbook
+        second = DataHandler(path, sheet=2, book=first.book)
+        self.assertTrue(second.book is first.book)
+        self.assertTrue(first.book.on_demand)
+        expected = DataHandler(path, sheet=2).get_mods_records()
+        self.assertEqual([r.field_data() for r in second.get_mods_records()], [r.field_data() for r in expected])
+        self.assertEqual(DataHandler(os.path.join('test_files', 'data.csv')).book, None)
+        #only the handler that opened the workbook releases it
+        second.close()
+        self.assertFalse(first.book._resources_released)
+        first.close()
+        self.assertTrue(first.book._resources_released)
+        self.assertEqual(len(first.get_mods_records()), 2)
+
+    def test_shared_xlsx_zip(self):
+        path = os.path.join('test_files', 'data.xlsx')
+        first = DataHandler(path, streaming=True)
+        self.assertTrue(isinstance(first.book, zipfile.ZipFile))
+        second = DataHandler(path, sheet=2, streaming=True, book=first.book)
+        self.assertTrue(second.book is first.book)
+        expected = DataHandler(path, sheet=2).get_mods_records()
+        self.assertEqual([r.field_data() for r in second.get_mods_records()], [r.field_data() for r in expected])
+        #reading a sheet doesn't close the shared zip file
+        self.assertEqual(len(list(first.get_mods_records())), 2)
+        second.close()
+        self.assertFalse(first.book.fp is None)
+        first.close()
+        self.assertTrue(first.book.fp is None)
+
+    def test_xlrd_columnar(self):
+        for filename in ['data.xls', 'data.xlsx']:
+            for sheet in [1, 2]:
+                path = os.path.join('test_files', filename)
+                by_column = DataHandler(path, sheet=sheet, columnar=True).get_mods_records()
+                by_row = DataHandler(path, sheet=sheet).get_mods_records()
+                self.assertEqual([r.field_data() for r in by_column], [r.field_data() for r in by_row])
+                self.assertEqual([r.mods_id for r in by_column], [r.mods_id for r in by_row])
+
+    def test_compact_records(self):
+        records = DataHandler(os.path.join('test_files', 'data.csv')).get_mods_records()
+        first, second = records
+        self.assertFalse(hasattr(first, '__dict__'))
+        #the records share the sheet's path table & repeated values
+        self.assertTrue(first._paths is second._paths)
+        self.assertEqual(first.field_data()[0], {'mods_path': u'<mods:identifier type="local" displayLabel="Originăl noé.">',
+                                                 'data': u'123'})
+        self.assertEqual(first.fields()[0], (u'<mods:identifier type="local" displayLabel="Originăl noé.">', u'123'))
+        shared = [(a, b) for a, b in zip(first.fields(), second.fields()) if a == b]
+        self.assertTrue(shared)
+        self.assertTrue(all(a[1] is b[1] for a, b in shared))
+        self.assertEqual((first.mods_filename, first.parent_mods_filename), (u'test1.mods', u'test1.mods'))
+        #the pickled record only has the paths it uses
+        copied = pickle.loads(pickle.dumps(first, pickle.HIGHEST_PROTOCOL))
+        self.assertEqual(copied.field_data(), first.field_data())
+        self.assertEqual((copied.id, copied.mods_id, copied.data_files), (first.id, first.mods_id, first.data_files))
+        self.assertEqual(len(copied._paths), len(first.fields()))
+        #the old list of dicts works too
+        record = generate_mods.ModsRecord(u'a', u'a_1', [{'mods_path': u'<mods:note>', 'data': u'x'}], [])
+        self.assertEqual(record.field_data(), [{'mods_path': u'<mods:note>', 'data': u'x'}])
+
+    def test_intern_limits(self):
+        tmp_dir = tempfile.mkdtemp()
+        orig_limits = (generate_mods.INTERN_SAMPLE_ROWS, generate_mods.INTERN_MAX_VALUES)
+        try:
+            filename = os.path.join(tmp_dir, 'data.csv')
+            with open(filename, 'wb') as f:
+                f.write('ID,Genre,Note,Topic\nid,<mods:genre>,<mods:note>,<mods:subject><mods:topic>\n')
+                for i in range(20):
+                    #notes repeat for 6 rows, then they're all new for 5 rows, then they repeat again
+                    note = 'note 0' if i < 6 else ('note %d' % i if i < 11 else 'note x')
+                    #the topics change every 3 rows
+                    f.write('rec%d,photographs,%s,topic %d\n' % (i, note, i // 3))
+            #check every 6 rows, & keep up to 4 values
+            generate_mods.INTERN_SAMPLE_ROWS, generate_mods.INTERN_MAX_VALUES = 6, 4
+            records = DataHandler(filename, streaming=True).get_mods_records()
+            genres, notes, topics = zip(*[[data for path, data in r.fields()] for r in records])
+        finally:
+            generate_mods.INTERN_SAMPLE_ROWS, generate_mods.INTERN_MAX_VALUES = orig_limits
+            shutil.rmtree(tmp_dir)
+        self.assertTrue(genres[0] is genres[19])
+        #notes stopped being interned at the second check, when most of them were new
+        self.assertTrue(notes[0] is notes[5])
+        self.assertFalse(notes[12] is notes[13])
+        #topics stopped being interned at the third check, when there were too many
+        self.assertTrue(topics[15] is topics[16])
+        self.assertFalse(topics[18] is topics[19])
+
+    def test_mapping_plan(self):
+        dh = DataHandler(os.path.join('test_files', 'data.csv'))
+        plan = dh._get_mapping_plan()
+        self.assertTrue(plan is dh._get_mapping_plan())
+        self.assertEqual(plan.id_col, 2)
+        self.assertEqual(plan.mods_id_col, None)
+        self.assertEqual(plan.filename_col, 2)
+        self.assertEqual(plan.cols_to_map, dh.get_cols_to_map())
+        self.assertEqual(plan.mapped_cols[0], (3, u'<mods:identifier type="local" displayLabel="Originăl noé.">'))
+        self.assertEqual(plan.date_cols, [11, 22])
+        plan = MappingPlan([u'ID', u'Title'], [u'do not map', u'<mods:mods ID="">'])
+        self.assertEqual(plan.id_col, 0)
+        self.assertEqual(plan.mods_id_col, 1)
+        self.assertEqual(plan.filename_col, None)
+
 
 class TestOther(unittest.TestCase):
     '''Test non-class functions.'''
 
+    def test_mods_name_index(self):
+        index = generate_mods.ModsNameIndex([u'a.mods', u'a_2.mods'])
+        self.assertEqual(index.get_unused(u'b'), u'b.mods')
+        self.assertEqual(index.get_unused(u'a'), u'a_1.mods')
+        self.assertEqual(index.get_unused(u'a'), u'a_3.mods')
+        self.assertTrue(u'a_3.mods' in index)
+        self.assertEqual(generate_mods.get_mods_filename(u'b', name_index=index),
+                         os.path.join(generate_mods.MODS_DIR, u'b_1.mods'))
+
+    def test_mods_dir_layout(self):
+        self.assertEqual(generate_mods.ModsDirLayout().shard_dirs(u'test1.mods'), [])
+        layout = generate_mods.ModsDirLayout(2, 'id')
+        self.assertEqual(layout.shard_dirs(u'test1.mods'), [u'te', u'st'])
+        self.assertEqual(layout.shard_dirs(u'a.mods'), [u'a_', u'__'])
+        #ids can't put files outside the directory
+        self.assertEqual(layout.shard_dirs(u'../etc.mods'), [u'__', u'_e'])
+        self.assertEqual(layout.shard_dirs(u'a/' + os.sep + u'b.mods'), [u'a_', u'_b'])
+        self.assertEqual(layout.shard_dirs(u'.\\x.mods'), [u'__', u'x_'])
+        self.assertEqual(layout.shard_dirs(u'ébc.mods'), [u'éb', u'c_'])
+        path = layout.path(u'..x.mods', 'out')
+        self.assertEqual(path, os.path.join('out', u'__', u'x_', u'..x.mods'))
+        layout = generate_mods.ModsDirLayout(3, 'hash', 1)
+        self.assertEqual(len(layout.shard_dirs(u'test1.mods')), 3)
+        self.assertEqual(layout.path(u'test1.mods', 'out'),
+                         os.path.join('out', *(layout.shard_dirs(u'test1.mods') + [u'test1.mods'])))
+
+    def test_progress_and_async_log(self):
+        messages = []
+        handler = logging.Handler()
+        handler.emit = lambda record: messages.append(record.getMessage())
+        test_logger = logging.getLogger('test_async_log')
+        test_logger.propagate = False
+        test_logger.addHandler(handler)
+        sink = generate_mods.AsyncLogSink(test_logger)
+        sink.start()
+        self.assertEqual(test_logger.handlers, [sink.queue_handler])
+        test_logger.warning('%d records', 3)
+        sink.stop()
+        self.assertEqual(test_logger.handlers, [handler])
+        self.assertEqual(messages, ['3 records'])
+        generate_mods.logger.addHandler(handler)
+        try:
+            progress = generate_mods.ProgressReporter(total=4, interval=0)
+            progress.update(2)
+        finally:
+            generate_mods.logger.removeHandler(handler)
+        self.assertTrue(messages[1].startswith('Processed 2 of 4 records (50.0%, '))
+        self.assertTrue('ETA' in messages[1])
+
     def test_process_text_date(self):
         '''Tests to make sure we're handling dates properly.'''
         #dates with slashes
@@ -195,6 +462,59 @@ class TestOther(unittest.TestCase):
         self.assertEqual(process_text_date('5/4/99', True), '1999-05-04')
         self.assertEqual(process_text_date('5/17/99', True), '1999-05-17')
 
+    def test_text_date_cache(self):
+        generate_mods.text_date_cache.clear()
+        self.assertEqual(process_text_date(u'10/21/1850'), u'1850-10-21')
+        self.assertEqual(process_text_date(u'10/21/1850'), u'1850-10-21')
+        self.assertEqual(process_text_date(u'10/21/1850', True), u'1850-10-21')
+        self.assertEqual((generate_mods.text_date_cache.hits, generate_mods.text_date_cache.misses), (1, 2))
+        #warnings are counted every time, even when the result is cached
+        generate_mods.warning_counter.clear()
+        warnings = []
+        handler = logging.Handler()
+        handler.emit = lambda record: warnings.append(record.getMessage())
+        generate_mods.logger.addHandler(handler)
+        try:
+            process_text_date(u'5/4/99')
+            process_text_date(u'5/4/99')
+            process_text_date(u'2/30/2001')
+            self.assertEqual(warnings, [u'Ambiguous day/month: 5/4/99', u'Ambiguous day/month: 5/4/99',
+                                        u'Error creating date from 2/30/2001'])
+            #after the first few, they're only counted
+            for i in range(2000):
+                process_text_date(u'%d/4/99' % [1, 2, 3, 5, 6][i % 5])
+            self.assertEqual(len(warnings), 6)
+            warnings[:] = []
+            generate_mods.warning_counter.log_summary()
+        finally:
+            generate_mods.logger.removeHandler(handler)
+            generate_mods.warning_counter.clear()
+        self.assertEqual(warnings, [u'2,002 ambiguous day/month dates (e.g. 5/4/99, 1/4/99, 2/4/99, 3/4/99, 6/4/99).',
+                                    u'1 invalid dates (e.g. 2/30/2001).'])
+
+    def test_warning_counter(self):
+        formatted = []
+        class Row(object):
+            def __init__(self, index):
+                self.index = index
+            def __str__(self):
+                formatted.append(self.index)
+                return str(self.index)
+        counter = generate_mods.WarningCounter(log_first=2)
+        warnings = []
+        handler = logging.Handler()
+        handler.emit = lambda record: warnings.append(record.getMessage())
+        generate_mods.logger.addHandler(handler)
+        try:
+            for i in range(5):
+                counter.warn('rows without an id', 'no id on row %s - skipping', i, Row(i))
+        finally:
+            generate_mods.logger.removeHandler(handler)
+        #the messages that are only counted are never formatted
+        self.assertEqual(warnings, [u'no id on row 0 - skipping', u'no id on row 1 - skipping'])
+        self.assertEqual(sorted(set(formatted)), [0, 1])
+        self.assertEqual(counter.counts['rows without an id'], 5)
+
 class TestMapper(unittest.TestCase):
     '''Test Mapper class.'''
 
@@ -365,12 +685,522 @@ class TestMapper(unittest.TestCase):
         #this does assume that the attributes will always be written out in the same order
         self.assertEqual(mods_data, self.FULL_MODS)
 
+    def test_direct_mapper(self):
+        #same locations & data as test_mods_output (without the parent, the
+        #   typeOfResource & the physicalLocation, which DirectMapper doesn't
+        #   support - see below), plus an abstract
+        calls = [
+            (u'<mods:mods ID="">', u'mods000'),
+            (u'<mods:titleInfo><mods:title>#<mods:partName>#<mods:partNumber>', u'é. 1 Test#part \\#1#1'),
+            (u'<mods:titleInfo type="alternative" displayLabel="display"><mods:title>#<mods:nonSort>', u'Alt Title#The'),
+            (u'<mods:identifier type="local" displayLabel="Original no.">', u'1591'),
+            (u'<mods:identifier type="local" displayLabel="PN_DB_id">', u'321'),
+            (u'<mods:genre authority="aat">', u'Programming Tests'),
+            (u'<mods:originInfo><mods:publisher>', u'Publisher'),
+            (u'<mods:originInfo><mods:place><mods:placeTerm>', u'USA'),
+            (u'<mods:originInfo displayLabel="Date Ądded to Colléction"><mods:dateOther encoding="w3cdtf" keyDate="yes">', u'2010-01-31'),
+            (u'<mods:subject><mods:topic>', u'PROGRĄMMING || Testing'),
+            (u'<mods:subject><mods:topic>#<mods:topic>', u'Software#Testing'),
+            (u'<mods:subject authority="local"><mods:topic>', u'Recursion || '),
+            (u'<mods:subject authority="local"><mods:temporal>', u'1990s'),
+            (u'<mods:subject><mods:geographic>', u'United States'),
+            (u'<mods:subject><mods:hierarchicalGeographic><mods:country>United States</mods:country><mods:state>', u'Pennsylvania'),
+            (u'<mods:name type="personal"><mods:namePart>#<mods:role><mods:roleTerm>', u'Smith#creator || Jones, T.'),
+            (u'<mods:namePart type="date">', u'1799-1889'),
+            (u'<mods:name type="personal"><mods:namePart>#<mods:role><mods:roleTerm type="text">winner', u'Bob'),
+            (u'<mods:name type="personal"><mods:namePart>#<mods:namePart type="date">#<mods:namePart type="termsOfAddress">', u'Fob, Bob || Smith, Ted#1900-2013#Sir'),
+            (u'<mods:originInfo><mods:dateCreated encoding="w3cdtf" point="end">', u'7/13/1899'),
+            (u'<mods:originInfo><mods:dateCreated encoding="w3cdtf">#<mods:dateCreated encoding="w3cdtf" point="start" keyDate="yes">#<mods:dateCreated encoding="w3cdtf" point="end">', u'1972-10-1973-07-07#1972-10#1973-07-07'),
+            (u'<mods:note displayLabel="note label">', u'Note 1&2'),
+            (u'<mods:note>', u'3<4'),
+            (u'<mods:physicalDescription><mods:extent>#<mods:digitalOrigin>#<mods:note>', u'1 video file#reformatted digital#note 1'),
+            (u'<mods:abstract>', u'Abstract'),
+            (u'<mods:location><mods:url>#<mods:holdingSimple><mods:copyInformation><mods:note>', u'http://www.example.com#Note 1'),
+            (u'<mods:note>', u'another note'),
+            (u'<mods:language><mods:languageTerm authority="iso639-2b" type="code">', u'eng'),
+            (u'<mods:relatedItem type="related item" displayLabel="display"><mods:titleInfo><mods:title>', u'Some related item display title'),
+            (u'<mods:originInfo><mods:dateIssued encoding="w3cdtf">', u'1974-01-01'),
+            (u'<mods:originInfo><mods:dateCaptured encoding="w3cdtf">', u'1975-01-01'),
+            (u'<mods:originInfo><mods:dateValid encoding="w3cdtf">', u'1976-01-01'),
+            (u'<mods:originInfo><mods:dateModified encoding="w3cdtf">', u'1977-01-01'),
+            (u'<mods:originInfo><mods:copyrightDate>', u'1978-01-##'),
+        ]
+        self.assertTrue(generate_mods.DirectMapper.supports(loc for loc, data in calls))
+        m = Mapper()
+        direct = generate_mods.DirectMapper()
+        for loc, data in calls:
+            m.add_data(loc, data)
+            direct.add_data(loc, data)
+        self.assertEqual(direct.serialize(), m.get_mods().serializeDocument(pretty=True))
+        #locations it can't map exactly like Mapper
+        self.assertFalse(generate_mods.DirectMapper.supports([u'<mods:accessCondition>']))
+        self.assertFalse(generate_mods.DirectMapper.supports([u'<mods:originInfo><mods:edition>']))
+        self.assertFalse(generate_mods.DirectMapper.supports([u'<mods:typeOfResource>']))
+        self.assertFalse(generate_mods.DirectMapper.supports(
+            [u'<mods:location><mods:physicalLocation>zzz#<mods:url>#<mods:holdingSimple><mods:copyInformation><mods:note>']))
+        self.assertRaises(generate_mods.UnsupportedLocation, direct.add_data, u'<mods:accessCondition>', u'x')
+
+    def test_register_element_handler(self):
+        class AccessMapper(Mapper):
+            pass
+        calls = []
+        def add_access_condition(mapper, base_element, location_sections, data_vals):
+            calls.append((base_element[u'attributes'][u'type'], data_vals))
+        def clear_access_conditions(mods_obj):
+            calls.append(u'cleared')
+        AccessMapper.register_element_handler(u'mods:accessCondition', add_access_condition, clear_access_conditions)
+        m = AccessMapper()
+        m.add_data(u'<mods:accessCondition type="use and reproduction">', u'Public domain || CC0')
+        m.add_data(u'<mods:accessCondition type="restriction on access">', u'None')
+        self.assertEqual(calls, [u'cleared', (u'use and reproduction', [[u'Public domain'], [u'CC0']]),
+                                 (u'restriction on access', [[u'None']])])
+        #registering on the subclass doesn't change Mapper
+        self.assertRaises(Exception, Mapper().add_data, u'<mods:accessCondition type="use and reproduction">', u'CC0')
+        m.add_data(u'<mods:note>', u'still handled')
+        self.assertEqual(m.get_mods().notes[0].text, u'still handled')
+
+    def test_register_element_compiler(self):
+        def add_access_condition(mapper, base_element, location_sections, data_vals):
+            for data in data_vals:
+                mapper.get_mods().access_conditions.append(mods.AccessCondition(text=data[0]))
+        def compile_access_condition(base_element, location_sections):
+            tag = generate_mods._mods_tag(u'mods:accessCondition')
+            def build(root, data_vals):
+                for data in data_vals:
+                    etree.SubElement(root, tag).text = data[0]
+            return build
+        loc = u'<mods:accessCondition>'
+        handlers = dict(Mapper._element_handlers)
+        try:
+            #without a compile function, DirectMapper can't map it
+            Mapper.register_element_handler(u'mods:accessCondition', add_access_condition)
+            self.assertFalse(generate_mods.DirectMapper.supports([loc], generate_mods.CompiledLocationCache()))
+            Mapper.register_element_handler(u'mods:accessCondition', add_access_condition,
+                                            compile=compile_access_condition)
+            cache = generate_mods.CompiledLocationCache()
+            self.assertTrue(generate_mods.DirectMapper.supports([loc], cache))
+            direct = generate_mods.DirectMapper(cache)
+            direct.add_data(loc, u'Public domain || CC0')
+            m = Mapper()
+            m.add_data(loc, u'Public domain || CC0')
+            self.assertEqual(direct.serialize(), m.get_mods().serializeDocument(pretty=True))
+        finally:
+            Mapper._element_handlers = handlers
+
     def test_get_data_divs(self):
         m = Mapper()
         self.assertEqual(m._get_data_divs(u'part1#part2#part3', False), [u'part1#part2#part3'])
         self.assertEqual(m._get_data_divs(u'part1#part2#part3', True), [u'part1', u'part2', u'part3'])
         self.assertEqual(m._get_data_divs(u'part\#1#part2#part\#3', True), [u'part#1', u'part2', u'part#3'])
         self.assertEqual(m._get_data_divs(u'part\#1 and \#1a#part2#part\#3', True), [u'part#1 and #1a', u'part2', u'part#3'])
+        self.assertEqual(m._get_data_divs(u'part1##', True), [u'part1', u''])
+
+    def test_split_sectioned_data(self):
+        split = generate_mods.split_sectioned_data
+        self.assertEqual(split(u'part1#part2 || part\#1#part2#'), [[u'part1', u'part2'], [u'part#1', u'part2']])
+        self.assertEqual(split(u' a # b || || # '), [[u'a ', u' b'], [u'']])
+        self.assertEqual(split(u'a|||b'), [[u'a'], [u'|b']])
+        self.assertEqual(split(u'a;b#c', u';'), [[u'a'], [u'b', u'c']])
+        #this used to loop forever
+        self.assertEqual(split(u'#a\\'), [[u'', u'a\\']])
+
+
+class TestModsValidator(unittest.TestCase):
+
+    def test_validate(self):
+        validator = ModsValidator()
+        m = Mapper()
+        m.add_data(u'<mods:titleInfo><mods:title>', u'Test')
+        m.add_data(u'<mods:name type="personal"><mods:namePart>#<mods:role><mods:roleTerm type="text">', u'Smith#creator')
+        self.assertEqual(validator.validate(m.get_mods().node), [])
+        bad = etree.fromstring('<mods:mods xmlns:mods="http://www.loc.gov/mods/v3"><mods:bogus/></mods:mods>')
+        errors = validator.validate(bad)
+        self.assertEqual(len(errors), 1)
+        self.assertTrue('bogus' in errors[0])
+
+
+class TestProcess(unittest.TestCase):
+    '''Test the process function, writing to a temporary MODS_DIR.'''
+
+    CSV_DATA = u'''ID,Title,Subject,Date
+id,<mods:titleInfo><mods:title>,<mods:subject><mods:topic>,<mods:originInfo><mods:dateCreated encoding="w3cdtf">
+test1,Test 1,Testing || Python,10/21/2005
+test2,Test 2,Testing,2005-10-22
+test3,Tëst 3,,1/1/2001
+'''
+
+    #with a hierarchicalGeographic column, which used to be printed to stdout
+    PLACE_CSV_DATA = u'''ID,Title,Place
+id,<mods:titleInfo><mods:title>,<mods:subject><mods:hierarchicalGeographic><mods:country>United States</mods:country><mods:state>
+test1,Test 1,Pennsylvania
+test2,Test 2,Rhode Island
+'''
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.orig_mods_dir = generate_mods.MODS_DIR
+        generate_mods.MODS_DIR = os.path.join(self.tmp_dir, 'mods_files')
+        os.makedirs(generate_mods.MODS_DIR)
+        self.csv_filename = os.path.join(self.tmp_dir, 'data.csv')
+        with open(self.csv_filename, 'wb') as f:
+            f.write(self.CSV_DATA.encode('utf-8'))
+
+    def tearDown(self):
+        generate_mods.MODS_DIR = self.orig_mods_dir
+        shutil.rmtree(self.tmp_dir)
+
+    def _write_place_csv(self):
+        filename = os.path.join(self.tmp_dir, 'places.csv')
+        with open(filename, 'wb') as f:
+            f.write(self.PLACE_CSV_DATA.encode('utf-8'))
+        return filename
+
+    def _process_to_stdout(self, filename, output_format):
+        '''Run process() with output to '-', & return what was written to stdout.'''
+        orig_stdout = sys.stdout
+        with tempfile.TemporaryFile() as stdout:
+            sys.stdout = stdout
+            try:
+                writer = generate_mods.make_output_writer('-', output_format)
+                generate_mods.process(DataHandler(filename), writer=writer)
+            finally:
+                sys.stdout = orig_stdout
+            stdout.seek(0)
+            return stdout.read()
+
+    def _read_output(self):
+        output = {}
+        for filename in os.listdir(generate_mods.MODS_DIR):
+            with open(os.path.join(generate_mods.MODS_DIR, filename), 'rb') as f:
+                output[filename] = f.read()
+        return output
+
+    def test_process(self):
+        generate_mods.process(DataHandler(self.csv_filename))
+        output = self._read_output()
+        self.assertEqual(sorted(output), ['test1.mods', 'test2.mods', 'test3.mods'])
+        self.assertTrue('<mods:title>T\xc3\xabst 3</mods:title>' in output['test3.mods'])
+        self.assertTrue('2005-10-21' in output['test1.mods'])
+        self.assertRaises(Exception, generate_mods.process, DataHandler(self.csv_filename))
+
+    def test_process_validate(self):
+        self.assertEqual(generate_mods.process(DataHandler(self.csv_filename), validate=True), 0)
+        self.assertEqual(len(self._read_output()), 3)
+
+    def test_copy_parent_to_children(self):
+        generate_mods.process(DataHandler(self.csv_filename))
+        child_filename = os.path.join(self.tmp_dir, 'children.csv')
+        with open(child_filename, 'wb') as f:
+            f.write(u'''ID,Note
+id,<mods:note>
+test1,child 1
+test1,child 2
+test2,child 3
+'''.encode('utf-8'))
+        records = DataHandler(child_filename, obj_type='child').get_mods_records()
+        expected = [generate_mods.build_mods_data(r, True) for r in records]
+        cache = generate_mods.ParentModsCache()
+        self.assertEqual([generate_mods.build_mods_data(r, True, cache) for r in records], expected)
+        self.assertEqual((cache.hits, cache.misses), (1, 2))
+        self.assertTrue('<mods:title>Test 1</mods:title>' in expected[1])
+        self.assertTrue('<mods:note>child 2</mods:note>' in expected[1])
+        self.assertFalse('child 1' in expected[1])
+        generate_mods.process(DataHandler(child_filename, obj_type='child'), copy_parent_to_children=True)
+        output = self._read_output()
+        self.assertEqual(output['test1_2.mods'], expected[1])
+
+    def test_group_by_id(self):
+        #parents & children in one sheet, with the children after other parents
+        grouped_filename = os.path.join(self.tmp_dir, 'grouped.csv')
+        with open(grouped_filename, 'wb') as f:
+            f.write(u'''ID,Title,Note
+id,<mods:titleInfo><mods:title>,<mods:note>
+test1,Test 1,parent note
+test2,Test 2,
+test1,,child 1
+test1,,child 2
+'''.encode('utf-8'))
+        groups = DataHandler(grouped_filename).get_record_groups()
+        self.assertEqual([(rec_id, [r.mods_id for r in records]) for rec_id, records in groups],
+                         [(u'test1', [u'test1', u'test1_1', u'test1_2']), (u'test2', [u'test2'])])
+        generate_mods.process(DataHandler(grouped_filename), group_by_id=True)
+        output = self._read_output()
+        self.assertEqual(sorted(output), ['test1.mods', 'test1_1.mods', 'test1_2.mods', 'test2.mods'])
+        self.assertTrue('<mods:title>Test 1</mods:title>' in output['test1_2.mods'])
+        self.assertTrue('<mods:note>child 2</mods:note>' in output['test1_2.mods'])
+        self.assertFalse('parent note' in output['test1_2.mods'])
+        #same output as generating the parents & then the children with copy_parent_to_children
+        shutil.rmtree(generate_mods.MODS_DIR)
+        os.makedirs(generate_mods.MODS_DIR)
+        with open(self.csv_filename, 'wb') as f:
+            f.write(u'ID,Title,Note\nid,<mods:titleInfo><mods:title>,<mods:note>\n'
+                    u'test1,Test 1,parent note\ntest2,Test 2,\n'.encode('utf-8'))
+        generate_mods.process(DataHandler(self.csv_filename))
+        child_filename = os.path.join(self.tmp_dir, 'children.csv')
+        with open(child_filename, 'wb') as f:
+            f.write(u'ID,Note\nid,<mods:note>\ntest1,child 1\ntest1,child 2\n'.encode('utf-8'))
+        generate_mods.process(DataHandler(child_filename, obj_type='child'), copy_parent_to_children=True)
+        self.assertEqual(self._read_output(), output)
+        shutil.rmtree(generate_mods.MODS_DIR)
+        os.makedirs(generate_mods.MODS_DIR)
+        generate_mods.process(DataHandler(grouped_filename, streaming=True), workers=2, group_by_id=True)
+        self.assertEqual(self._read_output(), output)
+        self.assertRaises(Exception, generate_mods.process, DataHandler(child_filename, obj_type='child'),
+                          group_by_id=True)
+
+    def test_process_with_children(self):
+        child_filename = os.path.join(self.tmp_dir, 'children.csv')
+        with open(child_filename, 'wb') as f:
+            f.write(u'''ID,Note
+id,<mods:note>
+test2,child 3
+test1,child 1
+test4,orphan
+test1,child 2
+'''.encode('utf-8'))
+        #parents & then children, in two runs
+        generate_mods.process(DataHandler(self.csv_filename))
+        generate_mods.process(DataHandler(child_filename, obj_type='child'), copy_parent_to_children=True)
+        expected = self._read_output()
+        self.assertEqual(len(expected), 7)
+        self.assertFalse('<mods:title>' in expected['test4_1.mods'])
+        groups = generate_mods.attach_children(DataHandler(self.csv_filename).get_mods_records(),
+                                               DataHandler(child_filename, obj_type='child').get_record_groups())
+        self.assertEqual([(p and p.mods_id, [r.mods_id for r in records]) for p, records in groups],
+                         [(u'test1', [u'test1_1', u'test1_2']), (u'test2', [u'test2_1']), (u'test3', []),
+                          (None, [u'test4_1'])])
+        for workers in [1, 2]:
+            shutil.rmtree(generate_mods.MODS_DIR)
+            os.makedirs(generate_mods.MODS_DIR)
+            generate_mods.process(DataHandler(self.csv_filename), workers=workers,
+                                  children=DataHandler(child_filename, obj_type='child'))
+            self.assertEqual(self._read_output(), expected)
+
+    def test_process_workers(self):
+        generate_mods.process(DataHandler(self.csv_filename))
+        expected = self._read_output()
+        for filename in expected:
+            os.remove(os.path.join(generate_mods.MODS_DIR, filename))
+        generate_mods.process(DataHandler(self.csv_filename, streaming=True), workers=2)
+        self.assertEqual(self._read_output(), expected)
+
+    def test_text_date_cache_stats(self):
+        #each run reports its own cache stats, not the totals so far
+        generate_mods.text_date_cache.clear()
+        messages = []
+        handler = logging.Handler()
+        handler.emit = lambda record: messages.append(record.getMessage())
+        generate_mods.logger.addHandler(handler)
+        try:
+            generate_mods.process(DataHandler(self.csv_filename))
+            generate_mods.process(DataHandler(self.csv_filename), writer=generate_mods.ModsArchiveWriter(
+                os.path.join(self.tmp_dir, 'mods.zip')))
+        finally:
+            generate_mods.logger.removeHandler(handler)
+        self.assertEqual([m for m in messages if m.startswith(u'Text date cache')],
+                         [u'Text date cache: 0 hits, 3 misses (0.0% hit rate).',
+                          u'Text date cache: 3 hits, 0 misses (100.0% hit rate).'])
+
+    def test_process_direct(self):
+        generate_mods.process(DataHandler(self.csv_filename))
+        expected = self._read_output()
+        for workers in [1, 2]:
+            for filename in expected:
+                os.remove(os.path.join(generate_mods.MODS_DIR, filename))
+            generate_mods.process(DataHandler(self.csv_filename), workers=workers, direct=True)
+            self.assertEqual(self._read_output(), expected)
+
+    def test_process_direct_unsupported(self):
+        #a handler registered without a compile function can't be used by
+        #   the lxml engine - that's logged, & the records are mapped with eulxml
+        def add_access_condition(mapper, base_element, location_sections, data_vals):
+            for data in data_vals:
+                mapper.get_mods().access_conditions.append(mods.AccessCondition(text=data[0]))
+        filename = os.path.join(self.tmp_dir, 'access.csv')
+        with open(filename, 'wb') as f:
+            f.write(u'''ID,Title,Access
+id,<mods:titleInfo><mods:title>,<mods:accessCondition>
+test1,Test 1,Public domain
+test2,Test 2,CC0
+'''.encode('utf-8'))
+        handlers = dict(Mapper._element_handlers)
+        warnings = []
+        handler = logging.Handler()
+        handler.emit = lambda record: warnings.append(record.getMessage())
+        try:
+            Mapper.register_element_handler(u'mods:accessCondition', add_access_condition)
+            generate_mods.process(DataHandler(filename))
+            expected = self._read_output()
+            for name in expected:
+                os.remove(os.path.join(generate_mods.MODS_DIR, name))
+            generate_mods.logger.addHandler(handler)
+            generate_mods.process(DataHandler(filename), direct=True)
+        finally:
+            generate_mods.logger.removeHandler(handler)
+            Mapper._element_handlers = handlers
+        self.assertEqual(self._read_output(), expected)
+        self.assertEqual([w for w in warnings if u'lxml' in w],
+                         [u"the lxml engine can't map mods:accessCondition (<mods:accessCondition>)"
+                          u" - records with it are mapped with eulxml"])
+
+    def test_process_batch(self):
+        other_filename = os.path.join(self.tmp_dir, 'other.csv')
+        with open(other_filename, 'wb') as f:
+            f.write(self.CSV_DATA.replace(u'test', u'other').encode('utf-8'))
+        inputs = generate_mods.expand_inputs([os.path.join(self.tmp_dir, '*.csv')])
+        self.assertEqual(inputs, [(self.csv_filename, 1), (other_filename, 1)])
+        self.assertEqual(generate_mods.expand_inputs(['data.xls:2', 'data.csv'], sheet=3),
+                         [('data.xls', 2), ('data.csv', 3)])
+        for workers in [1, 2]:
+            archive_name = os.path.join(self.tmp_dir, 'mods-%d.zip' % workers)
+            writer = generate_mods.make_output_writer(archive_name)
+            self.assertEqual(generate_mods.process_batch(inputs, workers=workers, writer=writer, validate=True), 0)
+            with zipfile.ZipFile(archive_name) as z:
+                self.assertEqual(sorted(z.namelist()), ['other1.mods', 'other2.mods', 'other3.mods',
+                                                        'test1.mods', 'test2.mods', 'test3.mods'])
+                self.assertTrue('<mods:title>T\xc3\xabst 3</mods:title>' in z.read('test3.mods'))
+        #the same records in two inputs still clash
+        self.assertRaises(Exception, generate_mods.process_batch, [(self.csv_filename, 1), (self.csv_filename, 1)])
+
+    def test_writer_thread(self):
+        generate_mods.process(DataHandler(self.csv_filename))
+        expected = self._read_output()
+        for filename in expected:
+            os.remove(os.path.join(generate_mods.MODS_DIR, filename))
+        writer = generate_mods.ModsDirWriter(background=True, batch_size=2)
+        generate_mods.process(DataHandler(self.csv_filename), writer=writer)
+        self.assertEqual(self._read_output(), expected)
+        #existing files are found from the directory listing
+        writer = generate_mods.ModsDirWriter()
+        self.assertTrue(writer.exists(u'test1.mods'))
+        self.assertRaises(Exception, generate_mods.process, DataHandler(self.csv_filename), writer=writer)
+
+    def test_archive(self):
+        generate_mods.process(DataHandler(self.csv_filename))
+        expected = self._read_output()
+        for archive_name in ['mods.tar.gz', 'mods.zip']:
+            path = os.path.join(self.tmp_dir, archive_name)
+            writer = generate_mods.ModsArchiveWriter(path)
+            generate_mods.process(DataHandler(self.csv_filename), writer=writer)
+            if archive_name.endswith('.zip'):
+                archive = zipfile.ZipFile(path)
+                output = dict((name, archive.read(name)) for name in archive.namelist())
+            else:
+                archive = tarfile.open(path)
+                output = dict((m.name, archive.extractfile(m).read()) for m in archive.getmembers())
+            archive.close()
+            self.assertEqual(output, expected)
+        self.assertEqual(generate_mods.guess_output_format('mods.tgz'), 'tar.gz')
+        self.assertRaises(Exception, generate_mods.ModsArchiveWriter, '-', 'zip')
+
+    def test_archive_stdout(self):
+        filename = self._write_place_csv()
+        generate_mods.process(DataHandler(filename))
+        expected = self._read_output()
+        archive = tarfile.open(fileobj=io.BytesIO(self._process_to_stdout(filename, 'tar')))
+        output = dict((m.name, archive.extractfile(m).read()) for m in archive.getmembers())
+        archive.close()
+        self.assertEqual(output, expected)
+        self.assertTrue('<mods:state>Pennsylvania</mods:state>' in output['test1.mods'])
+
+    def test_json_lines(self):
+        generate_mods.process(DataHandler(self.csv_filename))
+        expected = self._read_output()
+        path = os.path.join(self.tmp_dir, 'mods.jsonl')
+        writer = generate_mods.make_output_writer(path)
+        self.assertTrue(isinstance(writer, generate_mods.ModsJsonLinesWriter))
+        generate_mods.process(DataHandler(self.csv_filename), writer=writer)
+        with open(path, 'rb') as f:
+            lines = [json.loads(line) for line in f]
+        self.assertEqual([line['id'] for line in lines], [u'test1', u'test2', u'test3'])
+        self.assertEqual(lines[2]['mods_id'], u'test3')
+        self.assertEqual(lines[2]['data_files'], [])
+        self.assertEqual(lines[2]['mods_xml'].encode('utf-8'), expected['test3.mods'])
+
+    def test_json_lines_stdout(self):
+        filename = self._write_place_csv()
+        generate_mods.process(DataHandler(filename))
+        expected = self._read_output()
+        output = self._process_to_stdout(filename, 'jsonl')
+        #every line on stdout has to be a record
+        lines = [json.loads(line) for line in output.splitlines()]
+        self.assertEqual([line['id'] for line in lines], [u'test1', u'test2'])
+        self.assertEqual(lines[0]['mods_xml'].encode('utf-8'), expected['test1.mods'])
+
+    def test_sharded_layout(self):
+        generate_mods.process(DataHandler(self.csv_filename))
+        expected = self._read_output()
+        shutil.rmtree(generate_mods.MODS_DIR)
+        os.makedirs(generate_mods.MODS_DIR)
+        orig_layout = generate_mods.mods_dir_layout
+        generate_mods.mods_dir_layout = generate_mods.ModsDirLayout(2, 'id')
+        try:
+            generate_mods.process(DataHandler(self.csv_filename), incremental=True)
+            with open(os.path.join(generate_mods.MODS_DIR, 'te', 'st', 'test3.mods'), 'rb') as f:
+                self.assertEqual(f.read(), expected['test3.mods'])
+            #nothing changed
+            generate_mods.process(DataHandler(self.csv_filename), incremental=True)
+            self.assertRaises(Exception, generate_mods.process, DataHandler(self.csv_filename))
+            #parents are found in their subdirectory
+            child_filename = os.path.join(self.tmp_dir, 'children.csv')
+            with open(child_filename, 'wb') as f:
+                f.write(u'ID,Note\nid,<mods:note>\ntest1,child 1\n'.encode('utf-8'))
+            generate_mods.process(DataHandler(child_filename, obj_type='child'), copy_parent_to_children=True)
+            with open(os.path.join(generate_mods.MODS_DIR, 'te', 'st', 'test1_1.mods'), 'rb') as f:
+                self.assertTrue('<mods:title>Test 1</mods:title>' in f.read())
+        finally:
+            generate_mods.mods_dir_layout = orig_layout
+
+    def test_profile(self):
+        for workers in [1, 2]:
+            shutil.rmtree(generate_mods.MODS_DIR)
+            os.makedirs(generate_mods.MODS_DIR)
+            stats = generate_mods.PipelineStats()
+            generate_mods.process(DataHandler(self.csv_filename), workers=workers, stats=stats)
+            summary = stats.summary()
+            for stage in ['parse_locations', 'load', 'read', 'map', 'serialize', 'write', 'close']:
+                self.assertTrue(stage in summary, stage)
+            self.assertEqual(summary['map']['count'], 3)
+            self.assertEqual(summary[u'map:mods:titleInfo']['count'], 3)
+            self.assertEqual(summary[u'map:mods:subject']['count'], 2)
+            self.assertTrue(summary['map']['p50'] <= summary['map']['max'])
+        json_filename = os.path.join(self.tmp_dir, 'stats.json')
+        stats.dump_json(json_filename)
+        with open(json_filename, 'rb') as f:
+            self.assertEqual(json.load(f)['write']['count'], 3)
+
+    def test_stats_percentiles(self):
+        stats = generate_mods.PipelineStats()
+        stats.add_all([('map', seconds) for seconds in [0.4, 0.1, 0.3, 0.2]])
+        summary = stats.summary()['map']
+        #nearest rank: p50 of 4 timings is the 2nd one
+        self.assertEqual((summary['p50'], summary['p90'], summary['p99']), (0.2, 0.4, 0.4))
+        stats.add_all([('write', i / 10.0) for i in range(1, 11)])
+        summary = stats.summary()['write']
+        self.assertEqual((summary['p50'], summary['p90'], summary['p99']), (0.5, 0.9, 1.0))
+
+    def test_incremental(self):
+        generate_mods.process(DataHandler(self.csv_filename), incremental=True)
+        output = self._read_output()
+        self.assertEqual(len(output), 3)
+        self.assertTrue(os.path.exists(generate_mods.get_manifest_filename()))
+        #change one record & drop another
+        with open(self.csv_filename, 'wb') as f:
+            f.write(self.CSV_DATA.replace(u'Test 2', u'Test 2 (fixed)').replace(u'test3', u'test4').encode('utf-8'))
+        os.utime(os.path.join(generate_mods.MODS_DIR, 'test1.mods'), (0, 0))
+        generate_mods.process(DataHandler(self.csv_filename), incremental=True)
+        new_output = self._read_output()
+        self.assertEqual(sorted(new_output), ['test1.mods', 'test2.mods', 'test3.mods', 'test4.mods'])
+        #unchanged record wasn't rewritten
+        self.assertEqual(os.path.getmtime(os.path.join(generate_mods.MODS_DIR, 'test1.mods')), 0)
+        self.assertTrue('Test 2 (fixed)' in new_output['test2.mods'])
+        manifest = generate_mods.Manifest(generate_mods.get_manifest_filename())
+        self.assertEqual(sorted(manifest.hashes), ['test1.mods', 'test2.mods', 'test3.mods', 'test4.mods'])
+        generate_mods.process(DataHandler(self.csv_filename), incremental=True, remove_orphans=True)
+        self.assertEqual(sorted(self._read_output()), ['test1.mods', 'test2.mods', 'test4.mods'])
+        #files that weren't written by an incremental run are never overwritten
+        os.remove(generate_mods.get_manifest_filename())
+        self.assertRaises(Exception, generate_mods.process, DataHandler(self.csv_filename), incremental=True)
 
 
 if __name__ == '__main__':
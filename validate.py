@@ -1,24 +1,120 @@
 #!/usr/bin/env python
+'''Validate MODS files against the MODS 3.4 schema in this directory.
 
-#validate output files as much as possible
+The schema is loaded once (its xlink & xml imports are resolved to the
+local copies here, so no network access is needed) and files are validated
+in-process, optionally in several worker processes. A summary of the
+failures is printed at the end.
+Run './validate.py --help' to see the options.
+'''
 import os
 import sys
 import time
+import multiprocessing
+from optparse import OptionParser
 
-#list all the files in mods_files
-for f in os.listdir('mods_files'):
-    #run xmllint on each one
-    filename = './mods_files/' + f
-    print('Validating %s...' % f)
-    #xmllint --noout --schema "http://www.loc.gov/standards/mods/v3/mods-3-4.xsd" 00001817.mods
-    #args = ['/usr/bin/xmllint',  '--noout', '--schema', 
-    #    './mods-3-4.xsd.nice', './mods_files/' + f]
-    #p = Popen(args)
-    cmd = '/usr/bin/xmllint --noout --schema "http://www.loc.gov/standards/mods/v3/mods-3-4.xsd" %s' % filename
-    result = os.system(cmd)
-    if result != 0:
-        print 'Error'
-    time.sleep(3)
-
-sys.exit()
+from lxml import etree
 
+SCHEMA_DIR = os.path.dirname(os.path.abspath(__file__))
+SCHEMA_FILENAME = os.path.join(SCHEMA_DIR, 'mods-3-4.xsd')
+#schemas imported by mods-3-4.xsd -> local copies
+LOCAL_SCHEMAS = {
+    'http://www.loc.gov/mods/xml.xsd': os.path.join(SCHEMA_DIR, 'xml.xsd'),
+    'http://www.loc.gov/standards/xlink/xlink.xsd': os.path.join(SCHEMA_DIR, 'xlink.xsd'),
+}
+
+
+class LocalSchemaResolver(etree.Resolver):
+    '''Resolve the schemas imported by the MODS schema to our local copies.'''
+
+    def resolve(self, url, pubid, context):
+        if url in LOCAL_SCHEMAS:
+            return self.resolve_filename(LOCAL_SCHEMAS[url], context)
+        return None
+
+
+class ModsValidator(object):
+    '''Validate MODS documents against the MODS schema.
+
+    The schema is only loaded once, when the validator is created.'''
+
+    def __init__(self, schema_filename=SCHEMA_FILENAME):
+        parser = etree.XMLParser(no_network=True)
+        parser.resolvers.add(LocalSchemaResolver())
+        self._schema = etree.XMLSchema(etree.parse(schema_filename, parser))
+
+    def validate(self, node):
+        '''Validate an lxml element or tree (eg. the node of a Mods object).
+
+        Returns a list of error messages - an empty list means it's valid.'''
+        if self._schema.validate(node):
+            return []
+        return [u'line %s: %s' % (error.line, error.message) for error in self._schema.error_log]
+
+    def validate_file(self, filename):
+        try:
+            tree = etree.parse(filename)
+        except etree.XMLSyntaxError as e:
+            return [unicode(e)]
+        return self.validate(tree)
+
+
+#validator for each worker process
+_validator = None
+
+
+def _init_worker():
+    global _validator
+    _validator = ModsValidator()
+
+
+def _validate_file_worker(filename):
+    return (filename, _validator.validate_file(filename))
+
+
+def validate_files(filenames, workers=1):
+    '''Validate a list of files. Yields (filename, errors) tuples, in the same
+    order as filenames.'''
+    if workers > 1:
+        pool = multiprocessing.Pool(workers, _init_worker)
+        try:
+            for result in pool.imap(_validate_file_worker, filenames, 16):
+                yield result
+        finally:
+            pool.terminate()
+    else:
+        validator = ModsValidator()
+        for filename in filenames:
+            yield (filename, validator.validate_file(filename))
+
+
+if __name__ == '__main__':
+    parser = OptionParser(usage='%prog [options] [directory or file ...] (default is mods_files)')
+    parser.add_option('-w', '--workers',
+                    action='store', dest='workers', type='int', default=1,
+                    help='number of processes to validate with (default is 1)')
+    parser.add_option('-q', '--quiet',
+                    action='store_true', dest='quiet', default=False,
+                    help="don't list each file as it's validated")
+    (options, args) = parser.parse_args()
+    filenames = []
+    for path in args or ['mods_files']:
+        if os.path.isdir(path):
+            filenames.extend(os.path.join(path, f) for f in sorted(os.listdir(path)))
+        else:
+            filenames.append(path)
+    start_time = time.time()
+    failures = []
+    for filename, errors in validate_files(filenames, options.workers):
+        if errors:
+            failures.append((filename, errors))
+            print('%s: INVALID' % filename)
+            for error in errors:
+                print(u'    %s' % error)
+        elif not options.quiet:
+            print('%s: ok' % filename)
+    print('Validated %d files in %.2f seconds: %d valid, %d invalid.' %
+          (len(filenames), time.time() - start_time, len(filenames) - len(failures), len(failures)))
+    for filename, errors in failures:
+        print('    %s (%d errors)' % (filename, len(errors)))
+    sys.exit(1 if failures else 0)